@@ -0,0 +1,191 @@
+"""Acumulación temporal de cubos de radar (tiempo, Y, X) en totales de lluvia.
+
+Los cubos se recorren paso a paso: en memoria solo viven el paso actual y el
+acumulador de la ventana en curso, así que un día de escaneos cada 5 minutos
+se acumula con memoria acotada aunque el archivo no quepa en RAM.
+
+Los cubos de reflectividad (``tipo='reflectividad'``) se convierten a
+intensidad con una ``reflectividad.RelacionZR`` sobre el mismo paso leído,
+sin copias adicionales.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from reflectividad import RelacionZR
+
+# Ventanas de acumulación habituales (cualquier frecuencia de pandas es válida)
+VENTANAS = ('1h', '3h', '6h', '24h')
+
+# Tipo de dato de cada paso: intensidad en mm/h, lámina ya acumulada en mm o reflectividad en dBZ
+TIPOS = ('intensidad', 'acumulado', 'reflectividad')
+
+
+def dimension_tiempo(radar_da):
+    """Nombre de la dimensión temporal del campo de radar, o None si es 2D"""
+    extra = [dim for dim in radar_da.dims if dim not in ('Y', 'X')]
+    if len(extra) > 1:
+        raise ValueError(f"El radar tiene más de una dimensión no espacial: {extra}")
+    return extra[0] if extra else None
+
+
+def _tiempos(radar_da, dim):
+    """Marcas de tiempo del cubo, validadas como crecientes"""
+    if dim not in radar_da.coords:
+        raise ValueError(f"La dimensión '{dim}' del radar no tiene coordenada de tiempo")
+
+    tiempos = pd.DatetimeIndex(radar_da[dim].values)
+    if not tiempos.is_monotonic_increasing:
+        raise ValueError("Los pasos de tiempo del radar no están en orden creciente")
+    return tiempos
+
+
+def _duraciones_horas(tiempos, paso_minutos=None):
+    """Duración (h) del intervalo (t[i-1], t[i]] que representa cada paso"""
+    if paso_minutos is not None:
+        return np.full(len(tiempos), paso_minutos / 60.0)
+
+    if len(tiempos) < 2:
+        raise ValueError("Con un solo paso de tiempo hay que indicar paso_minutos")
+
+    diferencias = np.diff(tiempos.values).astype('timedelta64[s]').astype(float) / 3600.0
+    # El primer paso no tiene anterior: se asume el paso típico del archivo
+    return np.concatenate([[np.median(diferencias)], diferencias])
+
+
+def _acumular_pasos(radar_da, dim, indices, duraciones, tipo, zr=None):
+    """Suma los pasos ``indices`` leyendo uno cada vez; devuelve (mm, horas cubiertas)"""
+    acumulado = np.zeros(radar_da.shape[-2:], dtype=np.float32)
+    validos = np.zeros(radar_da.shape[-2:], dtype=np.uint16)
+
+    for i in indices:
+        # Solo se lee de disco el paso actual
+        paso = np.array(radar_da.isel({dim: i}).values, dtype=np.float32)
+        if tipo == 'reflectividad':
+            zr.intensidad(paso)
+        if tipo != 'acumulado':
+            paso *= np.float32(duraciones[i])
+
+        finitos = np.isfinite(paso)
+        np.add(acumulado, paso, out=acumulado, where=finitos)
+        validos += finitos
+
+    acumulado[validos == 0] = np.nan
+    return acumulado, float(duraciones[indices].sum())
+
+
+def _validar_tipo(tipo, zr=None):
+    """Comprueba el tipo y devuelve la relación Z-R a usar (Marshall-Palmer por defecto)"""
+    if tipo not in TIPOS:
+        raise ValueError(f"Tipo de dato desconocido: {tipo} (opciones: {', '.join(TIPOS)})")
+    if tipo == 'reflectividad' and zr is None:
+        return RelacionZR()
+    return zr
+
+
+def iterar_acumulados(radar_da, ventana='1h', tipo='intensidad', paso_minutos=None, desfase=None, zr=None):
+    """Recorre el cubo paso a paso y genera cada ventana de acumulación.
+
+    Produce tuplas ``(inicio, fin, acumulado, cobertura)`` donde ``acumulado``
+    es un array float32 (Y, X) en mm y ``cobertura`` la fracción de la ventana
+    cubierta por pasos del archivo. Los píxeles sin ningún dato válido en la
+    ventana quedan en NaN. ``desfase`` desplaza el origen de las ventanas
+    (por ejemplo '8h' para días pluviométricos de 8:00 a 8:00). Con
+    ``tipo='reflectividad'`` cada paso se convierte con ``zr``.
+    """
+    zr = _validar_tipo(tipo, zr)
+    dim = dimension_tiempo(radar_da)
+    if dim is None:
+        raise ValueError("El campo de radar no tiene dimensión temporal")
+
+    tiempos = _tiempos(radar_da, dim)
+    duraciones = _duraciones_horas(tiempos, paso_minutos)
+    periodo = pd.Timedelta(ventana)
+    desfase = pd.Timedelta(desfase or 0)
+    horas_ventana = periodo / pd.Timedelta(hours=1)
+
+    # Ventana (inicio, inicio + periodo] de cada paso; los pasos están ordenados
+    inicios = (tiempos - pd.Timedelta(1, 'ns') - desfase).floor(periodo) + desfase
+    cortes = np.flatnonzero(inicios[1:] != inicios[:-1]) + 1
+
+    for indices in np.split(np.arange(len(tiempos)), cortes):
+        inicio = inicios[indices[0]]
+        acumulado, horas = _acumular_pasos(radar_da, dim, indices, duraciones, tipo, zr)
+        yield inicio, inicio + periodo, acumulado, horas / horas_ventana
+
+
+def _campo_acumulado(radar_da, dim, datos, attrs, zr=None):
+    """DataArray 2D o 3D con las coordenadas espaciales del radar original"""
+    coords = {nombre: coord for nombre, coord in radar_da.coords.items() if dim not in coord.dims}
+    dims = ('Y', 'X') if datos.ndim == 2 else (dim, 'Y', 'X')
+    atributos = dict(radar_da.attrs)
+    atributos.update(attrs)
+    if zr is not None:
+        atributos['relacion_zr'] = repr(zr)
+    return xr.DataArray(datos, dims=dims, coords=coords, attrs=atributos)
+
+
+def acumular(radar_da, ventana='1h', tipo='intensidad', paso_minutos=None, desfase=None, zr=None, log=print):
+    """Acumula un cubo (tiempo, Y, X) en totales por ventana.
+
+    Devuelve un DataArray (tiempo, Y, X) etiquetado con el fin de cada ventana
+    y con las coordenadas ``inicio`` y ``cobertura`` por ventana.
+    """
+    dim = dimension_tiempo(radar_da)
+    inicios, fines, campos, coberturas = [], [], [], []
+
+    for inicio, fin, acumulado, cobertura in iterar_acumulados(radar_da, ventana, tipo, paso_minutos, desfase,
+                                                                 zr):
+        inicios.append(inicio)
+        fines.append(fin)
+        campos.append(acumulado)
+        coberturas.append(cobertura)
+        if cobertura < 0.999:
+            log(f"Aviso: la ventana {inicio} - {fin} solo tiene datos para el {cobertura:.0%} del periodo")
+
+    log(f"Ventanas de {ventana} acumuladas: {len(campos)}")
+
+    da = _campo_acumulado(radar_da, dim, np.stack(campos), {'units': 'mm', 'ventana': ventana}, zr)
+    return da.assign_coords({
+        dim: (dim, pd.DatetimeIndex(fines)),
+        'inicio': (dim, pd.DatetimeIndex(inicios)),
+        'cobertura': (dim, np.array(coberturas)),
+    })
+
+
+def acumulado_ventana(radar_da, fin=None, ventana='24h', tipo='intensidad', paso_minutos=None, zr=None,
+                      log=print):
+    """Total de lluvia en la ventana (fin - ventana, fin] del cubo.
+
+    Solo se leen los pasos que caen dentro de la ventana. Si no se indica
+    ``fin`` se usa el último paso del archivo. Sirve para comparar el radar
+    con pluviómetros que reportan acumulados de ese mismo periodo.
+    """
+    zr = _validar_tipo(tipo, zr)
+    dim = dimension_tiempo(radar_da)
+    if dim is None:
+        raise ValueError("El campo de radar no tiene dimensión temporal")
+
+    tiempos = _tiempos(radar_da, dim)
+    duraciones = _duraciones_horas(tiempos, paso_minutos)
+    fin = tiempos[-1] if fin is None else pd.Timestamp(fin)
+    inicio = fin - pd.Timedelta(ventana)
+
+    indices = np.flatnonzero((tiempos > inicio) & (tiempos <= fin))
+    if indices.size == 0:
+        raise ValueError(f"No hay pasos de radar en la ventana {inicio} - {fin}")
+
+    # Las duraciones se calculan con el archivo completo para no perder el primer intervalo
+    acumulado, horas = _acumular_pasos(radar_da, dim, indices, duraciones, tipo, zr)
+    cobertura = horas / (pd.Timedelta(ventana) / pd.Timedelta(hours=1))
+
+    log(f"Acumulado de {ventana} entre {inicio} y {fin}: {indices.size} pasos "
+        f"({cobertura:.0%} del periodo)")
+
+    return _campo_acumulado(radar_da, dim, acumulado, {
+        'units': 'mm',
+        'ventana': ventana,
+        'inicio': str(inicio),
+        'fin': str(fin),
+        'cobertura': cobertura,
+    }, zr)
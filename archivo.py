@@ -0,0 +1,294 @@
+"""Archivo de campos corregidos en memoria mapeada para leer series temporales por píxel.
+
+Sacar la serie de una temporada en un pluviómetro abriendo cada NetCDF obliga
+a leer (y descomprimir) un campo entero por escaneo. Este archivo guarda los
+campos float32 «transpuestos por bloques»: cada bloque de ``tam_bloque``
+instantes se escribe como (píxel, instante), de modo que la serie de un
+píxel son ``T / tam_bloque`` lecturas contiguas en lugar de ``T`` campos.
+
+Un archivo es un directorio con:
+
+- ``indice.json``: geometría del radar (centro, resolución, forma), tamaño
+  de bloque, unidades e instantes de todos los campos.
+- ``bloques.f32``: bloques completos, (bloque, píxel, instante).
+- ``cola.f32``: últimos campos aún sin bloque completo, (instante, píxel).
+  Al llenarse la cola se transpone por trozos y se pasa a ``bloques.f32``.
+
+Los datos se escriben antes que el índice (que se sustituye de forma
+atómica), así que un corte a mitad de escritura deja el archivo como estaba.
+Los lectores se fían del índice e ignoran los bytes que haya detrás; solo
+el escritor (``modo='a'``) recorta esos restos al abrir el archivo, de modo
+que consultar mientras otro proceso escribe no le quita datos.
+
+Ejemplo:
+    python lote.py "escaneos/*.nc" --pluviometros lluvia.xls --producto temporada.arch
+    python archivo.py temporada.arch --pluviometros lluvia.xls -o series.csv
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from geometria import obtener_geometria
+from muestreo import METODOS_MUESTREO, preparar_muestreo
+
+VERSION = 1
+
+# Instantes por bloque transpuesto: la serie de un píxel en una temporada de
+# escaneos cada 5 minutos son unas cien lecturas de 1 KB
+TAM_BLOQUE = 256
+
+# Memoria máxima al transponer la cola en bloques
+BYTES_TRANSPOSICION = 64 * 2 ** 20
+
+TIPO = np.dtype('<f4')
+
+
+class ArchivoCampos:
+    """Serie de campos (tiempo, Y, X) de una geometría de radar, en disco.
+
+    ``modo='r'`` solo lee; ``modo='a'`` permite agregar campos y, al abrir,
+    descarta lo que dejó una escritura interrumpida.
+    """
+
+    def __init__(self, ruta, modo='r'):
+        if modo not in ('r', 'a'):
+            raise ValueError(f"Modo de archivo no válido: {modo}")
+        self.ruta = ruta
+        self.modo = modo
+        with open(os.path.join(ruta, 'indice.json'), encoding='utf-8') as f:
+            indice = json.load(f)
+        if indice.get('version') != VERSION:
+            raise ValueError(f"Versión de archivo no soportada: {indice.get('version')}")
+
+        self.centro = tuple(indice['centro'])
+        self.resolucion_km = indice['resolucion_km']
+        self.forma = tuple(indice['forma'])
+        self.tam_bloque = indice['tam_bloque']
+        self.unidades = indice.get('unidades', 'mm')
+        self.tiempos = pd.DatetimeIndex(indice['tiempos'])
+        if modo == 'a':
+            self._descartar_restos()
+
+    @classmethod
+    def crear(cls, ruta, centro, resolucion_km, forma, tam_bloque=TAM_BLOQUE, unidades='mm'):
+        """Archivo vacío para la geometría indicada"""
+        if os.path.exists(os.path.join(ruta, 'indice.json')):
+            raise FileExistsError(f"Ya existe un archivo en {ruta}")
+        os.makedirs(ruta, exist_ok=True)
+        for nombre in ('bloques.f32', 'cola.f32'):
+            open(os.path.join(ruta, nombre), 'wb').close()
+        _escribir_indice(ruta, {
+            'version': VERSION,
+            'centro': [float(c) for c in centro],
+            'resolucion_km': float(resolucion_km),
+            'forma': [int(n) for n in forma],
+            'tam_bloque': int(tam_bloque),
+            'unidades': unidades,
+            'tiempos': [],
+        })
+        return cls(ruta, modo='a')
+
+    @property
+    def geometria(self):
+        return obtener_geometria(*self.centro, self.resolucion_km, self.forma)
+
+    @property
+    def pixeles(self):
+        return self.forma[0] * self.forma[1]
+
+    @property
+    def n_bloques(self):
+        return len(self.tiempos) // self.tam_bloque
+
+    @property
+    def n_cola(self):
+        return len(self.tiempos) % self.tam_bloque
+
+    def _archivo(self, nombre):
+        return os.path.join(self.ruta, nombre)
+
+    def _descartar_restos(self):
+        """Recorta los datos escritos tras el último índice válido (escrituras interrumpidas)"""
+        esperado = {'bloques.f32': self.n_bloques * self.pixeles * self.tam_bloque * TIPO.itemsize,
+                    'cola.f32': self.n_cola * self.pixeles * TIPO.itemsize}
+        for nombre, tamano in esperado.items():
+            if os.path.getsize(self._archivo(nombre)) > tamano:
+                os.truncate(self._archivo(nombre), tamano)
+
+    def _bloques(self):
+        if not self.n_bloques:
+            return np.empty((0, self.pixeles, self.tam_bloque), dtype=TIPO)
+        return np.memmap(self._archivo('bloques.f32'), dtype=TIPO, mode='r',
+                         shape=(self.n_bloques, self.pixeles, self.tam_bloque))
+
+    def _cola(self, modo='r'):
+        if not self.n_cola:
+            return np.empty((0, self.pixeles), dtype=TIPO)
+        return np.memmap(self._archivo('cola.f32'), dtype=TIPO, mode=modo, shape=(self.n_cola, self.pixeles))
+
+    def _guardar_indice(self):
+        _escribir_indice(self.ruta, {
+            'version': VERSION,
+            'centro': list(self.centro),
+            'resolucion_km': self.resolucion_km,
+            'forma': list(self.forma),
+            'tam_bloque': self.tam_bloque,
+            'unidades': self.unidades,
+            'tiempos': [t.isoformat() for t in self.tiempos],
+        })
+
+    def comprobar_rejilla(self, centro, resolucion_km, forma):
+        if (tuple(forma) != self.forma or not np.isclose(resolucion_km, self.resolucion_km)
+                or not np.allclose(centro, self.centro)):
+            raise ValueError("La rejilla del campo no coincide con la del archivo")
+
+    def agregar(self, valores, tiempo):
+        """Añade un campo (Y, X); si el instante ya está, lo sustituye"""
+        if self.modo != 'a':
+            raise ValueError("El archivo está abierto solo para lectura")
+        valores = np.ascontiguousarray(valores, dtype=TIPO)
+        if valores.shape != self.forma:
+            raise ValueError(f"El campo {valores.shape} no tiene la forma del archivo {self.forma}")
+        tiempo = pd.Timestamp(tiempo)
+
+        if tiempo in self.tiempos:
+            self._sustituir(self.tiempos.get_loc(tiempo), valores)
+            return
+        if len(self.tiempos) and tiempo < self.tiempos[-1]:
+            raise ValueError(f"El archivo solo admite campos posteriores al último ({self.tiempos[-1]})")
+
+        with open(self._archivo('cola.f32'), 'ab') as f:
+            f.write(valores.tobytes())
+        self.tiempos = self.tiempos.append(pd.DatetimeIndex([tiempo]))
+        if self.n_cola == 0:
+            self._cerrar_bloque()
+        self._guardar_indice()
+        if self.n_cola == 0:
+            # Solo cuando el índice ya cuenta con el bloque nuevo
+            os.truncate(self._archivo('cola.f32'), 0)
+
+    def _cerrar_bloque(self):
+        """Escribe la cola llena como bloque transpuesto (píxel, instante)"""
+        cola = np.memmap(self._archivo('cola.f32'), dtype=TIPO, mode='r',
+                         shape=(self.tam_bloque, self.pixeles))
+        paso = max(1, BYTES_TRANSPOSICION // (self.tam_bloque * TIPO.itemsize))
+        with open(self._archivo('bloques.f32'), 'ab') as f:
+            for inicio in range(0, self.pixeles, paso):
+                f.write(np.ascontiguousarray(cola[:, inicio:inicio + paso].T).tobytes())
+
+    def _sustituir(self, i, valores):
+        bloque, j = divmod(i, self.tam_bloque)
+        if bloque < self.n_bloques:
+            bloques = np.memmap(self._archivo('bloques.f32'), dtype=TIPO, mode='r+',
+                                shape=(self.n_bloques, self.pixeles, self.tam_bloque))
+            bloques[bloque, :, j] = valores.ravel()
+            bloques.flush()
+        else:
+            cola = self._cola('r+')
+            cola[j] = valores.ravel()
+            cola.flush()
+
+    def series_pixeles(self, indices):
+        """Series (tiempo, píxeles) de los píxeles de índice plano ``indices``"""
+        indices = np.atleast_1d(np.asarray(indices, dtype=np.intp))
+        # Cada bloque aporta un tramo contiguo por píxel; la cola, un valor por campo
+        desde_bloques = self._bloques()[:, indices, :].transpose(0, 2, 1).reshape(-1, indices.size)
+        desde_cola = self._cola()[:, indices]
+        return np.concatenate([desde_bloques, desde_cola]).astype(TIPO, copy=False)
+
+    def serie_pixel(self, fila, columna):
+        """Serie temporal de un píxel (pd.Series indexada por instante)"""
+        return pd.Series(self.series_pixeles([fila * self.forma[1] + columna])[:, 0], index=self.tiempos)
+
+    def series_puntos(self, lon_pts, lat_pts, metodo='bilineal', nombres=None):
+        """Series interpoladas en puntos lon/lat: DataFrame (instante × punto).
+
+        Solo se leen los píxeles que intervienen en la interpolación de cada punto.
+        """
+        geometria = self.geometria
+        x_pts, y_pts = geometria.proyectar(lon_pts, lat_pts)
+        plan = preparar_muestreo(geometria.x, geometria.y, x_pts, y_pts, metodo)
+
+        resultado = np.full((len(self.tiempos), plan.dentro.size), np.nan, dtype=np.float32)
+        if plan.indices.size:
+            unicos, inverso = np.unique(plan.indices, return_inverse=True)
+            series = self.series_pixeles(unicos)[:, inverso.reshape(plan.indices.shape)]
+            resultado[:, plan.dentro] = np.sum(series * plan.pesos.astype(np.float32), axis=1)
+
+        columnas = nombres if nombres is not None else [f"punto_{i}" for i in range(plan.dentro.size)]
+        return pd.DataFrame(resultado, index=self.tiempos, columns=columnas)
+
+    def campo(self, i):
+        """Campo (Y, X) del instante de posición ``i`` (lectura con saltos: para consultas puntuales)"""
+        bloque, j = divmod(i, self.tam_bloque)
+        if bloque < self.n_bloques:
+            return np.array(self._bloques()[bloque, :, j]).reshape(self.forma)
+        return np.array(self._cola()[j]).reshape(self.forma)
+
+
+def _escribir_indice(ruta, indice):
+    temporal = os.path.join(ruta, f"indice.json.{os.getpid()}.tmp")
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(indice, f)
+    os.replace(temporal, os.path.join(ruta, 'indice.json'))
+
+
+def abrir_o_crear(ruta, centro, resolucion_km, forma, unidades='mm'):
+    """Archivo existente en ``ruta`` (comprobando su rejilla) o uno nuevo"""
+    if os.path.exists(os.path.join(ruta, 'indice.json')):
+        archivo = ArchivoCampos(ruta, modo='a')
+        archivo.comprobar_rejilla(centro, resolucion_km, forma)
+        return archivo
+    return ArchivoCampos.crear(ruta, centro, resolucion_km, forma, unidades=unidades)
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Series temporales de lluvia desde un archivo de campos (.arch)")
+    parser.add_argument("archivo", help="Directorio del archivo de campos")
+    parser.add_argument("--pluviometros", default=None, help="Series en cada pluviómetro de esta tabla")
+    parser.add_argument("--punto", type=float, nargs=2, action="append", default=None, metavar=("LON", "LAT"),
+                        help="Serie en un punto lon/lat (repetible)")
+    parser.add_argument("--metodo", default="bilineal", choices=METODOS_MUESTREO,
+                        help="Interpolación en los puntos")
+    parser.add_argument("-o", "--salida", default=None, help="CSV de salida (por defecto, se muestra)")
+    return parser
+
+
+def main(argv=None):
+    args = crear_parser().parse_args(argv)
+
+    try:
+        archivo = ArchivoCampos(args.archivo)
+        if args.pluviometros:
+            import pluviometros
+
+            tabla = pluviometros.cargar_tabla(args.pluviometros, log=lambda mensaje: None)
+            series = archivo.series_puntos(tabla.longitud.values, tabla.latitud.values, args.metodo,
+                                           nombres=[f"{lon:.4f},{lat:.4f}" for lon, lat
+                                                    in zip(tabla.longitud, tabla.latitud)])
+        elif args.punto:
+            lon, lat = np.array(args.punto).T
+            series = archivo.series_puntos(lon, lat, args.metodo,
+                                           nombres=[f"{x:.4f},{y:.4f}" for x, y in args.punto])
+        else:
+            print(f"{len(archivo.tiempos)} campos {archivo.forma} de {archivo.tiempos.min()} a "
+                  f"{archivo.tiempos.max()} ({archivo.unidades})")
+            return 0
+    except Exception as e:
+        print(f"ERROR: {str(e)}", file=sys.stderr)
+        return 1
+
+    if args.salida:
+        series.to_csv(args.salida, index_label='tiempo')
+        print(f"Series guardadas en: {args.salida}")
+    else:
+        print(series.to_string(float_format=lambda v: f"{v:.2f}"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""Banco de pruebas de rendimiento con radares y redes de pluviómetros sintéticos.
+
+Genera campos de radar de tamaño creciente (100² a 4000² píxeles) sobre un
+mismo dominio y redes de 10 a 10 000 pluviómetros, los escribe a NetCDF y
+CSV y mide cada etapa con ``instrumentacion.RegistroEjecucion``: carga del
+radar, lectura de pluviómetros, muestreo, corrección y mapa. Todo es
+reproducible (semilla fija) y funciona sin red: el mapa se dibuja sin las
+costas de Natural Earth.
+
+Los resultados se añaden a un JSON Lines para compararlos entre versiones
+y el proceso termina con código 1 si alguna etapa supera su presupuesto.
+
+Ejemplo:
+    python benchmark.py --escala rapida
+    python benchmark.py --escala completa --metodos idw kriging --comparar
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import correccion
+import fusion
+import geometria
+import instrumentacion
+import pluviometros
+import renderizado
+
+# (píxeles por lado, número de pluviómetros)
+ESCALAS = {
+    'rapida': [(100, 10), (500, 100), (1000, 1000)],
+    'completa': [(n, m) for n in (100, 500, 1000, 2000, 4000) for m in (10, 100, 1000, 10000)],
+}
+
+# Todos los radares cubren el mismo dominio; solo cambia la resolución
+LADO_DOMINIO_KM = 400.0
+
+# Presupuesto de cada etapa: segundos fijos + por millón de píxeles + por mil pluviómetros
+PRESUPUESTOS = {
+    'cargar_radar': (1.0, 1.0, 0.0),
+    'cargar_pluviometros': (1.0, 0.0, 0.5),
+    'muestreo': (0.5, 0.1, 0.2),
+    'correccion': (2.0, 16.0, 1.0),
+    'generar_mapa': (3.0, 2.0, 0.5),
+}
+
+RUTA_RESULTADOS = 'resultados_benchmark.jsonl'
+
+
+def campo_sintetico(n, semilla=0):
+    """Campo de lluvia (mm) n×n con celdas convectivas gaussianas y fondo estratiforme"""
+    rng = np.random.default_rng(semilla)
+    eje = np.linspace(0.0, 1.0, n, dtype=np.float32)
+    campo = np.zeros((n, n), dtype=np.float32)
+    for _ in range(12):
+        cx, cy = rng.uniform(0, 1, 2)
+        radio = rng.uniform(0.03, 0.15)
+        intensidad = rng.gamma(2.0, 15.0)
+        # Producto exterior de dos gaussianas 1D: sin rejillas n×n intermedias
+        gx = np.exp(-((eje - cx) ** 2) / (2 * radio ** 2))
+        gy = np.exp(-((eje - cy) ** 2) / (2 * radio ** 2))
+        campo += np.float32(intensidad) * np.outer(gy, gx)
+    campo += np.float32(0.5)
+    return campo
+
+
+def pluviometros_sinteticos(geometria, campo, m, semilla=0):
+    """Tabla de m pluviómetros dentro del dominio con el radar afectado de un sesgo y ruido"""
+    rng = np.random.default_rng(semilla + 1)
+    ix = rng.integers(0, len(geometria.x), m)
+    iy = rng.integers(0, len(geometria.y), m)
+    lon_pts, lat_pts = geometria.desproyectar(geometria.x[ix], geometria.y[iy])
+    precipitacion = campo[iy, ix] * 1.3 * rng.lognormal(0.0, 0.3, m)
+    return pd.DataFrame({'longitud': lon_pts, 'latitud': lat_pts, 'precipitacion': precipitacion})
+
+
+def escribir_entradas(directorio, n, m, semilla=0):
+    """Escribe el radar (NetCDF) y los pluviómetros (CSV) sintéticos; devuelve sus rutas"""
+    resolucion_km = LADO_DOMINIO_KM / n
+    rejilla = geometria.GeometriaRadar(fusion.CENTRO_LON, fusion.CENTRO_LAT, resolucion_km, (n, n))
+    campo = campo_sintetico(n, semilla)
+
+    ruta_radar = os.path.join(directorio, f"radar_{n}.nc")
+    if not os.path.exists(ruta_radar):
+        xr.Dataset({'precipitacion': (('Y', 'X'), campo, {'units': 'mm'})}).to_netcdf(ruta_radar)
+
+    ruta_pluv = os.path.join(directorio, f"pluviometros_{n}_{m}.csv")
+    tabla = pluviometros_sinteticos(rejilla, campo, m, semilla)
+    # Con cabecera, como los libros de Excel del proyecto
+    tabla.to_csv(ruta_pluv, index=False)
+    return ruta_radar, ruta_pluv, resolucion_km
+
+
+def medir_configuracion(directorio, n, m, metodo, semilla=0):
+    """Ejecuta las etapas sobre una configuración y devuelve su RegistroEjecucion"""
+    silencioso = lambda mensaje: None
+    ruta_radar, ruta_pluv, resolucion_km = escribir_entradas(directorio, n, m, semilla)
+
+    # Cada configuración empieza con las cachés frías
+    geometria.configurar_cache()
+    pluviometros._memoria.clear()
+
+    registro = instrumentacion.RegistroEjecucion(
+        contexto={'pixeles': n, 'pluviometros': m, 'metodo': metodo}
+    )
+    with registro.etapa('cargar_radar') as medida:
+        radar = medida['resultado'] = fusion.cargar_datos_radar(
+            ruta_radar, fusion.CENTRO_LON, fusion.CENTRO_LAT, resolucion_km, log=silencioso
+        )
+    with registro.etapa('cargar_pluviometros') as medida:
+        pluv = medida['resultado'] = fusion.cargar_datos_pluviometros(ruta_pluv, log=silencioso)
+
+    with registro.etapa('muestreo') as medida:
+        radar_en_pluv = medida['resultado'] = fusion.muestrear_pluviometros(radar, pluv)
+    validos = np.isfinite(radar_en_pluv)
+
+    with registro.etapa('correccion') as medida:
+        corregido = medida['resultado'] = correccion.corregir(
+            radar,
+            pluv.longitud.values[validos],
+            pluv.latitud.values[validos],
+            pluv.precipitacion.values[validos],
+            radar_en_pluv[validos],
+            metodo=metodo,
+            log=silencioso
+        )
+
+    with registro.etapa('generar_mapa'):
+        motor = renderizado.MotorMapa(geometria.geometria_de(corregido), calidad='borrador', costas=False,
+                                      log=silencioso)
+        try:
+            motor.guardar(corregido.values, os.path.join(directorio, f"mapa_{n}_{m}.png"),
+                          pluv.longitud.values, pluv.latitud.values)
+        finally:
+            motor.cerrar()
+
+    return registro
+
+
+def presupuesto(etapa, n, m, presupuestos=PRESUPUESTOS):
+    fijo, por_mpx, por_mil = presupuestos[etapa]
+    return fijo + por_mpx * n * n / 1e6 + por_mil * m / 1000
+
+
+def version_codigo():
+    """Commit actual del repositorio (cadena vacía fuera de git)"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def ultimos_resultados(ruta):
+    """Segundos por (configuración, etapa) de la ejecución anterior guardada en ``ruta``"""
+    if not os.path.exists(ruta):
+        return {}
+    anteriores = {}
+    with open(ruta, encoding='utf-8') as f:
+        for linea in f:
+            ejecucion = json.loads(linea)
+            c = ejecucion['contexto']
+            for medida in ejecucion['etapas']:
+                anteriores[(c['pixeles'], c['pluviometros'], c['metodo'], medida['etapa'])] = medida['segundos']
+    return anteriores
+
+
+def ejecutar(configuraciones, metodos, ruta_resultados=RUTA_RESULTADOS, comparar=False,
+             presupuestos=PRESUPUESTOS, semilla=0, log=print):
+    """Corre todas las configuraciones; devuelve la lista de etapas fuera de presupuesto"""
+    anteriores = ultimos_resultados(ruta_resultados) if comparar else {}
+    version = version_codigo()
+    excedidas = []
+
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as directorio:
+        # Calentamiento: importaciones diferidas y primera figura fuera de las medidas
+        medir_configuracion(directorio, 50, 5, metodos[0], semilla)
+
+        for n, m in configuraciones:
+            for metodo in metodos:
+                registro = medir_configuracion(directorio, n, m, metodo, semilla)
+                registro.contexto['version'] = version
+
+                log(f"\n=== {n}x{n} píxeles, {m} pluviómetros, {metodo} ===")
+                for medida in registro.etapas:
+                    limite = presupuesto(medida['etapa'], n, m, presupuestos)
+                    marca = "OK" if medida['segundos'] <= limite else "EXCEDE"
+                    linea = (f"{medida['etapa']:<22}{medida['segundos']:>9.3f} s"
+                             f"  (presupuesto {limite:.1f} s)  {marca}")
+                    anterior = anteriores.get((n, m, metodo, medida['etapa']))
+                    if anterior:
+                        linea += f"  x{medida['segundos'] / anterior:.2f} vs anterior"
+                    log(linea)
+                    if marca != "OK":
+                        excedidas.append((n, m, metodo, medida['etapa'], medida['segundos'], limite))
+
+                if ruta_resultados:
+                    registro.guardar(ruta_resultados)
+
+    return excedidas
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Banco de pruebas de rendimiento de la fusión")
+    parser.add_argument("--escala", default="rapida", choices=tuple(ESCALAS),
+                        help="Conjunto de configuraciones (rapida: hasta 1000², completa: hasta 4000²)")
+    parser.add_argument("--pixeles", type=int, nargs='+', default=None,
+                        help="Lados de rejilla a probar (sustituye a --escala junto con --pluviometros)")
+    parser.add_argument("--pluviometros", type=int, nargs='+', default=None,
+                        help="Tamaños de red de pluviómetros a probar")
+    parser.add_argument("--metodos", nargs='+', default=['idw'], choices=correccion.METODOS_CORRECCION,
+                        help="Métodos de corrección a medir")
+    parser.add_argument("--resultados", default=RUTA_RESULTADOS,
+                        help="JSON Lines donde se acumulan los resultados")
+    parser.add_argument("--presupuestos", default=None,
+                        help="JSON con presupuestos {etapa: [fijo, por_mpx, por_mil_pluviometros]}")
+    parser.add_argument("--comparar", action="store_true",
+                        help="Comparar con la ejecución anterior guardada en --resultados")
+    parser.add_argument("--semilla", type=int, default=0, help="Semilla de los datos sintéticos")
+    return parser
+
+
+def main(argv=None):
+    args = crear_parser().parse_args(argv)
+
+    configuraciones = ESCALAS[args.escala]
+    if args.pixeles or args.pluviometros:
+        configuraciones = [(n, m) for n in (args.pixeles or [500]) for m in (args.pluviometros or [100])]
+
+    presupuestos = dict(PRESUPUESTOS)
+    if args.presupuestos:
+        with open(args.presupuestos, encoding='utf-8') as f:
+            presupuestos.update({etapa: tuple(valores) for etapa, valores in json.load(f).items()})
+
+    excedidas = ejecutar(configuraciones, args.metodos, args.resultados, args.comparar,
+                         presupuestos, args.semilla)
+
+    if excedidas:
+        print(f"\n{len(excedidas)} etapas superan su presupuesto:", file=sys.stderr)
+        for n, m, metodo, etapa, segundos, limite in excedidas:
+            print(f"  {n}x{n}, {m} pluv., {metodo}, {etapa}: {segundos:.2f} s > {limite:.2f} s",
+                  file=sys.stderr)
+        return 1
+
+    print(f"\nTodas las etapas dentro de presupuesto. Resultados en: {args.resultados}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""Almacén de capas de límites (shapefiles) preprocesadas e indexadas.
+
+Cada shapefile de ``shpfiles/`` se lee una sola vez por proceso. Al cargarlo
+se detecta la columna de nombres, se indexan las provincias por nombre
+normalizado (sin tildes ni mayúsculas), se construye un STRtree para las
+consultas espaciales y se simplifican las geometrías por nivel de zoom, así
+que redibujar el mapa o recortar una provincia ya no vuelve a tocar el
+disco. Las rutas son relativas a este módulo, no al directorio de trabajo.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unicodedata
+
+import numpy as np
+from pandas.api.types import is_string_dtype
+
+DIRECTORIO_CAPAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shpfiles')
+
+# Tolerancia de simplificación (grados) de cada nivel de zoom
+NIVELES = {'detalle': 0.0, 'medio': 0.002, 'bajo': 0.01}
+
+# Columnas donde puede venir el nombre de la provincia, por orden de preferencia
+COLUMNAS_NOMBRE = ['NAME_1', 'name_1', 'NAM', 'nombre', 'provincia', 'name']
+
+ARCHIVOS_AUXILIARES = ('.shx', '.dbf', '.prj', '.cpg')
+
+
+def normalizar_nombre(texto):
+    """'Camagüey ' → 'camaguey' (sin tildes, minúsculas, espacios simples)"""
+    texto = unicodedata.normalize('NFKD', str(texto))
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.lower().split())
+
+
+def nivel_para_extension(ancho_grados):
+    """Nivel de simplificación adecuado para un mapa de ``ancho_grados`` de ancho"""
+    if ancho_grados > 10:
+        return 'bajo'
+    if ancho_grados > 2:
+        return 'medio'
+    return 'detalle'
+
+
+def _fin_segun_indice(ruta_shx):
+    """Tamaño en bytes del .shp que describe un .shx (último registro + cabecera)"""
+    with open(ruta_shx, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        registros = (f.tell() - 100) // 8
+        if registros <= 0:
+            return 100
+        f.seek(100 + 8 * (registros - 1))
+        desplazamiento, longitud = struct.unpack('>ii', f.read(8))
+    return (desplazamiento + 4 + longitud) * 2
+
+
+def _buscar_auxiliares(ruta_shp):
+    """Base de los archivos .shx/.dbf/.prj de un .shp.
+
+    Normalmente comparten nombre; si no (``cuba.shp`` con ``cu.shx``), se
+    busca en el mismo directorio el .shx cuyo último registro acaba justo
+    donde acaba el .shp.
+    """
+    base = os.path.splitext(ruta_shp)[0]
+    if os.path.exists(base + '.shx'):
+        return base
+
+    directorio = os.path.dirname(ruta_shp)
+    tamano = os.path.getsize(ruta_shp)
+    for nombre in sorted(os.listdir(directorio)):
+        candidato, extension = os.path.splitext(nombre)
+        if extension.lower() != '.shx' or os.path.exists(os.path.join(directorio, candidato + '.shp')):
+            continue
+        if _fin_segun_indice(os.path.join(directorio, nombre)) == tamano:
+            return os.path.join(directorio, candidato)
+    return None
+
+
+def _leer_shapefile(ruta_shp):
+    """GeoDataFrame en EPSG:4326 con los atributos decodificados como UTF-8"""
+    import geopandas as gpd
+
+    base = _buscar_auxiliares(ruta_shp)
+    if base is None:
+        raise FileNotFoundError(f"No se encontró el índice (.shx) de {ruta_shp}")
+
+    def leer(ruta):
+        try:
+            return gpd.read_file(ruta, encoding='utf-8')
+        except UnicodeDecodeError:
+            return gpd.read_file(ruta)
+
+    if base == os.path.splitext(ruta_shp)[0]:
+        gdf = leer(ruta_shp)
+    else:
+        # Se reúnen los archivos con un mismo nombre en un directorio temporal
+        with tempfile.TemporaryDirectory() as temporal:
+            destino = os.path.join(temporal, 'capa')
+            shutil.copyfile(ruta_shp, destino + '.shp')
+            for extension in ARCHIVOS_AUXILIARES:
+                if os.path.exists(base + extension):
+                    shutil.copyfile(base + extension, destino + extension)
+            gdf = leer(destino + '.shp')
+
+    if gdf.crs is not None:
+        gdf = gdf.to_crs("EPSG:4326")
+    return gdf
+
+
+class CapaLimites:
+    """Geometrías de un shapefile con índice por nombre, STRtree y versiones simplificadas"""
+
+    def __init__(self, nombre, gdf):
+        import shapely
+
+        self.nombre = nombre
+        self.gdf = gdf.reset_index(drop=True)
+        self.geometrias = np.asarray(self.gdf.geometry.values, dtype=object)
+        self.arbol = shapely.STRtree(self.geometrias)
+        self.extension = tuple(self.gdf.total_bounds)
+
+        self.columna_nombre = next(
+            (c for c in COLUMNAS_NOMBRE if c in self.gdf.columns and is_string_dtype(self.gdf[c])), None
+        )
+        self.indice = {}
+        if self.columna_nombre is not None:
+            for i, valor in enumerate(self.gdf[self.columna_nombre]):
+                self.indice.setdefault(normalizar_nombre(valor), []).append(i)
+
+        self._simplificadas = {'detalle': self.geometrias}
+
+    def simplificadas(self, nivel='medio'):
+        """Geometrías simplificadas para un nivel de zoom (se calculan una vez)"""
+        import shapely
+
+        if nivel not in self._simplificadas:
+            self._simplificadas[nivel] = shapely.simplify(self.geometrias, NIVELES[nivel], preserve_topology=True)
+        return self._simplificadas[nivel]
+
+    def buscar(self, nombre):
+        """Índices de los elementos cuyo nombre normalizado coincide (o empieza por) ``nombre``"""
+        clave = normalizar_nombre(nombre)
+        if clave in self.indice:
+            return self.indice[clave]
+        return [i for k, indices in self.indice.items() if k.startswith(clave) for i in indices]
+
+    def geometria(self, nombre, nivel='detalle'):
+        """Geometría (unión) de la provincia ``nombre``; None si no existe"""
+        import shapely
+
+        indices = self.buscar(nombre)
+        if not indices:
+            return None
+        return shapely.union_all(self.simplificadas(nivel)[indices])
+
+    def en_extension(self, lon_min, lon_max, lat_min, lat_max):
+        """Índices de los elementos que tocan la caja dada (consulta al STRtree)"""
+        import shapely
+
+        return np.sort(self.arbol.query(shapely.box(lon_min, lat_min, lon_max, lat_max)))
+
+    def nombres_en(self, lon_pts, lat_pts):
+        """Nombre del elemento que contiene cada punto ('' fuera de todos)"""
+        import shapely
+
+        puntos = shapely.points(np.asarray(lon_pts, dtype=float), np.asarray(lat_pts, dtype=float))
+        i_puntos, i_geometrias = self.arbol.query(puntos, predicate='within')
+        nombres = np.full(len(puntos), '', dtype=object)
+        if self.columna_nombre is not None:
+            nombres[i_puntos] = self.gdf[self.columna_nombre].values[i_geometrias]
+        return nombres
+
+
+class AlmacenCapas:
+    """Capas de un directorio de shapefiles, cargadas bajo demanda y una sola vez"""
+
+    def __init__(self, directorio=DIRECTORIO_CAPAS):
+        self.directorio = directorio
+        self._capas = {}
+
+    def disponibles(self):
+        if not os.path.isdir(self.directorio):
+            return []
+        return sorted(os.path.splitext(n)[0] for n in os.listdir(self.directorio) if n.lower().endswith('.shp'))
+
+    def capa(self, nombre='cuba'):
+        if nombre not in self._capas:
+            ruta = os.path.join(self.directorio, nombre + '.shp')
+            if not os.path.exists(ruta):
+                raise FileNotFoundError(f"No existe la capa {nombre} en {self.directorio} "
+                                        f"(disponibles: {', '.join(self.disponibles())})")
+            self._capas[nombre] = CapaLimites(nombre, _leer_shapefile(ruta))
+        return self._capas[nombre]
+
+
+# Almacén compartido por el proceso
+ALMACEN = AlmacenCapas()
+
+
+def obtener_capa(nombre='cuba'):
+    """Capa de límites desde el almacén compartido"""
+    return ALMACEN.capa(nombre)
+
+
+def dibujar_limites(ax, extension, capa='cuba', resaltar=None, log=print):
+    """Dibuja los límites que caen en ``extension`` y resalta una provincia.
+
+    Devuelve False si la provincia pedida no está en la capa; si la capa no
+    se puede leer se propaga la excepción.
+    """
+    import cartopy.crs as ccrs
+
+    limites = obtener_capa(capa)
+    lon_min, lon_max, lat_min, lat_max = extension
+    nivel = nivel_para_extension(lon_max - lon_min)
+    visibles = limites.en_extension(lon_min, lon_max, lat_min, lat_max)
+    ax.add_geometries(limites.simplificadas(nivel)[visibles], crs=ccrs.PlateCarree(),
+                      facecolor='none', edgecolor='gray', linewidth=1)
+
+    if resaltar is None:
+        return True
+    provincia = limites.geometria(resaltar, nivel)
+    if provincia is None:
+        log(f"No se pudo identificar {resaltar} en el shapefile")
+        return False
+    ax.add_geometries([provincia], crs=ccrs.PlateCarree(), facecolor='none', edgecolor='red', linewidth=2)
+    return True
+
+
+def mascara_provincia(radar_da, nombre, capa='cuba'):
+    """Máscara (Y, X) de los píxeles del radar dentro de una provincia, cacheada por geometría"""
+    from geometria import geometria_de, mascara_poligonos
+
+    limites = obtener_capa(capa)
+    provincia = limites.geometria(nombre)
+    if provincia is None:
+        raise ValueError(f"No existe la provincia {nombre} en la capa {capa}")
+    return geometria_de(radar_da).mascara(
+        f"provincia|{capa}|{normalizar_nombre(nombre)}",
+        lambda g: mascara_poligonos(g, [provincia])
+    )
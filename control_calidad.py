@@ -0,0 +1,242 @@
+"""Control de calidad de los pluviómetros antes de la fusión.
+
+``pluviometros.limpiar_tabla`` solo descarta filas sin coordenadas y lluvias
+negativas. Este control revisa toda la red con operaciones vectorizadas
+(sin bucles por estación) y asigna a cada pluviómetro descartado un motivo:
+
+- ``fuera_de_rango``: precipitación sin dato, negativa o mayor que
+  ``max_precipitacion``.
+- ``fuera_del_dominio``: el radar no tiene dato en el pluviómetro.
+- ``duplicado``: misma posición (redondeada a ``resolucion_grados``) que
+  otro pluviómetro; de cada posición se conserva la lectura mediana, para
+  que el resultado no dependa del orden de la tabla.
+- ``espacial``: se aleja de la mediana de sus vecinos (KD-tree, hasta
+  ``radio_km``) más de ``umbral_z`` veces su dispersión (MAD, con un mínimo
+  que crece con la lluvia de los vecinos) y más de ``diferencia_minima`` mm.
+  No se marca si el radar lo respalda: su lectura coincide con la del radar
+  dentro de un factor ``factor_discrepancia`` o el radar ve la misma
+  anomalía frente a los vecinos (un núcleo convectivo aislado).
+- ``radar``: su log-cociente pluviómetro/radar se aleja del de la red más
+  que ``umbral_z`` dispersiones y que un factor ``factor_discrepancia``; el
+  sesgo común de todo el radar no cuenta como discrepancia.
+
+Cada criterio se evalúa solo sobre los pluviómetros que superan los
+anteriores, para que un duplicado o un valor absurdo no contamine la mediana
+de sus vecinos ni el sesgo de referencia. El coste es O(n log n) en el número
+de pluviómetros (miles de estaciones en milisegundos).
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from correccion import coordenadas_km
+
+MOTIVOS = ('fuera_de_rango', 'fuera_del_dominio', 'duplicado', 'espacial', 'radar')
+
+MAX_PRECIPITACION_MM = 500.0
+RESOLUCION_DUPLICADOS_GRADOS = 1e-4
+
+VECINOS_CONTROL = 8
+RADIO_VECINOS_KM = 50.0
+MIN_VECINOS = 3
+UMBRAL_Z = 5.0
+# Dispersión mínima de los vecinos: en zonas secas la MAD es 0 (mm) y, con lluvia,
+# una fracción de su media, porque la variabilidad de la lluvia crece con su intensidad
+DISPERSION_MINIMA_MM = 2.0
+DISPERSION_RELATIVA = 0.5
+DIFERENCIA_MINIMA_MM = 10.0
+
+FACTOR_DISCREPANCIA = 10.0
+MIN_PARES_RADAR = 5
+# Desplazamiento del log-cociente (mm), para que los ceros no lo disparen
+DESPLAZAMIENTO_MM = 1.0
+
+# Factor que convierte la MAD en desviación típica para datos normales
+ESCALA_MAD = 1.4826
+
+
+def claves_posicion(lon_pts, lat_pts, resolucion_grados=RESOLUCION_DUPLICADOS_GRADOS):
+    """Entero único por celda de ``resolucion_grados`` (las posiciones iguales comparten clave)"""
+    ix = np.rint(np.asarray(lon_pts, dtype=float) / resolucion_grados).astype(np.int64)
+    iy = np.rint(np.asarray(lat_pts, dtype=float) / resolucion_grados).astype(np.int64)
+    desfase = int(round(180.0 / resolucion_grados))
+    return iy * (2 * desfase + 1) + (ix + desfase)
+
+
+def marcar_duplicados(lon_pts, lat_pts, valores, resolucion_grados=RESOLUCION_DUPLICADOS_GRADOS):
+    """(duplicados, grupos con lecturas distintas): todos menos la lectura mediana de cada posición"""
+    lon_pts = np.asarray(lon_pts, dtype=float)
+    lat_pts = np.asarray(lat_pts, dtype=float)
+    claves = claves_posicion(lon_pts, lat_pts, resolucion_grados)
+    # Por posición y lectura (y coordenadas exactas para desempatar): no depende del orden de las filas
+    orden = np.lexsort((lat_pts, lon_pts, valores, claves))
+    ordenadas = claves[orden]
+    inicios = np.flatnonzero(np.r_[True, ordenadas[1:] != ordenadas[:-1]])
+    cuentas = np.diff(np.r_[inicios, len(claves)])
+    duplicados = np.ones(len(claves), dtype=bool)
+    duplicados[orden[inicios + (cuentas - 1) // 2]] = False
+
+    # Rango de las lecturas de cada grupo, para avisar de los duplicados que no coinciden
+    lecturas = np.asarray(valores, dtype=float)[orden]
+    rango = lecturas[inicios + cuentas - 1] - lecturas[inicios]
+    conflictivos = int(np.sum((cuentas > 1) & (rango > 0.1)))
+    return duplicados, conflictivos
+
+
+def _anomalia_vecinos(valores, indices, min_vecinos, dispersion_minima):
+    """(diferencia, z) de cada valor frente a la mediana y la MAD de sus vecinos (``indices``)"""
+    valores_vecinos = np.append(valores, np.nan)[indices]
+    with warnings.catch_warnings():
+        # Filas sin vecinos: mediana NaN, se descartan abajo
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mediana = np.nanmedian(valores_vecinos, axis=1)
+        mad = np.nanmedian(np.abs(valores_vecinos - mediana[:, np.newaxis]), axis=1)
+        magnitud = np.nanmean(np.abs(valores_vecinos), axis=1)
+
+    diferencia = valores - mediana
+    z = diferencia / np.maximum.reduce([ESCALA_MAD * mad, DISPERSION_RELATIVA * magnitud,
+                                        np.full(len(valores), dispersion_minima)])
+    z[np.isfinite(valores_vecinos).sum(axis=1) < min_vecinos] = np.nan
+    return diferencia, z
+
+
+def atipicos_espaciales(x_pts, y_pts, valores, radar_en_pluv=None, vecinos=VECINOS_CONTROL,
+                        radio_km=RADIO_VECINOS_KM, min_vecinos=MIN_VECINOS, umbral_z=UMBRAL_Z,
+                        dispersion_minima=DISPERSION_MINIMA_MM, diferencia_minima=DIFERENCIA_MINIMA_MM,
+                        factor=FACTOR_DISCREPANCIA):
+    """(atípicos, z): cada pluviómetro frente a la mediana y la MAD de sus vecinos.
+
+    Los pluviómetros con menos de ``min_vecinos`` vecinos a menos de
+    ``radio_km`` no se evalúan (z = NaN). Con ``radar_en_pluv`` no se marca
+    una anomalía que el radar respalda: lectura igual a la del radar dentro de
+    un factor ``factor``, o la misma anomalía en el radar frente a los vecinos.
+    """
+    n = len(valores)
+    if n <= min_vecinos:
+        return np.zeros(n, dtype=bool), np.full(n, np.nan)
+
+    xy = np.column_stack([x_pts, y_pts])
+    _, indices = cKDTree(xy).query(xy, k=min(vecinos + 1, n), distance_upper_bound=radio_km)
+    # El propio pluviómetro no es su vecino (con empates no tiene por qué ser el primero)
+    indices = np.where(indices == np.arange(n)[:, np.newaxis], n, indices)
+
+    diferencia, z = _anomalia_vecinos(valores, indices, min_vecinos, dispersion_minima)
+    atipicos = (np.abs(np.nan_to_num(z)) > umbral_z) & (np.abs(diferencia) > diferencia_minima)
+    if radar_en_pluv is not None:
+        cociente = np.log((valores + DESPLAZAMIENTO_MM) / (radar_en_pluv + DESPLAZAMIENTO_MM))
+        coincide = np.abs(cociente) <= np.log(factor)
+        _, z_radar = _anomalia_vecinos(radar_en_pluv, indices, min_vecinos, dispersion_minima)
+        misma_anomalia = (np.sign(z_radar) == np.sign(z)) & (np.abs(z_radar) > umbral_z / 2)
+        atipicos &= ~(coincide | misma_anomalia)
+    return atipicos, z
+
+
+def discrepancias_radar(valores, radar_en_pluv, umbral_z=UMBRAL_Z, factor=FACTOR_DISCREPANCIA,
+                        diferencia_minima=DIFERENCIA_MINIMA_MM, min_pares=MIN_PARES_RADAR):
+    """(discrepantes, desviación): log-cociente pluviómetro/radar frente al de toda la red"""
+    n = len(valores)
+    if n < min_pares:
+        return np.zeros(n, dtype=bool), np.full(n, np.nan)
+
+    cocientes = np.log((valores + DESPLAZAMIENTO_MM) / (radar_en_pluv + DESPLAZAMIENTO_MM))
+    sesgo = float(np.median(cocientes))
+    desviacion = cocientes - sesgo
+    mad = float(np.median(np.abs(desviacion)))
+    umbral = max(umbral_z * ESCALA_MAD * mad, np.log(factor))
+
+    # Lo que marcaría el radar una vez quitado el sesgo común de la red
+    esperado = (radar_en_pluv + DESPLAZAMIENTO_MM) * np.exp(sesgo) - DESPLAZAMIENTO_MM
+    discrepantes = (np.abs(desviacion) > umbral) & (np.abs(valores - esperado) > diferencia_minima)
+    return discrepantes, desviacion
+
+
+def controlar(lon_pts, lat_pts, valores_pluv, radar_en_pluv=None, x_pts=None, y_pts=None,
+              max_precipitacion=MAX_PRECIPITACION_MM, resolucion_grados=RESOLUCION_DUPLICADOS_GRADOS,
+              vecinos=VECINOS_CONTROL, radio_km=RADIO_VECINOS_KM, umbral_z=UMBRAL_Z):
+    """Control de calidad de la red; DataFrame con una fila por pluviómetro.
+
+    Columnas: ``motivo`` ('' si es válido, si no uno de ``MOTIVOS``),
+    ``valido``, ``z_espacial`` y ``desviacion_radar`` (log-cociente menos el
+    de la red). ``x_pts``/``y_pts`` (km) son la posición en la rejilla del
+    radar; sin ellas se usa una proyección equirrectangular local. Sin
+    ``radar_en_pluv`` no se revisan el dominio ni la discrepancia con el radar.
+    """
+    lon_pts = np.asarray(lon_pts, dtype=float)
+    lat_pts = np.asarray(lat_pts, dtype=float)
+    valores = np.asarray(valores_pluv, dtype=float)
+    n = len(valores)
+    if x_pts is None:
+        x_pts, y_pts = coordenadas_km(lon_pts, lat_pts, float(np.mean(lat_pts)) if n else 0.0)
+    x_pts = np.asarray(x_pts, dtype=float)
+    y_pts = np.asarray(y_pts, dtype=float)
+
+    motivo = np.full(n, '', dtype=object)
+    z_espacial = np.full(n, np.nan)
+    desviacion_radar = np.full(n, np.nan)
+
+    fuera = ~np.isfinite(valores) | (valores < 0) | (valores > max_precipitacion)
+    motivo[fuera] = 'fuera_de_rango'
+    if radar_en_pluv is not None:
+        radar_en_pluv = np.asarray(radar_en_pluv, dtype=float)
+        motivo[(motivo == '') & ~np.isfinite(radar_en_pluv)] = 'fuera_del_dominio'
+
+    conflictivos = 0
+    restantes = np.flatnonzero(motivo == '')
+    if len(restantes):
+        duplicados, conflictivos = marcar_duplicados(lon_pts[restantes], lat_pts[restantes], valores[restantes],
+                                                     resolucion_grados)
+        motivo[restantes[duplicados]] = 'duplicado'
+
+    restantes = np.flatnonzero(motivo == '')
+    atipicos, z = atipicos_espaciales(x_pts[restantes], y_pts[restantes], valores[restantes],
+                                      None if radar_en_pluv is None else radar_en_pluv[restantes],
+                                      vecinos=vecinos, radio_km=radio_km, umbral_z=umbral_z)
+    z_espacial[restantes] = z
+    motivo[restantes[atipicos]] = 'espacial'
+
+    if radar_en_pluv is not None:
+        restantes = np.flatnonzero(motivo == '')
+        discrepantes, desviacion = discrepancias_radar(valores[restantes], radar_en_pluv[restantes],
+                                                       umbral_z=umbral_z)
+        desviacion_radar[restantes] = desviacion
+        motivo[restantes[discrepantes]] = 'radar'
+
+    control = pd.DataFrame({'motivo': motivo, 'valido': motivo == '', 'z_espacial': z_espacial,
+                            'desviacion_radar': desviacion_radar})
+    control.attrs['duplicados_conflictivos'] = conflictivos
+    return control
+
+
+def resumen(control):
+    """Recuento por motivo, listo para el registro de la ejecución"""
+    cuentas = control.motivo.value_counts()
+    datos = {'pluviometros': len(control), 'descartados': int((~control.valido).sum())}
+    datos.update({m: int(cuentas.get(m, 0)) for m in MOTIVOS})
+    datos['duplicados_conflictivos'] = int(control.attrs.get('duplicados_conflictivos', 0))
+    return datos
+
+
+def describir(control, lon_pts, lat_pts, valores_pluv, max_lineas=10):
+    """Texto para el log: el recuento y los primeros pluviómetros descartados"""
+    datos = resumen(control)
+    detalle = ", ".join(f"{m}: {datos[m]}" for m in MOTIVOS if datos[m])
+    lineas = [f"Control de calidad: {datos['pluviometros']} pluviómetros, {datos['descartados']} descartados"
+              + (f" ({detalle})" if detalle else "")]
+    if datos['duplicados_conflictivos']:
+        lineas.append(f"  {datos['duplicados_conflictivos']} posiciones repetidas con lecturas distintas "
+                      f"(se conserva la lectura mediana)")
+
+    descartados = np.flatnonzero(~control.valido.values)
+    for i in descartados[:max_lineas]:
+        extra = ''
+        if control.motivo.iat[i] == 'espacial':
+            extra = f" (z = {control.z_espacial.iat[i]:.1f})"
+        elif control.motivo.iat[i] == 'radar':
+            extra = f" (x{np.exp(control.desviacion_radar.iat[i]):.2g} respecto a la red)"
+        lineas.append(f"  ({lon_pts[i]:.4f}, {lat_pts[i]:.4f}) {valores_pluv[i]:.1f} mm: "
+                      f"{control.motivo.iat[i]}{extra}")
+    if len(descartados) > max_lineas:
+        lineas.append(f"  ... y {len(descartados) - max_lineas} más")
+    return "\n".join(lineas)
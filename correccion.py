@@ -0,0 +1,257 @@
+"""Métodos de corrección del radar con pluviómetros (merging).
+
+Todos los métodos reciben los pares pluviómetro/radar ya muestreados y
+devuelven el campo corregido a la resolución completa del radar:
+
+- ``mediana``: factor único, mediana de los cocientes pluviómetro/radar.
+- ``campo_medio``: factor único de sesgo medio, suma(G) / suma(R).
+- ``idw``: sesgo local, inverso de la distancia de los log-cocientes.
+- ``kriging``: sesgo local, kriging ordinario de los log-cocientes.
+- ``condicional``: merging condicional (kriging de pluviómetros más el
+  detalle espacial del radar).
+
+Los métodos locales buscan vecinos con un KD-tree sobre los pluviómetros y
+recorren la rejilla por bloques de filas, así que el coste es casi lineal
+en el número de píxeles y la memoria está acotada.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+METODOS_CORRECCION = ('mediana', 'campo_medio', 'idw', 'kriging', 'condicional')
+
+# Por debajo de este valor (mm) un píxel o pluviómetro se considera seco
+UMBRAL_LLUVIA = 0.1
+
+# Píxeles que se interpolan a la vez (acota la memoria de los sistemas de kriging)
+PIXELES_POR_BLOQUE = 16384
+
+KM_POR_GRADO = 111.32
+
+
+def coordenadas_km(lon, lat, lat_ref):
+    """Proyección equirrectangular local en km, para rejillas lon/lat sin geometría de radar"""
+    x = np.asarray(lon, dtype=float) * KM_POR_GRADO * np.cos(np.radians(lat_ref))
+    y = np.asarray(lat, dtype=float) * KM_POR_GRADO
+    return x, y
+
+
+def coordenadas_radar_km(radar_da, lon_pts, lat_pts):
+    """Ejes x/y (km) de la rejilla y posición x/y de los puntos en el mismo sistema.
+
+    Los radares de ``fusion`` se proyectan con su geometría (acimutal
+    equidistante del sitio); un DataArray con ejes lon/lat 1D usa la
+    aproximación equirrectangular local.
+    """
+    if 'centro' in radar_da.attrs and 'resolucion_km' in radar_da.attrs:
+        from geometria import geometria_de
+
+        geometria = geometria_de(radar_da)
+        x_pts, y_pts = geometria.proyectar(lon_pts, lat_pts)
+        return geometria.x, geometria.y, x_pts, y_pts
+
+    lon = radar_da.lon.values
+    lat = radar_da.lat.values
+    lat_ref = float(np.mean(lat))
+    x_eje, _ = coordenadas_km(lon, lat_ref, lat_ref)
+    _, y_eje = coordenadas_km(0.0, lat, lat_ref)
+    x_pts, y_pts = coordenadas_km(lon_pts, lat_pts, lat_ref)
+    return x_eje, y_eje, x_pts, y_pts
+
+
+def _variograma_exponencial(h, meseta, rango, pepita):
+    return pepita + meseta * (1.0 - np.exp(-3.0 * h / rango))
+
+
+def ajustar_variograma(xy, valores, rango=None):
+    """Parámetros (meseta, rango, pepita) de un variograma exponencial sencillo"""
+    varianza = float(np.var(valores))
+    if varianza == 0:
+        varianza = 1e-6
+    if rango is None:
+        # Sin un ajuste empírico, se toma el triple de la separación típica entre pluviómetros
+        distancias, _ = cKDTree(xy).query(xy, k=2)
+        rango = 3.0 * float(np.median(distancias[:, 1])) if len(xy) > 1 else 10.0
+    return 0.9 * varianza, max(rango, 1e-3), 0.1 * varianza
+
+
+def idw_con_vecinos(valores, distancias, indices, potencia=2.0):
+    """IDW a partir de vecinos ya buscados (``indices`` == len(valores) marca huecos)"""
+    validos = np.isfinite(distancias)
+    valores_ext = np.append(valores, np.nan)
+    pesos = np.where(validos, 1.0 / np.maximum(distancias, 1e-6) ** potencia, 0.0)
+
+    suma_pesos = pesos.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        resultado = np.sum(pesos * np.nan_to_num(valores_ext[indices]), axis=1) / suma_pesos
+
+    # Un destino que coincide con un pluviómetro toma exactamente su valor
+    exactos = validos[:, 0] & (distancias[:, 0] < 1e-6)
+    resultado[exactos] = valores[indices[exactos, 0]]
+    return resultado
+
+
+def kriging_con_vecinos(xy_pluv, valores, distancias, indices, variograma):
+    """Kriging ordinario a partir de vecinos ya buscados, resuelto por lotes"""
+    meseta, rango, pepita = variograma
+    n, k = indices.shape
+    if k == 1:
+        return valores[indices[:, 0]].astype(float)
+
+    # Matriz de variogramas entre los vecinos de cada destino, con la fila del multiplicador
+    vecinos_xy = xy_pluv[indices]
+    separacion = np.linalg.norm(vecinos_xy[:, :, np.newaxis, :] - vecinos_xy[:, np.newaxis, :, :], axis=-1)
+    sistema = np.ones((n, k + 1, k + 1))
+    sistema[:, :k, :k] = _variograma_exponencial(separacion, meseta, rango, pepita)
+    sistema[:, np.arange(k), np.arange(k)] = 0.0
+    sistema[:, k, k] = 0.0
+
+    derecha = np.ones((n, k + 1))
+    derecha[:, :k] = _variograma_exponencial(distancias, meseta, rango, pepita)
+    derecha[:, :k][distancias < 1e-6] = 0.0
+
+    pesos = np.linalg.solve(sistema, derecha[:, :, np.newaxis])[:, :k, 0]
+    return np.sum(pesos * valores[indices], axis=1)
+
+
+def _buscar_vecinos(arbol, xy_destino, k, radio=None):
+    distancias, indices = arbol.query(xy_destino, k=k,
+                                      distance_upper_bound=np.inf if radio is None else radio)
+    return distancias.reshape(len(xy_destino), k), indices.reshape(len(xy_destino), k)
+
+
+def interpolar_idw(xy_pluv, valores, xy_destino, vecinos=8, potencia=2.0, radio=None, arbol=None):
+    """Interpolación por inverso de la distancia con los ``vecinos`` más cercanos.
+
+    Los destinos sin ningún pluviómetro a menos de ``radio`` km devuelven NaN.
+    """
+    arbol = arbol or cKDTree(xy_pluv)
+    distancias, indices = _buscar_vecinos(arbol, xy_destino, min(vecinos, len(valores)), radio)
+    return idw_con_vecinos(valores, distancias, indices, potencia)
+
+
+def interpolar_kriging(xy_pluv, valores, xy_destino, vecinos=12, variograma=None, arbol=None):
+    """Kriging ordinario local con los ``vecinos`` más cercanos a cada destino.
+
+    Los sistemas de todos los destinos del bloque se resuelven a la vez
+    (``np.linalg.solve`` por lotes).
+    """
+    arbol = arbol or cKDTree(xy_pluv)
+    variograma = variograma or ajustar_variograma(xy_pluv, valores)
+    distancias, indices = _buscar_vecinos(arbol, xy_destino, min(vecinos, len(valores)))
+    return kriging_con_vecinos(xy_pluv, valores, distancias, indices, variograma)
+
+
+def _interpolar_rejilla(interpolador, x_eje, y_eje, x_pts, y_pts, valores, **opciones):
+    """Aplica ``interpolador`` a todos los píxeles de la rejilla (ejes en km), por bloques de filas"""
+    xy_pluv = np.column_stack([x_pts, y_pts])
+    arbol = cKDTree(xy_pluv)
+    if interpolador is interpolar_kriging and opciones.get('variograma') is None:
+        # Un único variograma para toda la rejilla
+        opciones['variograma'] = ajustar_variograma(xy_pluv, valores)
+
+    filas_por_bloque = max(1, PIXELES_POR_BLOQUE // len(x_eje))
+    campo = np.empty((len(y_eje), len(x_eje)))
+    for inicio in range(0, len(y_eje), filas_por_bloque):
+        y_filas = y_eje[inicio:inicio + filas_por_bloque]
+        xx, yy = np.meshgrid(x_eje, y_filas)
+        destino = np.column_stack([xx.ravel(), yy.ravel()])
+        campo[inicio:inicio + len(y_filas)] = interpolador(
+            xy_pluv, valores, destino, arbol=arbol, **opciones
+        ).reshape(len(y_filas), len(x_eje))
+    return campo
+
+
+def log_cocientes(valores_pluv, radar_en_pluv, desplazamiento=UMBRAL_LLUVIA):
+    """Log-cocientes pluviómetro/radar en los pares con lluvia en alguno de los dos"""
+    lluvia = (valores_pluv > UMBRAL_LLUVIA) | (radar_en_pluv > UMBRAL_LLUVIA)
+    cocientes = np.log((valores_pluv + desplazamiento) / (radar_en_pluv + desplazamiento))
+    return cocientes, lluvia
+
+
+def aplicar_factor(radar, factor, rellenar_secos=False):
+    """Radar multiplicado por el factor local de los log-cocientes (con el mismo desplazamiento).
+
+    Los píxeles donde el radar no pasa de ``UMBRAL_LLUVIA`` conservan su valor:
+    un pluviómetro con lluvia bajo radar seco da un log-cociente de hasta
+    ln((g + 0.1) / 0.1), y la interpolación lo lleva a los píxeles secos de
+    alrededor. Con ``rellenar_secos`` el factor se aplica también ahí, para
+    añadir cerca de los pluviómetros la lluvia que el radar no vio.
+    """
+    datos = np.maximum((radar + UMBRAL_LLUVIA) * factor - UMBRAL_LLUVIA, 0.0)
+    if rellenar_secos:
+        return datos
+    return np.where(radar > UMBRAL_LLUVIA, datos, radar)
+
+
+def factor_unico(valores_pluv, radar_en_pluv, metodo='mediana'):
+    """Factor de corrección escalar; 1.0 si no hay pares con lluvia en el radar"""
+    lluvia = radar_en_pluv > UMBRAL_LLUVIA
+    if not lluvia.any():
+        return 1.0
+
+    if metodo == 'mediana':
+        return float(np.median(valores_pluv[lluvia] / radar_en_pluv[lluvia]))
+    return float(valores_pluv[lluvia].sum() / radar_en_pluv[lluvia].sum())
+
+
+def corregir(radar_da, lon_pts, lat_pts, valores_pluv, radar_en_pluv, metodo='mediana',
+             vecinos=8, potencia=2.0, radio=None, rellenar_secos=False, log=print):
+    """Devuelve el radar corregido con el método indicado.
+
+    ``lon_pts``, ``lat_pts``, ``valores_pluv`` y ``radar_en_pluv`` describen
+    solo los pares válidos (sin NaN). El resultado conserva coordenadas y
+    atributos del radar y registra el método en ``attrs['metodo_correccion']``.
+    En ``idw`` y ``kriging`` los píxeles secos del radar siguen secos salvo
+    con ``rellenar_secos`` (ver ``aplicar_factor``).
+    """
+    if metodo not in METODOS_CORRECCION:
+        raise ValueError(f"Método de corrección desconocido: {metodo} "
+                         f"(opciones: {', '.join(METODOS_CORRECCION)})")
+
+    if metodo in ('mediana', 'campo_medio'):
+        ratio = factor_unico(valores_pluv, radar_en_pluv, metodo)
+        log(f"\nFactor de corrección: {ratio:.2f}")
+        corregido = radar_da * ratio
+
+    else:
+        x_eje, y_eje, x_pts, y_pts = coordenadas_radar_km(radar_da, lon_pts, lat_pts)
+        radar = np.asarray(radar_da.values, dtype=float)
+
+        if metodo == 'condicional':
+            # Kriging de pluviómetros y de radar en los pluviómetros; el radar aporta el detalle
+            campo_pluv = _interpolar_rejilla(interpolar_kriging, x_eje, y_eje, x_pts, y_pts,
+                                             valores_pluv, vecinos=vecinos)
+            campo_radar = _interpolar_rejilla(interpolar_kriging, x_eje, y_eje, x_pts, y_pts,
+                                              radar_en_pluv, vecinos=vecinos)
+            datos = np.maximum(campo_pluv + (radar - campo_radar), 0.0)
+
+        else:
+            cocientes, lluvia = log_cocientes(valores_pluv, radar_en_pluv)
+            if not lluvia.any():
+                log("\nAdvertencia: ningún par con lluvia; no se aplica corrección")
+                cocientes, lluvia = np.zeros(1), np.ones(1, dtype=bool)
+                x_pts, y_pts = np.array([x_eje.mean()]), np.array([y_eje.mean()])
+            else:
+                cocientes = cocientes[lluvia]
+                x_pts, y_pts = x_pts[lluvia], y_pts[lluvia]
+
+            if metodo == 'idw':
+                campo = _interpolar_rejilla(interpolar_idw, x_eje, y_eje, x_pts, y_pts, cocientes,
+                                            vecinos=vecinos, potencia=potencia, radio=radio)
+            else:
+                campo = _interpolar_rejilla(interpolar_kriging, x_eje, y_eje, x_pts, y_pts, cocientes,
+                                            vecinos=vecinos)
+
+            # Fuera del alcance de los pluviómetros se usa el sesgo medio
+            campo = np.where(np.isfinite(campo), campo, float(np.mean(cocientes)))
+            factor = np.exp(campo)
+            datos = aplicar_factor(radar, factor, rellenar_secos)
+            log(f"\nFactor de corrección local: {factor.min():.2f} a {factor.max():.2f} "
+                f"(mediana {np.median(factor):.2f})")
+
+        # Los píxeles sin dato de radar siguen sin dato
+        datos = np.where(np.isnan(radar), np.nan, datos)
+        corregido = radar_da.copy(data=datos.astype(radar_da.dtype, copy=False))
+
+    corregido.attrs = dict(radar_da.attrs, metodo_correccion=metodo)
+    return corregido
@@ -0,0 +1,406 @@
+"""Núcleo de la fusión radar-pluviómetros, independiente de la interfaz gráfica.
+
+Cada etapa (cargar radar, cargar pluviómetros, fusionar, generar mapa) es una
+función pura que recibe sus parámetros explícitamente, informa el progreso a
+través de la función ``log`` y lanza una excepción si algo falla.
+"""
+import importlib.util
+import os
+from contextlib import contextmanager
+
+import xarray as xr
+import pandas as pd
+import numpy as np
+import geopandas as gpd
+from sklearn.metrics import mean_squared_error
+
+from muestreo import aplicar_muestreo, muestrear_radar
+from geometria import geometria_de, obtener_geometria
+import pluviometros
+import polar
+import correccion
+import control_calidad
+import reflectividad
+import renderizado
+from productos import comprobar_producto, guardar_producto, tiempo_campo
+from instrumentacion import etapa
+from acumulacion import VENTANAS, acumulado_ventana, dimension_tiempo
+
+# Parámetros por defecto del radar de Camagüey (77.849° O)
+CENTRO_LON = -77.849
+CENTRO_LAT = 21.4227
+RESOLUCION_KM = 1.0
+
+
+def _abrir_dataset(ruta_radar, chunks, log):
+    """Abre el NetCDF; con ``chunks`` usa bloques dask si está instalado"""
+    if chunks is not None and importlib.util.find_spec('dask') is None:
+        log("Aviso: dask no está instalado, se usa la carga diferida de xarray sin bloques")
+        chunks = None
+    return xr.open_dataset(ruta_radar, chunks=chunks)
+
+
+def _fecha_escaneo(atributos):
+    """Hora del escaneo a partir de los atributos globales del NetCDF (None si no están)"""
+    try:
+        if 'time_coverage_start' in atributos:
+            # CfRadial
+            return pd.Timestamp(str(atributos['time_coverage_start'])).tz_localize(None)
+        return pd.Timestamp(*(int(atributos[campo]) for campo in ('Year', 'Month', 'Day', 'Hour', 'Minute',
+                                                                   'Second')))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def fecha_archivo(ruta):
+    """Fecha de modificación de ``ruta`` con toda su resolución (al microsegundo).
+
+    Redondear al segundo daría la misma hora a los archivos copiados de una
+    vez, y en un producto acumulable un paso repetido sustituye al anterior.
+    """
+    return pd.Timestamp(os.stat(ruta).st_mtime_ns // 1000, unit='us')
+
+
+def hora_escaneo_radar(ruta_radar):
+    """Hora del escaneo según los atributos del NetCDF (None si no la trae o no se puede leer)"""
+    try:
+        with xr.open_dataset(ruta_radar) as ds:
+            return _fecha_escaneo(ds.attrs)
+    except (OSError, ValueError):
+        # El error de lectura se verá al procesar el escaneo
+        return None
+
+
+def tiempo_archivo_radar(ruta_radar):
+    """Hora del escaneo según los atributos del NetCDF o, si no la trae, la fecha del archivo"""
+    fecha = hora_escaneo_radar(ruta_radar)
+    return fecha if fecha is not None else fecha_archivo(ruta_radar)
+
+
+def tiempo_productos(campo_da, ruta_radar, tiempo=None, log=print):
+    """Instante con el que se guardan los productos: ``tiempo``, el del campo o la fecha del archivo"""
+    if tiempo is not None:
+        return pd.Timestamp(tiempo)
+    try:
+        return tiempo_campo(campo_da)
+    except ValueError:
+        fecha = fecha_archivo(ruta_radar)
+        log(f"Aviso: el radar no tiene hora de escaneo; los productos usan la del archivo ({fecha})")
+        return fecha
+
+
+def _con_geometria(da, geometria, ds, var_precip, log):
+    """Añade a ``da`` (Y, X) los ejes x/y en km y los atributos de georreferencia"""
+    # Lon/lat de cada píxel están en la geometría (``geometria_de(da).lon``) y solo se calculan si hacen falta
+    original = ds[var_precip]
+    da = da.assign_coords(
+        y=(['Y'], geometria.y, {'units': 'km', 'standard_name': 'projection_y_coordinate'}),
+        x=(['X'], geometria.x, {'units': 'km', 'standard_name': 'projection_x_coordinate'})
+    )
+    da.attrs = {
+        # Algunos productos del radar escriben el atributo como 'Units'
+        'units': original.attrs.get('units', original.attrs.get('Units', 'mm')),
+        'description': original.attrs.get('description', ''),
+        'centro': geometria.centro,
+        'resolucion_km': geometria.resolucion_km,
+        'variable_original': var_precip
+    }
+    fecha = _fecha_escaneo(ds.attrs)
+    if fecha is not None:
+        da.attrs['tiempo'] = fecha.isoformat()
+    da.encoding = {}
+
+    lon_min, lon_max, lat_min, lat_max = geometria.extension_lonlat()
+    log("\nCoordenadas generadas (acimutal equidistante del sitio):")
+    log(f"X: {geometria.x[0]:.1f} a {geometria.x[-1]:.1f} km, Y: {geometria.y[0]:.1f} a {geometria.y[-1]:.1f} km")
+    log(f"Longitud: {lon_min:.4f} a {lon_max:.4f}")
+    log(f"Latitud: {lat_min:.4f} a {lat_max:.4f}")
+
+    return da
+
+
+def _radar_desde_polar(ds, centro_lon, centro_lat, resolucion_km, barrido, log):
+    """Regrilla un barrido polar (acimut, distancia) a la rejilla cartesiana del sitio"""
+    datos = polar.leer_barrido(ds, barrido)
+    log(f"Barrido polar detectado: {datos['variable']} ({len(datos['acimuts'])} rayos × "
+        f"{len(datos['distancias_km'])} celdas, elevación {datos['elevacion']:.1f}°)")
+
+    # En los volúmenes polares el sitio del propio archivo manda sobre los valores por defecto
+    if 'longitude' in ds.variables and 'latitude' in ds.variables:
+        centro_lon = float(np.asarray(ds['longitude'].values).ravel()[0])
+        centro_lat = float(np.asarray(ds['latitude'].values).ravel()[0])
+        log(f"Sitio del radar según el archivo: {centro_lon}° lon, {centro_lat}° lat")
+
+    forma = polar.forma_cartesiana(datos['distancias_km'], datos['elevacion'], resolucion_km)
+    geometria = obtener_geometria(centro_lon, centro_lat, resolucion_km, forma)
+    campo = polar.barrido_a_rejilla(datos, geometria)
+
+    da = xr.DataArray(campo.astype(np.float32), dims=('Y', 'X'))
+    return _con_geometria(da, geometria, ds, datos['variable'], log)
+
+
+def _radar_desde_dataset(ds, centro_lon, centro_lat, resolucion_km, log, barrido=0):
+    """Construye el DataArray georreferenciado sin leer todavía los datos.
+
+    Los barridos polares se regrillan (y por tanto se leen) al momento;
+    ``barrido`` elige cuál en los volúmenes con varias elevaciones.
+    """
+    log("\nMetadatos del radar:")
+    log(f"Ubicación: {centro_lon}° lon, {centro_lat}° lat")
+    log(f"Dimensiones: {ds.dims}")
+
+    if polar.es_polar(ds):
+        return _radar_desde_polar(ds, centro_lon, centro_lat, resolucion_km, barrido, log)
+
+    # Detectar automáticamente la variable de precipitación
+    var_precip = None
+    for var in ds.data_vars:
+        dims = ds[var].dims
+        # Buscamos variables 2D (Y, X) o cubos (tiempo, Y, X)
+        if len(dims) == 2 or (len(dims) == 3 and 'Y' in dims and 'X' in dims):
+            var_precip = var
+            break
+
+    if var_precip is None:
+        raise ValueError("No se encontró una variable 2D (o tiempo, Y, X) de precipitación en el archivo NetCDF")
+
+    log(f"Variable de precipitación detectada: {var_precip}")
+
+    # Rejilla acimutal equidistante del sitio (cacheada por geometría del radar)
+    geometria = obtener_geometria(centro_lon, centro_lat, resolucion_km, (ds.sizes['Y'], ds.sizes['X']))
+
+    # DataArray con los ejes x/y en km; los datos siguen en el archivo (o en bloques dask)
+    return _con_geometria(ds[var_precip].transpose(..., 'Y', 'X'), geometria, ds, var_precip, log)
+
+
+def cargar_datos_radar(ruta_radar, centro_lon=CENTRO_LON, centro_lat=CENTRO_LAT,
+                       resolucion_km=RESOLUCION_KM, log=print):
+    """Carga el NetCDF del radar en memoria como DataArray con coordenadas lon/lat.
+
+    El archivo se cierra antes de devolver el resultado.
+    """
+    log("\n[1/3] Cargando radar...")
+
+    with xr.open_dataset(ruta_radar) as ds:
+        return _radar_desde_dataset(ds, centro_lon, centro_lat, resolucion_km, log).load()
+
+
+@contextmanager
+def abrir_radar(ruta_radar, centro_lon=CENTRO_LON, centro_lat=CENTRO_LAT,
+                resolucion_km=RESOLUCION_KM, chunks='auto', log=print):
+    """Abre el radar en modo diferido (por bloques) y cierra el archivo al salir.
+
+    Los datos no se leen hasta que una etapa los necesita (``.values``,
+    ``.load()``), así que el DataArray solo es válido dentro del bloque ``with``.
+    """
+    log("\n[1/3] Abriendo radar (carga diferida)...")
+
+    ds = _abrir_dataset(ruta_radar, chunks, log)
+    try:
+        yield _radar_desde_dataset(ds, centro_lon, centro_lat, resolucion_km, log)
+    finally:
+        ds.close()
+
+
+def cargar_datos_pluviometros(ruta_pluviometros, log=print):
+    """Carga la tabla de pluviómetros (Excel, CSV o Parquet) como GeoDataFrame en EPSG:4326"""
+    log("\n[2/3] Cargando pluviómetros...")
+
+    df = pluviometros.cargar_tabla(ruta_pluviometros, log=log)
+
+    # Convertir a GeoDataFrame
+    gdf = gpd.GeoDataFrame(
+        df,
+        geometry=gpd.points_from_xy(df.longitud, df.latitud),
+        crs="EPSG:4326"
+    )
+
+    log(f"\nDatos pluviómetros cargados: {len(gdf)} estaciones")
+    return gdf
+
+
+def muestrear_pluviometros(radar_da, pluviometros_gdf, metodo='bilineal'):
+    """Valor del radar en cada pluviómetro, reutilizando el plan cacheado de la geometría"""
+    lon_pts = pluviometros_gdf.longitud.values.astype(float)
+    lat_pts = pluviometros_gdf.latitud.values.astype(float)
+
+    if 'centro' not in radar_da.attrs or 'resolucion_km' not in radar_da.attrs:
+        return muestrear_radar(radar_da, lon_pts, lat_pts, metodo=metodo)
+
+    plan = geometria_de(radar_da).plan_muestreo(lon_pts, lat_pts, metodo)
+    return aplicar_muestreo(plan, radar_da.values)
+
+
+def preparar_campo(radar_da, ventana=None, fin_ventana=None, zr=None, en_sitio=False, log=print):
+    """Devuelve el campo 2D a fusionar: el propio radar o su acumulado en la ventana.
+
+    Los pluviómetros reportan totales acumulados, así que un cubo (tiempo, Y, X)
+    se compara con el acumulado de la misma ventana (por ejemplo '24h').
+    Los radares en reflectividad (dBZ) se convierten con la relación ``zr``
+    (``reflectividad.RelacionZR``, Marshall-Palmer por defecto): los cubos
+    paso a paso dentro de la acumulación y los campos 2D a intensidad (mm/h).
+    ``radar_da`` no se modifica salvo con ``en_sitio=True``: entonces un campo
+    2D en dBZ se convierte sobre su propio array y queda consumido (sus datos
+    pasan a mm/h aunque sus atributos sigan diciendo dBZ). Úsese solo con un
+    radar recién cargado que nadie más vaya a leer.
+    """
+    dbz = reflectividad.es_reflectividad(radar_da)
+    if dbz:
+        zr = zr or reflectividad.RelacionZR()
+        log(f"Radar en reflectividad (dBZ): conversión a lluvia con {zr!r}")
+
+    if dimension_tiempo(radar_da) is None:
+        if dbz:
+            return reflectividad.convertir_campo(radar_da, zr, en_sitio=en_sitio)
+        return radar_da
+
+    if ventana is None:
+        raise ValueError("El radar tiene dimensión temporal: indique la ventana de acumulación "
+                         f"({', '.join(VENTANAS)})")
+
+    tipo = 'reflectividad' if dbz else 'intensidad'
+    return acumulado_ventana(radar_da, fin_ventana, ventana, tipo=tipo, zr=zr, log=log)
+
+
+def fusionar_datos(radar_da, pluviometros_gdf, metodo_muestreo='bilineal', metodo='mediana', log=print,
+                   registro=None, control=True):
+    """Corrige el campo de radar con los pluviómetros (ver ``correccion.METODOS_CORRECCION``).
+
+    Con ``control=True`` los pluviómetros pasan antes el control de calidad
+    (``control_calidad``) y los descartados no entran en la corrección. Con un
+    ``registro`` (``instrumentacion.RegistroEjecucion``) se miden por separado
+    el muestreo en los pluviómetros, el control y la corrección; el recuento
+    del control queda en su etapa.
+    """
+    log("\n[3/3] Fusionando datos...")
+
+    if radar_da.ndim != 2:
+        raise ValueError("La fusión necesita un campo 2D; acumule primero el cubo de radar")
+
+    valores_pluv = pluviometros_gdf.precipitacion.values.astype(float)
+    lon_pts = pluviometros_gdf.longitud.values.astype(float)
+    lat_pts = pluviometros_gdf.latitud.values.astype(float)
+
+    # Muestrear el radar en los pluviómetros directamente sobre la rejilla regular
+    with etapa(registro, 'fusionar/muestreo') as medida:
+        radar_en_pluv = medida['resultado'] = muestrear_pluviometros(radar_da, pluviometros_gdf, metodo_muestreo)
+
+    # Filtrar valores válidos
+    mask = (~np.isnan(radar_en_pluv)) & (~np.isnan(valores_pluv))
+
+    if control:
+        with etapa(registro, 'fusionar/control_calidad') as medida:
+            _, _, x_pts, y_pts = correccion.coordenadas_radar_km(radar_da, lon_pts, lat_pts)
+            revision = medida['resultado'] = control_calidad.controlar(lon_pts, lat_pts, valores_pluv,
+                                                                      radar_en_pluv, x_pts, y_pts)
+            medida['control_calidad'] = control_calidad.resumen(revision)
+        log(control_calidad.describir(revision, lon_pts, lat_pts, valores_pluv))
+        mask &= revision.valido.values
+
+    valores_pluv = valores_pluv[mask]
+    radar_en_pluv = radar_en_pluv[mask]
+
+    if len(valores_pluv) == 0:
+        log("\nAdvertencia: No hay puntos válidos para comparación")
+        return radar_da
+
+    log(f"Método de corrección: {metodo}")
+    with etapa(registro, 'fusionar/correccion') as medida:
+        corregido = medida['resultado'] = correccion.corregir(
+            radar_da,
+            lon_pts[mask],
+            lat_pts[mask],
+            valores_pluv,
+            radar_en_pluv,
+            metodo=metodo,
+            log=log
+        )
+
+    corregido_en_pluv = muestrear_pluviometros(corregido, pluviometros_gdf, metodo_muestreo)[mask]
+    log(f"RMSE antes: {np.sqrt(mean_squared_error(valores_pluv, radar_en_pluv)):.2f}")
+    log(f"RMSE después: {np.sqrt(mean_squared_error(valores_pluv, corregido_en_pluv)):.2f}")
+
+    return corregido
+
+
+def generar_mapa(radar_da, pluviometros_gdf, ruta_salida, calidad='final', log=print):
+    """Dibuja el campo corregido con los pluviómetros y lo guarda como PNG.
+
+    El mapa base se construye una vez por rejilla y calidad (ver
+    ``renderizado``); las siguientes llamadas solo repintan los datos.
+    """
+    log("\nGenerando mapa...")
+
+    motor = renderizado.obtener_motor(radar_da, calidad=calidad, log=log)
+    motor.guardar(
+        radar_da.values,
+        ruta_salida,
+        pluviometros_gdf.longitud.values,
+        pluviometros_gdf.latitud.values
+    )
+
+    log(f"\nMapa guardado en: {ruta_salida}")
+    return ruta_salida
+
+
+def ejecutar_fusion(ruta_radar, ruta_pluviometros, ruta_salida, centro_lon=CENTRO_LON,
+                    centro_lat=CENTRO_LAT, resolucion_km=RESOLUCION_KM, perezoso=False,
+                    ventana=None, fin_ventana=None, metodo='mediana', calidad='final', log=print,
+                    registro=None, rutas_producto=None, zr=None, control=True, tiempo=None):
+    """Ejecuta el proceso completo cargar → fusionar → mapa y devuelve el campo corregido.
+
+    Con ``perezoso=True`` el radar se abre por bloques y el archivo se cierra
+    al terminar; el campo devuelto ya está cargado en memoria. Si se indica
+    ``ventana`` el radar también se abre en diferido, porque los cubos
+    (tiempo, Y, X) se acumulan paso a paso antes de fusionar. Con un
+    ``registro`` se mide cada etapa (ver ``instrumentacion``). El campo
+    corregido se guarda además en cada una de ``rutas_producto`` (NetCDF,
+    Zarr o GeoTIFF, ver ``productos``). Los radares en dBZ se convierten a
+    lluvia con la relación Z-R ``zr`` (ver ``reflectividad``). Con
+    ``control=False`` se omite el control de calidad de los pluviómetros.
+    Los productos llevan el instante ``tiempo`` o, si no se indica, el del
+    campo (ver ``tiempo_productos``).
+    """
+    log("=== INICIANDO PROCESO DE FUSIÓN ===")
+
+    if perezoso or ventana is not None:
+        with abrir_radar(ruta_radar, centro_lon, centro_lat, resolucion_km, log=log) as radar:
+            # En diferido la lectura real ocurre al acumular o preparar el campo
+            with etapa(registro, 'cargar_radar') as medida:
+                radar = medida['resultado'] = preparar_campo(radar, ventana, fin_ventana, zr=zr, log=log)
+            radar_corregido = _fusionar_y_dibujar(radar, ruta_pluviometros, ruta_salida, metodo,
+                                                  calidad, log, registro, rutas_producto, control,
+                                                  ruta_radar, tiempo)
+            radar_corregido = radar_corregido.load()
+    else:
+        with etapa(registro, 'cargar_radar') as medida:
+            radar = cargar_datos_radar(ruta_radar, centro_lon, centro_lat, resolucion_km, log=log)
+            # Recién cargado y solo lo usa esta función: la conversión Z-R reutiliza su array
+            radar = medida['resultado'] = preparar_campo(radar, zr=zr, en_sitio=True, log=log)
+        radar_corregido = _fusionar_y_dibujar(radar, ruta_pluviometros, ruta_salida, metodo,
+                                              calidad, log, registro, rutas_producto, control,
+                                              ruta_radar, tiempo)
+
+    log("\nProceso completado exitosamente!")
+    return radar_corregido
+
+
+def _fusionar_y_dibujar(radar, ruta_pluviometros, ruta_salida, metodo, calidad, log, registro,
+                        rutas_producto=None, control=True, ruta_radar=None, tiempo=None):
+    if rutas_producto:
+        # Todos los productos deben aceptar el paso antes de fusionar, para no dejar unos escritos y otros no
+        tiempo = tiempo_productos(radar, ruta_radar, tiempo, log)
+        for ruta in rutas_producto:
+            comprobar_producto(ruta, tiempo)
+    with etapa(registro, 'cargar_pluviometros') as medida:
+        pluv = medida['resultado'] = cargar_datos_pluviometros(ruta_pluviometros, log=log)
+    with etapa(registro, 'fusionar') as medida:
+        radar_corregido = medida['resultado'] = fusionar_datos(radar, pluv, metodo=metodo, log=log,
+                                                              registro=registro, control=control)
+    with etapa(registro, 'generar_mapa'):
+        generar_mapa(radar_corregido, pluv, ruta_salida, calidad=calidad, log=log)
+    if rutas_producto:
+        with etapa(registro, 'guardar_productos'):
+            for ruta in rutas_producto:
+                guardar_producto(radar_corregido, ruta, tiempo, log=log)
+    return radar_corregido
@@ -0,0 +1,131 @@
+"""Fusión radar-pluviómetros desde la línea de comandos (sin interfaz gráfica).
+
+Ejemplo:
+    python fusion_cli.py lluvia8junio.nc lluvia.xls -o precipitacion_corregida.png
+"""
+import argparse
+import os
+import sys
+from contextlib import nullcontext
+
+import pandas as pd
+
+import correccion
+import fusion
+import geometria
+import instrumentacion
+import pluviometros
+import productos
+import reflectividad
+import renderizado
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(
+        description="Fusión de datos de precipitación radar-pluviómetros"
+    )
+    parser.add_argument("radar", help="Archivo de radar (NetCDF)")
+    parser.add_argument("pluviometros", help="Archivo de pluviómetros (Excel, CSV o Parquet)")
+    parser.add_argument("-o", "--salida", default="precipitacion_corregida.png",
+                        help="Archivo de salida (PNG)")
+    parser.add_argument("--producto", action="append", default=None,
+                        help="Guardar también el campo corregido en este archivo (.nc, .zarr, .tif o .arch); "
+                             "NetCDF, Zarr y .arch existentes se amplían con el nuevo paso de tiempo. Repetible")
+    parser.add_argument("--tiempo", default=None,
+                        help="Instante de los productos (por defecto, la hora del escaneo o, si el radar no "
+                             "la trae, la fecha del archivo)")
+    parser.add_argument("--centro-lon", type=float, default=fusion.CENTRO_LON,
+                        help="Longitud del centro del radar")
+    parser.add_argument("--centro-lat", type=float, default=fusion.CENTRO_LAT,
+                        help="Latitud del centro del radar")
+    parser.add_argument("--resolucion-km", type=float, default=fusion.RESOLUCION_KM,
+                        help="Resolución de la rejilla del radar (km)")
+    parser.add_argument("--perezoso", action="store_true",
+                        help="Abrir el radar por bloques sin cargarlo entero en memoria")
+    parser.add_argument("--ventana", default=None,
+                        help="Ventana de acumulación para radares con dimensión temporal (1h, 3h, 6h, 24h)")
+    parser.add_argument("--fin", default=None,
+                        help="Fin de la ventana de acumulación (por defecto, el último paso del archivo)")
+    parser.add_argument("--metodo", default="mediana", choices=correccion.METODOS_CORRECCION,
+                        help="Método de corrección del radar con los pluviómetros")
+    parser.add_argument("--sin-control", action="store_true",
+                        help="No pasar el control de calidad a los pluviómetros antes de fusionar")
+    parser.add_argument("--calidad", default="final", choices=tuple(renderizado.CALIDADES),
+                        help="Calidad del mapa: borrador (vista previa rápida) o final (300 dpi)")
+    reflectividad.agregar_argumentos(parser)
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directorio de la caché de geometría del radar y de tablas de pluviómetros")
+    parser.add_argument("--registro", default=None,
+                        help="Añadir las medidas por etapa a este registro (.csv o .jsonl)")
+    parser.add_argument("--perfil", default=None, choices=("cprofile", "tracemalloc"),
+                        help="Volcar además un perfil cProfile o de memoria (tracemalloc)")
+    parser.add_argument("-q", "--silencioso", action="store_true",
+                        help="No mostrar mensajes de progreso")
+    return parser
+
+
+def main(argv=None):
+    parser = crear_parser()
+    args = parser.parse_args(argv)
+    for ruta in args.producto or []:
+        try:
+            productos.formato_de(ruta)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.tiempo is not None:
+        try:
+            args.tiempo = pd.Timestamp(args.tiempo)
+        except ValueError:
+            parser.error(f"Tiempo no válido: {args.tiempo}")
+    log = (lambda mensaje: None) if args.silencioso else print
+
+    if args.cache_dir:
+        geometria.configurar_cache(directorio=args.cache_dir)
+        pluviometros.configurar_cache(args.cache_dir)
+
+    registro = None
+    if args.registro or args.perfil:
+        directorio = os.path.dirname(os.path.abspath(args.registro or args.salida))
+        registro = instrumentacion.RegistroEjecucion(
+            perfil=args.perfil, directorio_perfil=directorio,
+            contexto={'radar': args.radar, 'pluviometros': args.pluviometros, 'metodo': args.metodo}
+        )
+
+    try:
+        zr = reflectividad.desde_argumentos(args)
+        with registro.perfilando() if registro else nullcontext():
+            fusion.ejecutar_fusion(
+                args.radar,
+                args.pluviometros,
+                args.salida,
+                centro_lon=args.centro_lon,
+                centro_lat=args.centro_lat,
+                resolucion_km=args.resolucion_km,
+                perezoso=args.perezoso,
+                ventana=args.ventana,
+                fin_ventana=args.fin,
+                metodo=args.metodo,
+                calidad=args.calidad,
+                log=log,
+                registro=registro,
+                rutas_producto=args.producto,
+                zr=zr,
+                control=not args.sin_control,
+                tiempo=args.tiempo
+            )
+    except Exception as e:
+        print(f"ERROR: {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        if registro is not None:
+            log("\n" + registro.tabla())
+            if args.registro:
+                registro.guardar(args.registro)
+            for archivo in registro.archivos_perfil:
+                log(f"Perfil guardado en: {archivo}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""Caché de la geometría de la rejilla del radar.
+
+La rejilla del radar es regular en su proyección nativa: acimutal
+equidistante centrada en el sitio, con ejes ``x``/``y`` en km. Las
+transformaciones lon/lat <-> x/y se hacen con pyproj, vectorizadas y con un
+transformador por sitio, así que situar todos los pluviómetros de todos los
+escaneos en la rejilla es una sola llamada.
+
+El radar y su rejilla no cambian entre escaneos, así que las coordenadas, los
+planes de muestreo de los pluviómetros y las máscaras de shapefiles se
+calculan una sola vez por geometría (centro, resolución, forma). La caché
+guarda en memoria las geometrías usadas más recientemente (LRU) y, si se le
+indica un directorio, las persiste en disco para que las siguientes
+ejecuciones no repitan estos cálculos.
+
+En disco cada geometría es un directorio con un archivo por plan o máscara:
+una entrada nueva no reescribe las demás, y los procesos que comparten el
+directorio (``lote``, ``vigilancia``) no se pisan entre sí. En memoria solo
+se conservan los ``MAX_PLANES`` planes usados más recientemente, porque cada
+tabla de pluviómetros distinta tiene el suyo.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+
+import numpy as np
+
+from muestreo import PlanMuestreo, preparar_muestreo
+
+# Cambia cuando cambia el significado de lo guardado en disco
+# (2: rejilla acimutal equidistante, 3: un archivo por entrada)
+VERSION_CACHE = 3
+
+# Planes de muestreo en memoria por geometría (LRU)
+MAX_PLANES = 32
+
+
+def proyeccion_sitio(centro_lon, centro_lat):
+    """Cadena PROJ de la proyección acimutal equidistante del radar (km)"""
+    return f"+proj=aeqd +lat_0={float(centro_lat)} +lon_0={float(centro_lon)} +datum=WGS84 +units=km +no_defs"
+
+
+@lru_cache(maxsize=16)
+def transformadores(centro_lon, centro_lat):
+    """Transformadores (directo, inverso) lon/lat <-> x/y en km de un sitio"""
+    from pyproj import Transformer
+
+    proyeccion = proyeccion_sitio(centro_lon, centro_lat)
+    return (Transformer.from_crs("EPSG:4326", proyeccion, always_xy=True),
+            Transformer.from_crs(proyeccion, "EPSG:4326", always_xy=True))
+
+
+def ejes_rejilla(resolucion_km, forma):
+    """Ejes x/y (km) de los centros de píxel, con el radar en el centro de la rejilla"""
+    ny, nx = forma
+    x = (np.arange(nx) - (nx - 1) / 2) * resolucion_km
+    y = (np.arange(ny) - (ny - 1) / 2) * resolucion_km
+    return x, y
+
+
+def coordenadas_rejilla(centro_lon, centro_lat, resolucion_km, forma):
+    """Lon/lat (Y, X) de los centros de píxel de la rejilla del radar"""
+    x, y = ejes_rejilla(resolucion_km, forma)
+    xx, yy = np.meshgrid(x, y)
+    return transformadores(float(centro_lon), float(centro_lat))[1].transform(xx, yy)
+
+
+def huella_puntos(lon_pts, lat_pts):
+    """Identificador estable de un conjunto de puntos (para indexar sus tablas)"""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(lon_pts, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lat_pts, dtype=np.float64).tobytes())
+    return h.hexdigest()[:16]
+
+
+class GeometriaRadar:
+    """Coordenadas y tablas precalculadas de una rejilla de radar concreta"""
+
+    def __init__(self, centro_lon, centro_lat, resolucion_km, forma, ruta=None, max_planes=MAX_PLANES):
+        self.clave = (float(centro_lon), float(centro_lat), float(resolucion_km), tuple(int(n) for n in forma))
+        self.x, self.y = ejes_rejilla(resolucion_km, forma)
+        self.planes = OrderedDict()
+        self.max_planes = max_planes
+        self.mascaras = {}
+        # Directorio de la geometría en disco (None: solo en memoria)
+        self.ruta = ruta
+
+    @property
+    def centro(self):
+        return self.clave[:2]
+
+    @property
+    def resolucion_km(self):
+        return self.clave[2]
+
+    @property
+    def forma(self):
+        return self.clave[3]
+
+    @property
+    def proyeccion(self):
+        return proyeccion_sitio(*self.centro)
+
+    @cached_property
+    def _lonlat(self):
+        # Solo se calcula si alguien necesita lon/lat de cada píxel (máscaras, productos)
+        return coordenadas_rejilla(*self.clave)
+
+    @property
+    def lon(self):
+        """Longitud (Y, X) del centro de cada píxel"""
+        return self._lonlat[0]
+
+    @property
+    def lat(self):
+        """Latitud (Y, X) del centro de cada píxel"""
+        return self._lonlat[1]
+
+    def proyectar(self, lon_pts, lat_pts):
+        """Coordenadas x/y (km) en la rejilla del radar de puntos lon/lat"""
+        x, y = transformadores(*self.centro)[0].transform(np.asarray(lon_pts, dtype=float),
+                                                         np.asarray(lat_pts, dtype=float))
+        return np.asarray(x), np.asarray(y)
+
+    def desproyectar(self, x_pts, y_pts):
+        """Lon/lat de puntos x/y (km) de la rejilla del radar"""
+        lon, lat = transformadores(*self.centro)[1].transform(np.asarray(x_pts, dtype=float),
+                                                             np.asarray(y_pts, dtype=float))
+        return np.asarray(lon), np.asarray(lat)
+
+    def proyectar_geometria(self, geometria):
+        """Geometría de shapely en lon/lat pasada a x/y (km) de la rejilla"""
+        import shapely
+
+        return shapely.transform(geometria, lambda xy: np.column_stack(self.proyectar(xy[:, 0], xy[:, 1])))
+
+    def extension_lonlat(self, margen_km=0.0):
+        """Caja [lon_min, lon_max, lat_min, lat_max] que contiene la rejilla y ``margen_km`` alrededor"""
+        # El borde de la rejilla basta: la proyección no tiene extremos en el interior
+        medio = self.resolucion_km / 2 + margen_km
+        x0, x1 = self.x[0] - medio, self.x[-1] + medio
+        y0, y1 = self.y[0] - medio, self.y[-1] + medio
+        bx_fila = np.linspace(x0, x1, len(self.x) + 1)
+        by_columna = np.linspace(y0, y1, len(self.y) + 1)
+        bx = np.concatenate([bx_fila, bx_fila, np.full(len(by_columna), x0), np.full(len(by_columna), x1)])
+        by = np.concatenate([np.full(len(bx_fila), y0), np.full(len(bx_fila), y1), by_columna, by_columna])
+        lon, lat = self.desproyectar(bx, by)
+        return [float(lon.min()), float(lon.max()), float(lat.min()), float(lat.max())]
+
+    def plan_muestreo(self, lon_pts, lat_pts, metodo='bilineal'):
+        """Plan de muestreo de unos pluviómetros; se calcula una sola vez"""
+        clave = (metodo, huella_puntos(lon_pts, lat_pts))
+        if clave in self.planes:
+            self.planes.move_to_end(clave)
+            return self.planes[clave]
+
+        nombre = f"plan_{metodo}_{clave[1]}"
+        campos = self._leer(nombre)
+        if campos is not None:
+            plan = PlanMuestreo(**campos)
+        else:
+            x_pts, y_pts = self.proyectar(lon_pts, lat_pts)
+            plan = preparar_muestreo(self.x, self.y, x_pts, y_pts, metodo)
+            self._escribir(nombre, plan._asdict())
+
+        self.planes[clave] = plan
+        while len(self.planes) > self.max_planes:
+            self.planes.popitem(last=False)
+        return plan
+
+    def mascara(self, nombre, construir):
+        """Máscara (Y, X) asociada a ``nombre``; ``construir(geometria)`` la calcula si falta"""
+        return self.arrays(f"mascara|{nombre}", lambda g: {'mascara': construir(g)})['mascara']
+
+    def arrays(self, nombre, construir):
+        """Grupo de arrays asociado a ``nombre``; ``construir(geometria)`` devuelve un dict si falta"""
+        if nombre not in self.mascaras:
+            archivo = 'arrays_' + hashlib.sha1(nombre.encode()).hexdigest()[:16]
+            grupo = self._leer(archivo)
+            if grupo is None:
+                grupo = {campo: np.asarray(valor) for campo, valor in construir(self).items()}
+                self._escribir(archivo, grupo)
+            self.mascaras[nombre] = grupo
+        return self.mascaras[nombre]
+
+    def _archivo(self, nombre):
+        return None if self.ruta is None else os.path.join(self.ruta, f"{nombre}.npz")
+
+    def _leer(self, nombre):
+        """Arrays guardados de una entrada, o None si no está en disco"""
+        archivo = self._archivo(nombre)
+        if archivo is None or not os.path.exists(archivo):
+            return None
+        with np.load(archivo) as datos:
+            return {campo: datos[campo] for campo in datos.files}
+
+    def _escribir(self, nombre, arrays):
+        """Persiste una entrada en su propio archivo (si la caché tiene directorio)"""
+        archivo = self._archivo(nombre)
+        if archivo is None:
+            return
+
+        os.makedirs(self.ruta, exist_ok=True)
+        # Escritura atómica: ni archivos a medias si el proceso muere ni mezclas entre procesos
+        temporal = f"{archivo}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(temporal, **arrays)
+        os.replace(temporal, archivo)
+
+
+def mascara_poligonos(geometria, poligonos):
+    """Máscara booleana (Y, X) de los píxeles cuyo centro cae dentro de los polígonos"""
+    import shapely
+
+    xx, yy = np.meshgrid(geometria.x, geometria.y)
+    union = geometria.proyectar_geometria(shapely.union_all(np.asarray(poligonos)))
+    return shapely.contains_xy(union, xx, yy)
+
+
+def mascara_shapefile(geometria, ruta_shp):
+    """Máscara de un shapefile, cacheada por ruta y fecha de modificación"""
+    import geopandas as gpd
+
+    ruta_shp = os.path.abspath(ruta_shp)
+    nombre = f"{ruta_shp}@{os.path.getmtime(ruta_shp):.0f}"
+    return geometria.mascara(
+        nombre,
+        lambda g: mascara_poligonos(g, gpd.read_file(ruta_shp).to_crs("EPSG:4326").geometry)
+    )
+
+
+class CacheGeometria:
+    """Caché LRU de geometrías, con persistencia opcional en ``directorio``"""
+
+    def __init__(self, max_entradas=8, directorio=None):
+        self.max_entradas = max_entradas
+        self.directorio = directorio
+        self._geometrias = OrderedDict()
+
+    def _ruta(self, clave):
+        if self.directorio is None:
+            return None
+        nombre = hashlib.sha1(repr((VERSION_CACHE, clave)).encode()).hexdigest()[:16]
+        return os.path.join(self.directorio, f"geometria_{nombre}")
+
+    def obtener(self, centro_lon, centro_lat, resolucion_km, forma):
+        """Devuelve la geometría pedida, creándola (o leyéndola de disco) si no está"""
+        clave = (float(centro_lon), float(centro_lat), float(resolucion_km), tuple(int(n) for n in forma))
+
+        if clave in self._geometrias:
+            self._geometrias.move_to_end(clave)
+            return self._geometrias[clave]
+
+        geometria = GeometriaRadar(centro_lon, centro_lat, resolucion_km, forma, ruta=self._ruta(clave))
+
+        self._geometrias[clave] = geometria
+        while len(self._geometrias) > self.max_entradas:
+            self._geometrias.popitem(last=False)
+        return geometria
+
+    def limpiar(self):
+        self._geometrias.clear()
+
+
+# Caché compartida por el proceso
+CACHE = CacheGeometria()
+
+
+def configurar_cache(max_entradas=8, directorio=None):
+    """Reemplaza la caché compartida (por ejemplo para activar la persistencia en disco)"""
+    global CACHE
+    CACHE = CacheGeometria(max_entradas, directorio)
+    return CACHE
+
+
+def obtener_geometria(centro_lon, centro_lat, resolucion_km, forma):
+    """Geometría de la rejilla desde la caché compartida"""
+    return CACHE.obtener(centro_lon, centro_lat, resolucion_km, forma)
+
+
+def geometria_de(radar_da):
+    """Geometría de un DataArray creado por ``fusion.cargar_datos_radar`` (o derivado de él)"""
+    centro_lon, centro_lat = radar_da.attrs['centro']
+    return obtener_geometria(centro_lon, centro_lat, radar_da.attrs['resolucion_km'], radar_da.shape[-2:])
@@ -0,0 +1,499 @@
+"""Fusión incremental: la corrección se actualiza con los pluviómetros que llegan tarde.
+
+Los pluviómetros siguen reportando después de procesar un escaneo y
+repetir cargar → fusionar → mapa por cada dato tardío repite casi todo el
+trabajo. ``FusionIncremental`` conserva el estado intermedio de la fusión:
+
+- el radar muestreado en cada pluviómetro (solo se muestrean los nuevos),
+- los pares que participan en la corrección y sus residuos (log-cocientes,
+  o pluviómetro y radar para el merging condicional), promediados por
+  posición para que los pluviómetros coincidentes no dejen la elección de
+  vecinos al orden de la tabla,
+- el variograma ajustado (kriging), que queda fijo entre actualizaciones,
+- para cada píxel, la distancia a su vecino más lejano de los que usa.
+
+Como en ``fusion.fusionar_datos``, los pluviómetros pasan el control de
+calidad (``control_calidad``) salvo con ``control=False``; se repite con cada
+cambio de la tabla, porque un pluviómetro nuevo cambia a sus vecinos.
+
+Un píxel solo cambia si alguna posición que entra, sale o cambia de valor
+está a menos de esa distancia, así que las altas, bajas y ediciones
+recalculan únicamente esos píxeles (con los mismos interpoladores de
+``correccion``) y marcan sus teselas como sucias; el mapa repinta solo esas
+teselas sobre el cuadro anterior (``renderizado.MotorMapa.cuadro``).
+
+Se recalcula todo cuando el número de vecinos efectivo cambia (menos
+pluviómetros que ``vecinos``), cuando no queda ningún par con lluvia y,
+para los métodos de factor único, cada vez que el factor cambia. El
+resultado no depende del orden de las actualizaciones y, con kriging,
+coincide con ``correccion.corregir`` salvo por el variograma, que solo se
+reajusta con ``recalcular()``, y por los pluviómetros coincidentes.
+
+Ejemplo:
+    python incremental.py radar.nc lluvia.xls --metodo idw -o mapa.png --vigilar
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import control_calidad
+import correccion
+import fusion
+import pluviometros
+import reflectividad
+import renderizado
+from correccion import PIXELES_POR_BLOQUE
+from geometria import geometria_de
+from muestreo import aplicar_muestreo, muestrear_radar, preparar_muestreo
+from productos import guardar_producto
+
+# Lado de las teselas (píxeles) en que se sigue qué partes del mapa hay que repintar
+TAM_TESELA = 64
+
+COLUMNAS = ['longitud', 'latitud', 'precipitacion']
+
+
+class FusionIncremental:
+    """Estado de la fusión de un campo de radar que admite altas, bajas y ediciones de pluviómetros"""
+
+    def __init__(self, radar_da, pluviometros_gdf, metodo='idw', metodo_muestreo='bilineal', vecinos=8,
+                 potencia=2.0, radio=None, tam_tesela=TAM_TESELA, control=True, rellenar_secos=False, log=print):
+        if metodo not in correccion.METODOS_CORRECCION:
+            raise ValueError(f"Método de corrección desconocido: {metodo} "
+                             f"(opciones: {', '.join(correccion.METODOS_CORRECCION)})")
+        if radar_da.ndim != 2:
+            raise ValueError("La fusión necesita un campo 2D; acumule primero el cubo de radar")
+
+        self.radar_da = radar_da
+        self.radar = np.asarray(radar_da.values, dtype=float)
+        self.metodo = metodo
+        self.metodo_muestreo = metodo_muestreo
+        self.vecinos = vecinos
+        self.potencia = potencia
+        self.radio = radio if metodo == 'idw' else None
+        self.tam_tesela = tam_tesela
+        self.control = control
+        self.rellenar_secos = rellenar_secos
+        self.revision = None
+        self.log = log
+
+        self.x_eje, self.y_eje, _, _ = correccion.coordenadas_radar_km(radar_da, np.empty(0), np.empty(0))
+        ny, nx = self.radar.shape
+        self.forma_teselas = (-(-ny // tam_tesela), -(-nx // tam_tesela))
+
+        self.tabla = pd.DataFrame(columns=COLUMNAS + ['radar', 'x', 'y'], dtype=float)
+        self._siguiente = 0
+        self._anadir(pluviometros_gdf[COLUMNAS])
+        self._motor = None
+        self.recalcular()
+
+    # --- Pluviómetros ---
+
+    def _anadir(self, altas):
+        """Muestrea el radar en los pluviómetros nuevos y los añade a la tabla; devuelve sus ids"""
+        altas = pd.DataFrame({c: np.asarray(altas[c], dtype=float) for c in COLUMNAS})
+        if altas.empty:
+            return np.empty(0, dtype=int)
+
+        lon_pts, lat_pts = altas.longitud.values, altas.latitud.values
+        _, _, x_pts, y_pts = correccion.coordenadas_radar_km(self.radar_da, lon_pts, lat_pts)
+        if 'centro' in self.radar_da.attrs and 'resolucion_km' in self.radar_da.attrs:
+            # Plan sin cachear: los pluviómetros tardíos no se repiten entre escaneos
+            plan = preparar_muestreo(self.x_eje, self.y_eje, x_pts, y_pts, self.metodo_muestreo)
+            altas['radar'] = aplicar_muestreo(plan, self.radar)
+        else:
+            altas['radar'] = muestrear_radar(self.radar_da, lon_pts, lat_pts, self.metodo_muestreo)
+        altas['x'] = x_pts
+        altas['y'] = y_pts
+
+        ids = np.arange(self._siguiente, self._siguiente + len(altas))
+        self._siguiente += len(altas)
+        altas.index = ids
+        self.tabla = altas if self.tabla.empty else pd.concat([self.tabla, altas])
+        return ids
+
+    def diferencias(self, tabla):
+        """(altas, bajas) que convierten los pluviómetros actuales en ``tabla``.
+
+        Un pluviómetro cuya lectura cambia es una baja y un alta; las filas
+        repetidas cuentan por separado.
+        """
+        actual = self.tabla[COLUMNAS].copy()
+        actual['_n'] = actual.groupby(COLUMNAS, dropna=False).cumcount()
+        nueva = pd.DataFrame({c: np.asarray(tabla[c], dtype=float) for c in COLUMNAS})
+        nueva['_n'] = nueva.groupby(COLUMNAS, dropna=False).cumcount()
+
+        union = actual.rename_axis('id').reset_index().merge(nueva, on=COLUMNAS + ['_n'], how='outer',
+                                                             indicator=True)
+        bajas = union.loc[union['_merge'] == 'left_only', 'id'].astype(int).values
+        altas = union.loc[union['_merge'] == 'right_only', COLUMNAS]
+        return altas, bajas
+
+    def actualizar(self, altas=None, bajas=()):
+        """Añade ``altas`` (tabla con longitud, latitud y precipitación) y quita los ids de ``bajas``.
+
+        Devuelve un resumen con los ids nuevos, los píxeles recalculados y las
+        teselas que han quedado sucias.
+        """
+        bajas = np.asarray(bajas, dtype=int)
+        desconocidas = np.setdiff1d(bajas, self.tabla.index.values)
+        if len(desconocidas):
+            raise ValueError(f"Pluviómetros desconocidos: {', '.join(map(str, desconocidas))}")
+
+        antes = time.perf_counter()
+        cambiados = self.tabla.loc[bajas, ['longitud', 'latitud']]
+        self.tabla = self.tabla.drop(index=bajas)
+        ids = self._anadir(altas) if altas is not None else np.empty(0, dtype=int)
+        if len(ids):
+            cambiados = pd.concat([cambiados, self.tabla.loc[ids, ['longitud', 'latitud']]])
+        self._cambiados.append(cambiados)
+
+        pixeles = self._actualizar_correccion()
+        resumen = {
+            'altas': ids,
+            'bajas': bajas,
+            'pixeles': pixeles,
+            'teselas': int(self._sucias.sum()),
+            'completo': pixeles == self.radar.size,
+            'segundos': time.perf_counter() - antes,
+        }
+        control = ''
+        if self.revision is not None:
+            resumen['descartados'] = int((~self.revision.valido).sum())
+            control = f", {resumen['descartados']} pluviómetros descartados por el control de calidad"
+        self.log(f"Actualización: {len(ids)} altas, {len(bajas)} bajas, {pixeles} píxeles recalculados "
+                 f"en {resumen['segundos']:.3f} s{control}")
+        return resumen
+
+    def aplicar_tabla(self, tabla):
+        """Lleva el estado a los pluviómetros de ``tabla`` con las altas y bajas mínimas"""
+        altas, bajas = self.diferencias(tabla)
+        return self.actualizar(altas, bajas)
+
+    # --- Corrección ---
+
+    def _validos(self):
+        """Pluviómetros con lectura y radar que superan el control de calidad"""
+        validos = np.isfinite(self.tabla.radar.values) & np.isfinite(self.tabla.precipitacion.values)
+        if self.control and not self.tabla.empty:
+            t = self.tabla
+            self.revision = control_calidad.controlar(t.longitud.values, t.latitud.values, t.precipitacion.values,
+                                                      t.radar.values, t.x.values, t.y.values)
+            validos &= self.revision.valido.values
+        return self.tabla[validos]
+
+    def _participantes(self):
+        """Puntos que entran en la interpolación y sus valores, uno por posición (indexados por su clave)"""
+        validos = self._validos()
+        if self.metodo == 'condicional':
+            puntos = pd.DataFrame({'x': validos.x, 'y': validos.y, 'pluv': validos.precipitacion,
+                                   'radar': validos.radar})
+        else:
+            cocientes, lluvia = correccion.log_cocientes(validos.precipitacion.values, validos.radar.values)
+            puntos = pd.DataFrame({'x': validos.x, 'y': validos.y, 'campo': cocientes}, index=validos.index)[lluvia]
+
+        # Los coincidentes se promedian ordenados por valor: el resultado no depende del orden de las filas
+        puntos['clave'] = control_calidad.claves_posicion(self.tabla.loc[puntos.index, 'longitud'].values,
+                                                          self.tabla.loc[puntos.index, 'latitud'].values)
+        puntos = puntos.sort_values(['clave'] + [c for c in puntos.columns if c != 'clave'])
+        return puntos.groupby('clave').mean()
+
+    def _media(self):
+        if self.metodo == 'condicional' or self._puntos.empty:
+            return None
+        return float(self._puntos['campo'].mean())
+
+    def recalcular(self):
+        """Recalcula toda la corrección y reajusta el variograma"""
+        self._completo = True
+        self._sucias = np.ones(self.forma_teselas, dtype=bool)
+        self._cambiados = []
+        validos = self._validos()
+        if self.revision is not None:
+            self.log(control_calidad.describir(self.revision, self.tabla.longitud.values,
+                                               self.tabla.latitud.values, self.tabla.precipitacion.values))
+
+        if self.metodo in ('mediana', 'campo_medio'):
+            self.factor = correccion.factor_unico(validos.precipitacion.values, validos.radar.values, self.metodo)
+            self.datos = self.radar * self.factor
+            return self.radar.size
+
+        self._puntos = self._participantes()
+        if self._puntos.empty and self.metodo != 'condicional':
+            self.log("\nAdvertencia: ningún par con lluvia; no se aplica corrección")
+        nombres = [c for c in self._puntos.columns if c not in ('x', 'y')]
+        xy = self._puntos[['x', 'y']].values
+        self.variogramas = {}
+        if self.metodo in ('kriging', 'condicional') and len(xy):
+            self.variogramas = {c: correccion.ajustar_variograma(xy, self._puntos[c].values) for c in nombres}
+
+        self.campos = {c: np.zeros(self.radar.shape) for c in nombres}
+        self.alcance = np.full(self.radar.shape, np.inf)
+        self._media_actual = self._media()
+        self.datos = np.empty(self.radar.shape)
+        self._interpolar(np.arange(self.radar.size))
+        self._componer(np.arange(self.radar.size))
+        return self.radar.size
+
+    def _xy_pixeles(self, pixeles):
+        filas, columnas = np.divmod(pixeles, self.radar.shape[1])
+        return np.column_stack([self.x_eje[columnas], self.y_eje[filas]])
+
+    def _interpolar(self, pixeles):
+        """Interpola los campos en ``pixeles`` (índices planos) y guarda su alcance de vecinos"""
+        if self._puntos.empty:
+            # Sin pares: corrección nula (condicional se queda con el radar)
+            for campo in self.campos.values():
+                campo.flat[pixeles] = 0.0
+            self.alcance.flat[pixeles] = np.inf
+            return
+
+        xy_pluv = self._puntos[['x', 'y']].values
+        arbol = cKDTree(xy_pluv)
+        k = min(self.vecinos, len(xy_pluv))
+        for inicio in range(0, len(pixeles), PIXELES_POR_BLOQUE):
+            bloque = pixeles[inicio:inicio + PIXELES_POR_BLOQUE]
+            distancias, indices = correccion._buscar_vecinos(arbol, self._xy_pixeles(bloque), k, self.radio)
+            for nombre, campo in self.campos.items():
+                valores = self._puntos[nombre].values
+                if self.metodo == 'idw':
+                    campo.flat[bloque] = correccion.idw_con_vecinos(valores, distancias, indices, self.potencia)
+                else:
+                    campo.flat[bloque] = correccion.kriging_con_vecinos(xy_pluv, valores, distancias, indices,
+                                                                        self.variogramas[nombre])
+            # Con radio, un píxel con menos de k vecinos depende de todo lo que caiga en el radio
+            lejano = distancias[:, -1]
+            self.alcance.flat[bloque] = np.where(np.isfinite(lejano), lejano,
+                                                 self.radio if self.radio is not None else np.inf)
+
+    def _componer(self, pixeles):
+        """Campo corregido en ``pixeles`` a partir de los campos interpolados"""
+        radar = self.radar.flat[pixeles]
+        if self.metodo == 'condicional':
+            datos = np.maximum(self.campos['pluv'].flat[pixeles] + (radar - self.campos['radar'].flat[pixeles]), 0.0)
+        else:
+            campo = self.campos['campo'].flat[pixeles]
+            # Fuera del alcance de los pluviómetros se usa el sesgo medio
+            media = self._media_actual if self._media_actual is not None else 0.0
+            campo = np.where(np.isfinite(campo), campo, media)
+            datos = correccion.aplicar_factor(radar, np.exp(campo), self.rellenar_secos)
+        # Los píxeles sin dato de radar siguen sin dato
+        self.datos.flat[pixeles] = np.where(np.isnan(radar), np.nan, datos)
+
+    def _actualizar_correccion(self):
+        """Aplica a la corrección los cambios de pluviómetros; devuelve los píxeles recalculados"""
+        if self.metodo in ('mediana', 'campo_medio'):
+            validos = self._validos()
+            factor = correccion.factor_unico(validos.precipitacion.values, validos.radar.values, self.metodo)
+            if factor == self.factor:
+                return 0
+            return self.recalcular()
+
+        anteriores, nuevos = self._puntos, self._participantes()
+        k_antes, k_despues = min(self.vecinos, len(anteriores)), min(self.vecinos, len(nuevos))
+        if anteriores.empty or nuevos.empty or k_antes != k_despues:
+            return self.recalcular()
+
+        salen = anteriores.index.difference(nuevos.index)
+        entran = nuevos.index.difference(anteriores.index)
+        comunes = anteriores.index.intersection(nuevos.index)
+        # Posiciones que siguen pero cuyo valor (o promedio) ha cambiado
+        cambian = comunes[(anteriores.loc[comunes] != nuevos.loc[comunes]).any(axis=1).values]
+        if not len(salen) and not len(entran) and not len(cambian):
+            return 0
+
+        xy_cambios = np.concatenate([anteriores.loc[salen.union(cambian), ['x', 'y']].values,
+                                     nuevos.loc[entran.union(cambian), ['x', 'y']].values])
+        recalcular = self._pixeles_afectados(xy_cambios)
+
+        self._puntos = nuevos
+        media_anterior, self._media_actual = self._media_actual, self._media()
+        self._interpolar(recalcular)
+
+        componer = recalcular
+        if self._media_actual != media_anterior:
+            # El sesgo medio cambia los píxeles sin pluviómetros al alcance
+            sin_alcance = np.flatnonzero(~np.isfinite(self.campos['campo']))
+            componer = np.union1d(recalcular, sin_alcance)
+        self._componer(componer)
+        self._marcar(componer)
+        return len(recalcular)
+
+    def _pixeles_afectados(self, xy_cambios):
+        """Píxeles que tienen algún punto de ``xy_cambios`` dentro de su alcance de vecinos"""
+        ny, nx = self.radar.shape
+        t = self.tam_tesela
+        afectados = []
+        for fila0 in range(0, ny, t):
+            y = self.y_eje[fila0:fila0 + t]
+            # Distancia de cada cambio a la franja, para descartarla entera si queda lejos
+            dy = np.maximum(np.maximum(y[0] - xy_cambios[:, 1], xy_cambios[:, 1] - y[-1]), 0.0)
+            alcance = self.alcance[fila0:fila0 + t]
+            cerca = dy <= alcance.max()
+            if not cerca.any():
+                continue
+            for col0 in range(0, nx, t):
+                x = self.x_eje[col0:col0 + t]
+                alcance_tesela = alcance[:, col0:col0 + t]
+                dx = np.maximum(np.maximum(x[0] - xy_cambios[cerca, 0], xy_cambios[cerca, 0] - x[-1]), 0.0)
+                puntos = xy_cambios[cerca][np.hypot(dx, dy[cerca]) <= alcance_tesela.max()]
+                if not len(puntos):
+                    continue
+                # Distancia de cada píxel de la tesela al cambio más cercano
+                d2 = np.min((x[np.newaxis, :, np.newaxis] - puntos[:, 0]) ** 2
+                            + (y[:, np.newaxis, np.newaxis] - puntos[:, 1]) ** 2, axis=-1)
+                filas, columnas = np.nonzero(d2 <= alcance_tesela ** 2 * (1 + 1e-9))
+                afectados.append((fila0 + filas) * nx + col0 + columnas)
+        return np.concatenate(afectados) if afectados else np.empty(0, dtype=np.intp)
+
+    def _marcar(self, pixeles):
+        filas, columnas = np.divmod(pixeles, self.radar.shape[1])
+        self._sucias[filas // self.tam_tesela, columnas // self.tam_tesela] = True
+
+    # --- Resultados ---
+
+    def campo_corregido(self):
+        """Campo corregido como DataArray, con las coordenadas y atributos del radar"""
+        corregido = self.radar_da.copy(data=self.datos.astype(self.radar_da.dtype, copy=False))
+        corregido.attrs = dict(self.radar_da.attrs, metodo_correccion=self.metodo)
+        return corregido
+
+    def regiones_sucias(self):
+        """Regiones (fila0, fila1, col0, col1) por repintar: tramos de teselas sucias de cada fila"""
+        ny, nx = self.radar.shape
+        t = self.tam_tesela
+        regiones = []
+        for i, fila in enumerate(self._sucias):
+            # Inicios y finales de los tramos consecutivos de teselas sucias
+            bordes = np.flatnonzero(np.diff(np.concatenate([[0], fila.astype(np.int8), [0]])))
+            for inicio, fin in zip(bordes[::2], bordes[1::2]):
+                regiones.append((i * t, min((i + 1) * t, ny), inicio * t, min(fin * t, nx)))
+        return regiones
+
+    def renderizar(self, ruta_salida, calidad='final', vmax=None):
+        """Escribe el mapa; tras una actualización solo se repintan las teselas sucias"""
+        if self._motor is None:
+            self._motor = renderizado.MotorMapa(geometria_de(self.radar_da), calidad=calidad, vmax=vmax,
+                                                log=self.log)
+        cambiados = pd.concat(self._cambiados) if self._cambiados else None
+        parcial = not self._completo
+        self._motor.guardar(
+            self.datos, ruta_salida, self.tabla.longitud.values, self.tabla.latitud.values,
+            regiones=self.regiones_sucias() if parcial else None,
+            puntos_cambiados=(cambiados.longitud.values, cambiados.latitud.values) if parcial and cambiados is not None
+            else None
+        )
+        self._sucias[:] = False
+        self._cambiados = []
+        self._completo = False
+        return ruta_salida
+
+    def cerrar(self):
+        if self._motor is not None:
+            self._motor.cerrar()
+            self._motor = None
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(
+        description="Fusión radar-pluviómetros que se actualiza al cambiar la tabla de pluviómetros"
+    )
+    parser.add_argument("radar", help="Archivo NetCDF del radar")
+    parser.add_argument("pluviometros", help="Tabla de pluviómetros (Excel, CSV o Parquet)")
+    parser.add_argument("-o", "--salida", default="mapa_incremental.png", help="Mapa PNG generado")
+    parser.add_argument("--metodo", default="idw", choices=correccion.METODOS_CORRECCION,
+                        help="Método de corrección")
+    parser.add_argument("--vecinos", type=int, default=8, help="Pluviómetros vecinos de cada píxel")
+    parser.add_argument("--radio", type=float, default=None,
+                        help="Radio máximo de búsqueda del IDW (km); fuera se usa el sesgo medio")
+    parser.add_argument("--sin-control", action="store_true",
+                        help="No pasar el control de calidad a los pluviómetros antes de fusionar")
+    parser.add_argument("--actualizar", action="append", default=[], metavar="TABLA",
+                        help="Tabla posterior de pluviómetros que se aplica como actualización (repetible)")
+    parser.add_argument("--vigilar", action="store_true",
+                        help="Seguir aplicando la tabla de pluviómetros cada vez que cambie")
+    parser.add_argument("--intervalo", type=float, default=2.0,
+                        help="Segundos entre dos comprobaciones de la tabla con --vigilar")
+    parser.add_argument("--calidad", default="final", choices=tuple(renderizado.CALIDADES),
+                        help="Calidad del mapa: borrador (vista previa rápida) o final (300 dpi)")
+    parser.add_argument("--vmax", type=float, default=None,
+                        help="Máximo fijo de la escala de colores (evita repintar todo si cambia el máximo)")
+    parser.add_argument("--producto", default=None,
+                        help="NetCDF, Zarr o GeoTIFF donde guardar el campo corregido tras cada actualización")
+    parser.add_argument("--centro-lon", type=float, default=fusion.CENTRO_LON,
+                        help="Longitud del centro del radar")
+    parser.add_argument("--centro-lat", type=float, default=fusion.CENTRO_LAT,
+                        help="Latitud del centro del radar")
+    parser.add_argument("--resolucion-km", type=float, default=fusion.RESOLUCION_KM,
+                        help="Resolución de la rejilla del radar (km)")
+    reflectividad.agregar_argumentos(parser)
+    return parser
+
+
+def _firma(ruta):
+    estado = os.stat(ruta)
+    return estado.st_size, estado.st_mtime_ns
+
+
+def main(argv=None):
+    parser = crear_parser()
+    args = parser.parse_args(argv)
+    for ruta in [args.radar, args.pluviometros] + args.actualizar:
+        if not os.path.exists(ruta):
+            parser.error(f"No existe el archivo: {ruta}")
+    try:
+        zr = reflectividad.desde_argumentos(args)
+    except (OSError, ValueError) as e:
+        parser.error(f"--clutter/--zr: {e}")
+
+    radar = fusion.cargar_datos_radar(args.radar, args.centro_lon, args.centro_lat, args.resolucion_km)
+    radar = fusion.preparar_campo(radar, zr=zr, en_sitio=True)
+    pluv = fusion.cargar_datos_pluviometros(args.pluviometros)
+
+    estado = FusionIncremental(radar, pluv, metodo=args.metodo, vecinos=args.vecinos, radio=args.radio,
+                               control=not args.sin_control)
+    # Cada actualización sustituye el mismo paso de tiempo del producto
+    tiempo = fusion.tiempo_productos(radar, args.radar) if args.producto else None
+    try:
+        def publicar():
+            estado.renderizar(args.salida, calidad=args.calidad, vmax=args.vmax)
+            if args.producto:
+                guardar_producto(estado.campo_corregido(), args.producto, tiempo)
+            print(f"Mapa guardado en: {args.salida}")
+
+        publicar()
+        for ruta in args.actualizar:
+            estado.aplicar_tabla(pluviometros.cargar_tabla(ruta))
+            publicar()
+
+        if args.vigilar:
+            print(f"=== VIGILANDO {args.pluviometros} (Ctrl+C para terminar) ===")
+            firma = _firma(args.pluviometros)
+            try:
+                while True:
+                    time.sleep(args.intervalo)
+                    try:
+                        nueva = _firma(args.pluviometros)
+                        if nueva == firma:
+                            continue
+                        firma = nueva
+                        estado.aplicar_tabla(pluviometros.cargar_tabla(args.pluviometros))
+                    except (OSError, ValueError) as e:
+                        # Tabla a medio escribir: se reintenta en la siguiente comprobación
+                        print(f"No se pudo leer la tabla de pluviómetros: {e}")
+                        continue
+                    publicar()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        estado.cerrar()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""Instrumentación de las etapas de la fusión.
+
+``RegistroEjecucion`` mide cada etapa (``with registro.etapa('nombre'):``):
+tiempo de reloj, memoria residente (actual y pico del proceso) y el tamaño
+de los arrays que produce. Al terminar, ``guardar`` añade la ejecución a un
+registro estructurado: una línea JSON por ejecución (``.jsonl``/``.json``)
+o una fila por etapa (``.csv``), de modo que las regresiones se ven
+comparando ejecuciones de producción.
+
+Modos de perfilado opcionales (``perfil``):
+- ``'cprofile'``: guarda un ``.prof`` de toda la ejecución (ver con snakeviz
+  o ``python -m pstats``).
+- ``'tracemalloc'``: pico de memoria de Python por etapa y un resumen de
+  las líneas que más memoria reservan.
+"""
+import csv
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+PERFILES = (None, 'cprofile', 'tracemalloc')
+
+CAMPOS_CSV = ['ejecucion', 'inicio', 'etapa', 'segundos', 'rss_mb', 'pico_rss_mb',
+              'pico_python_mb', 'bytes_arrays', 'formas', 'error']
+
+
+def rss_actual_mb():
+    """Memoria residente actual del proceso (MB); None si el sistema no la expone"""
+    try:
+        with open('/proc/self/statm') as f:
+            paginas = int(f.read().split()[1])
+        return paginas * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def pico_rss_mb():
+    """Pico de memoria residente del proceso desde su inicio (MB)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KiB y macOS en bytes
+    return pico / 2 ** 20 if sys.platform == 'darwin' else pico / 2 ** 10
+
+
+def describir_arrays(objeto):
+    """(bytes, formas) de un resultado: DataArray, ndarray, DataFrame o tupla de ellos"""
+    if objeto is None:
+        return 0, []
+    if isinstance(objeto, (tuple, list)):
+        total, formas = 0, []
+        for elemento in objeto:
+            b, f = describir_arrays(elemento)
+            total += b
+            formas += f
+        return total, formas
+    if hasattr(objeto, 'memory_usage') and hasattr(objeto, 'columns'):
+        return int(objeto.memory_usage(deep=False).sum()), [list(objeto.shape)]
+    if hasattr(objeto, 'nbytes') and hasattr(objeto, 'shape'):
+        return int(objeto.nbytes), [list(objeto.shape)]
+    return 0, []
+
+
+class RegistroEjecucion:
+    """Medidas por etapa de una ejecución del proceso de fusión"""
+
+    def __init__(self, perfil=None, directorio_perfil='.', contexto=None):
+        if perfil not in PERFILES:
+            raise ValueError(f"Perfil desconocido: {perfil} (opciones: cprofile, tracemalloc)")
+
+        self.id = uuid.uuid4().hex[:12]
+        self.inicio = datetime.now().isoformat(timespec='seconds')
+        self.contexto = dict(contexto or {}, python=platform.python_version(), maquina=socket.gethostname())
+        self.etapas = []
+        self.perfil = perfil
+        self.directorio_perfil = directorio_perfil
+        self.archivos_perfil = []
+        self._perfilador = None
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def etapa(self, nombre):
+        """Mide el bloque; el resultado de la etapa se anota con ``medida['resultado'] = ...``"""
+        medida = {'etapa': nombre, 'error': ''}
+        if self.perfil == 'tracemalloc':
+            tracemalloc.reset_peak()
+        inicio = time.perf_counter()
+        try:
+            yield medida
+        except BaseException as e:
+            medida['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            medida['segundos'] = round(time.perf_counter() - inicio, 4)
+            medida['rss_mb'] = _redondear(rss_actual_mb())
+            medida['pico_rss_mb'] = _redondear(pico_rss_mb())
+            if self.perfil == 'tracemalloc':
+                medida['pico_python_mb'] = _redondear(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+            medida['bytes_arrays'], medida['formas'] = describir_arrays(medida.pop('resultado', None))
+            self.etapas.append(medida)
+
+    def iniciar_perfil(self):
+        if self.perfil == 'cprofile':
+            import cProfile
+
+            self._perfilador = cProfile.Profile()
+            self._perfilador.enable()
+        elif self.perfil == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def terminar_perfil(self):
+        """Detiene el perfilado y vuelca sus resultados junto al registro"""
+        if self.perfil is None:
+            return
+        os.makedirs(self.directorio_perfil, exist_ok=True)
+        base = os.path.join(self.directorio_perfil, f"perfil_{self.id}")
+
+        if self.perfil == 'cprofile' and self._perfilador is not None:
+            self._perfilador.disable()
+            self._perfilador.dump_stats(base + '.prof')
+            self.archivos_perfil.append(base + '.prof')
+            self._perfilador = None
+
+        elif self.perfil == 'tracemalloc' and tracemalloc.is_tracing():
+            estadisticas = tracemalloc.take_snapshot().statistics('lineno')
+            with open(base + '_memoria.txt', 'w', encoding='utf-8') as f:
+                for estadistica in estadisticas[:25]:
+                    f.write(f"{estadistica}\n")
+            tracemalloc.stop()
+            self.archivos_perfil.append(base + '_memoria.txt')
+
+    @contextmanager
+    def perfilando(self):
+        """Activa el modo de perfilado elegido durante el bloque"""
+        self.iniciar_perfil()
+        try:
+            yield self
+        finally:
+            self.terminar_perfil()
+
+    def resumen(self):
+        """Diccionario de la ejecución completa, listo para JSON"""
+        return {
+            'ejecucion': self.id,
+            'inicio': self.inicio,
+            'segundos_total': round(time.perf_counter() - self._t0, 4),
+            'contexto': self.contexto,
+            'etapas': self.etapas,
+            'perfil': self.archivos_perfil,
+        }
+
+    def guardar(self, ruta):
+        """Añade la ejecución al registro ``ruta`` (ver ``guardar_ejecucion``)"""
+        return guardar_ejecucion(self.resumen(), ruta)
+
+    def tabla(self):
+        """Texto con una línea por etapa, para el log de la ejecución"""
+        lineas = [f"{'Etapa':<24}{'s':>9}{'RSS MB':>10}{'Pico MB':>10}{'Arrays MB':>11}"]
+        for m in self.etapas:
+            lineas.append(f"{m['etapa']:<24}{m['segundos']:>9.3f}{_texto(m['rss_mb']):>10}"
+                          f"{_texto(m['pico_rss_mb']):>10}{m['bytes_arrays'] / 2 ** 20:>11.1f}")
+        return "\n".join(lineas)
+
+
+def guardar_ejecucion(resumen, ruta):
+    """Añade una ejecución (``RegistroEjecucion.resumen()``) al registro ``ruta``.
+
+    ``.csv``: una fila por etapa; cualquier otra extensión: una línea JSON por ejecución.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+
+    if ruta.lower().endswith('.csv'):
+        nuevo = not os.path.exists(ruta) or os.path.getsize(ruta) == 0
+        with open(ruta, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CAMPOS_CSV, extrasaction='ignore')
+            if nuevo:
+                writer.writeheader()
+            for medida in resumen['etapas']:
+                writer.writerow(dict(medida, ejecucion=resumen['ejecucion'], inicio=resumen['inicio'],
+                                     formas=json.dumps(medida['formas'])))
+    else:
+        with open(ruta, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(resumen, ensure_ascii=False, default=str) + "\n")
+    return ruta
+
+
+def _redondear(valor):
+    return None if valor is None else round(valor, 1)
+
+
+def _texto(valor):
+    return '-' if valor is None else f"{valor:.1f}"
+
+
+def etapa(registro, nombre):
+    """``registro.etapa(nombre)`` o un contexto vacío si no hay registro"""
+    return registro.etapa(nombre) if registro is not None else nullcontext({})
@@ -0,0 +1,299 @@
+"""Procesamiento por lotes de escaneos de radar repartido en un pool de procesos.
+
+Ejemplo:
+    python lote.py "escaneos/*.nc" --pluviometros lluvia.xls --salida-dir mapas -j 4
+"""
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import fusion
+import geometria
+import instrumentacion
+import pluviometros
+import productos
+import reflectividad
+import renderizado
+from pluviometros import EXTENSIONES
+
+
+def buscar_archivos_radar(patron):
+    """Devuelve la lista ordenada de NetCDF de un directorio o patrón glob"""
+    if os.path.isdir(patron):
+        patron = os.path.join(patron, '*.nc')
+    return sorted(glob.glob(patron))
+
+
+def emparejar_pluviometros(rutas_radar, pluviometros):
+    """Asocia a cada escaneo su tabla de pluviómetros.
+
+    ``pluviometros`` puede ser un único archivo (se usa para todos los
+    escaneos) o un directorio donde se busca un archivo con el mismo nombre
+    base que el NetCDF (``13-05-23.nc`` → ``13-05-23.xls``).
+    """
+    if not os.path.isdir(pluviometros):
+        return {ruta: pluviometros for ruta in rutas_radar}
+
+    parejas = {}
+    for ruta in rutas_radar:
+        base = os.path.splitext(os.path.basename(ruta))[0]
+        parejas[ruta] = None
+        for extension in EXTENSIONES:
+            candidato = os.path.join(pluviometros, base + extension)
+            if os.path.exists(candidato):
+                parejas[ruta] = candidato
+                break
+    return parejas
+
+
+def _procesar_escaneo(tarea):
+    """Ejecuta la fusión de un escaneo; nunca lanza excepciones hacia el pool"""
+    inicio = time.perf_counter()
+    mensajes = []
+    resultado = {
+        'radar': tarea['radar'],
+        'pluviometros': tarea['pluviometros'],
+        'salida': tarea['salida'],
+        'estado': 'ok',
+        'error': '',
+        # Instante con el que el proceso principal añade el campo al producto común
+        'tiempo': tarea.get('tiempo'),
+    }
+
+    # Cada proceso del pool mantiene su propia caché; el directorio la comparte entre ellos
+    if tarea.get('cache_dir') and geometria.CACHE.directorio != tarea['cache_dir']:
+        geometria.configurar_cache(directorio=tarea['cache_dir'])
+        pluviometros.configurar_cache(tarea['cache_dir'])
+
+    registro = None
+    if tarea.get('registro'):
+        registro = instrumentacion.RegistroEjecucion(
+            contexto={'radar': tarea['radar'], 'pluviometros': tarea['pluviometros']}
+        )
+
+    try:
+        if tarea['pluviometros'] is None:
+            raise FileNotFoundError("No se encontró una tabla de pluviómetros para este escaneo")
+
+        campo = fusion.ejecutar_fusion(
+            tarea['radar'],
+            tarea['pluviometros'],
+            tarea['salida'],
+            centro_lon=tarea['centro_lon'],
+            centro_lat=tarea['centro_lat'],
+            resolucion_km=tarea['resolucion_km'],
+            calidad=tarea.get('calidad', 'final'),
+            log=mensajes.append,
+            registro=registro,
+            rutas_producto=[tarea['geotiff']] if tarea.get('geotiff') else None,
+            zr=tarea.get('zr'),
+            control=tarea.get('control', True),
+            tiempo=tarea.get('tiempo')
+        )
+        # El producto acumulable lo escribe el proceso principal, en el orden del lote
+        if tarea.get('devolver_campo'):
+            resultado['campo'] = campo
+    except Exception as e:
+        resultado['estado'] = 'error'
+        resultado['error'] = str(e)
+
+    resultado['segundos'] = round(time.perf_counter() - inicio, 3)
+    resultado['log'] = "\n".join(mensajes)
+    # El proceso principal escribe el registro: así los procesos no compiten por el archivo
+    resultado['medidas'] = registro.resumen() if registro is not None else None
+    return resultado
+
+
+def preparar_tareas(rutas_radar, pluviometros, salida_dir, centro_lon=fusion.CENTRO_LON,
+                    centro_lat=fusion.CENTRO_LAT, resolucion_km=fusion.RESOLUCION_KM, cache_dir=None,
+                    calidad='final', registro=False, producto=None, geotiff=False, zr=None, control=True):
+    """Construye la lista de tareas (una por escaneo) para ``procesar_lote``.
+
+    Con ``producto`` cada tarea devuelve su campo corregido para añadirlo al
+    producto común (NetCDF, Zarr o .arch); con ``geotiff`` cada escaneo
+    escribe además su GeoTIFF junto al mapa. ``zr`` es la relación Z-R de los escaneos en dBZ.
+    Con ``control=False`` se omite el control de calidad de los pluviómetros.
+
+    Las tareas van por hora de escaneo (no por nombre de archivo), que es el
+    orden en que se añaden al producto común. Los escaneos sin hora propia
+    usan la fecha del archivo; si con ``producto`` esa fecha coincide con la
+    de otro escaneo, uno sustituiría al otro en el producto y se lanza ValueError.
+    """
+    parejas = emparejar_pluviometros(rutas_radar, pluviometros)
+    escaneos = {ruta: fusion.hora_escaneo_radar(ruta) for ruta in rutas_radar}
+    tiempos = {ruta: fusion.fecha_archivo(ruta) if hora is None else hora for ruta, hora in escaneos.items()}
+    if producto is not None:
+        repetidos = Counter(tiempos.values())
+        dudosos = sorted(ruta for ruta, hora in escaneos.items() if hora is None and repetidos[tiempos[ruta]] > 1)
+        if dudosos:
+            raise ValueError("Escaneos sin hora propia con la misma fecha de archivo que otro escaneo (se "
+                             f"sustituirían en {producto}): {', '.join(dudosos)}")
+    tareas = []
+    for ruta in sorted(rutas_radar, key=tiempos.get):
+        base = os.path.splitext(os.path.basename(ruta))[0]
+        tareas.append({
+            'radar': ruta,
+            'pluviometros': parejas[ruta],
+            'salida': os.path.join(salida_dir, f"{base}_corregida.png"),
+            'centro_lon': centro_lon,
+            'centro_lat': centro_lat,
+            'resolucion_km': resolucion_km,
+            'cache_dir': cache_dir,
+            'calidad': calidad,
+            'registro': registro,
+            'devolver_campo': producto is not None,
+            'geotiff': os.path.join(salida_dir, f"{base}_corregida.tif") if geotiff else None,
+            'zr': zr,
+            'control': control,
+            'tiempo': tiempos[ruta],
+        })
+    return tareas
+
+
+def procesar_lote(tareas, procesos=None, producto=None, log=print):
+    """Reparte las tareas en un pool de procesos y devuelve los resultados en orden.
+
+    Un fallo en un escaneo (incluida la caída de su proceso) queda registrado
+    en su resultado sin interrumpir el resto del lote. Con ``producto`` (NetCDF,
+    Zarr o .arch) los campos corregidos se añaden a ese archivo según llegan,
+    en el orden de las tareas, para que los procesos no escriban a la vez en él.
+    """
+    if not tareas:
+        return []
+
+    resultados = []
+    with ProcessPoolExecutor(max_workers=procesos) as executor:
+        futuros = [executor.submit(_procesar_escaneo, tarea) for tarea in tareas]
+
+        for tarea, futuro in zip(tareas, futuros):
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                resultado = {
+                    'radar': tarea['radar'],
+                    'pluviometros': tarea['pluviometros'],
+                    'salida': tarea['salida'],
+                    'estado': 'error',
+                    'error': f"Fallo del proceso: {str(e)}",
+                    'segundos': 0.0,
+                    'log': '',
+                }
+
+            campo = resultado.pop('campo', None)
+            if producto is not None and campo is not None:
+                try:
+                    productos.guardar_producto(campo, producto, resultado.get('tiempo'), log=lambda mensaje: None)
+                except Exception as e:
+                    resultado['estado'] = 'error'
+                    resultado['error'] = f"Producto: {str(e)}"
+
+            marca = "OK" if resultado['estado'] == 'ok' else "ERROR"
+            log(f"[{len(resultados) + 1}/{len(tareas)}] {marca} {resultado['radar']}"
+                + (f": {resultado['error']}" if resultado['error'] else ""))
+            resultados.append(resultado)
+
+    return resultados
+
+
+def escribir_resumen(resultados, ruta_csv):
+    """Guarda el resumen del lote como CSV (sin el log completo de cada escaneo)"""
+    campos = ['radar', 'pluviometros', 'salida', 'estado', 'segundos', 'error']
+    with open(ruta_csv, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=campos, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(resultados)
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(
+        description="Fusión radar-pluviómetros por lotes de archivos NetCDF"
+    )
+    parser.add_argument("radar", help="Directorio o patrón glob de archivos de radar (NetCDF)")
+    parser.add_argument("--pluviometros", required=True,
+                        help="Archivo de pluviómetros común o directorio con uno por escaneo")
+    parser.add_argument("--salida-dir", default="mapas", help="Directorio de los mapas generados")
+    parser.add_argument("-j", "--procesos", type=int, default=None,
+                        help="Número de procesos (por defecto, todos los núcleos)")
+    parser.add_argument("--resumen", default=None,
+                        help="CSV del resumen (por defecto, resumen_lote.csv en --salida-dir)")
+    parser.add_argument("--calidad", default="final", choices=tuple(renderizado.CALIDADES),
+                        help="Calidad de los mapas: borrador (vista previa rápida) o final (300 dpi)")
+    parser.add_argument("--producto", default=None,
+                        help="NetCDF (.nc), Zarr (.zarr) o archivo de campos (.arch) donde acumular los campos "
+                             "corregidos a lo largo del tiempo")
+    parser.add_argument("--geotiff", action="store_true",
+                        help="Guardar también un GeoTIFF del campo corregido de cada escaneo")
+    parser.add_argument("--registro", default=None,
+                        help="Añadir las medidas por etapa de cada escaneo a este registro (.csv o .jsonl)")
+    parser.add_argument("--sin-control", action="store_true",
+                        help="No pasar el control de calidad a los pluviómetros antes de fusionar")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directorio de la caché de geometría del radar y de tablas de pluviómetros")
+    parser.add_argument("--centro-lon", type=float, default=fusion.CENTRO_LON,
+                        help="Longitud del centro del radar")
+    parser.add_argument("--centro-lat", type=float, default=fusion.CENTRO_LAT,
+                        help="Latitud del centro del radar")
+    parser.add_argument("--resolucion-km", type=float, default=fusion.RESOLUCION_KM,
+                        help="Resolución de la rejilla del radar (km)")
+    reflectividad.agregar_argumentos(parser)
+    return parser
+
+
+def main(argv=None):
+    parser = crear_parser()
+    args = parser.parse_args(argv)
+    if args.producto:
+        try:
+            formato = productos.formato_de(args.producto)
+        except ValueError as e:
+            parser.error(str(e))
+        if formato not in ('netcdf', 'zarr', 'archivo'):
+            parser.error("--producto debe ser un NetCDF (.nc), un almacén Zarr (.zarr) o un archivo de campos "
+                         "(.arch)")
+
+    try:
+        zr = reflectividad.desde_argumentos(args)
+    except (OSError, ValueError) as e:
+        parser.error(f"--clutter/--zr: {e}")
+
+    rutas_radar = buscar_archivos_radar(args.radar)
+    if not rutas_radar:
+        print(f"ERROR: No se encontraron archivos de radar en {args.radar}", file=sys.stderr)
+        return 1
+
+    try:
+        tareas = preparar_tareas(rutas_radar, args.pluviometros, args.salida_dir,
+                                 args.centro_lon, args.centro_lat, args.resolucion_km, args.cache_dir,
+                                 args.calidad, registro=bool(args.registro), producto=args.producto,
+                                 geotiff=args.geotiff, zr=zr, control=not args.sin_control)
+    except ValueError as e:
+        print(f"ERROR: {str(e)}", file=sys.stderr)
+        return 1
+    os.makedirs(args.salida_dir, exist_ok=True)
+
+    print(f"=== LOTE: {len(tareas)} escaneos ===")
+    inicio = time.perf_counter()
+    resultados = procesar_lote(tareas, procesos=args.procesos, producto=args.producto)
+
+    ruta_resumen = args.resumen or os.path.join(args.salida_dir, 'resumen_lote.csv')
+    escribir_resumen(resultados, ruta_resumen)
+    if args.registro:
+        for resultado in resultados:
+            if resultado.get('medidas'):
+                instrumentacion.guardar_ejecucion(resultado['medidas'], args.registro)
+
+    errores = sum(1 for r in resultados if r['estado'] != 'ok')
+    print(f"\nCorrectos: {len(resultados) - errores}  Errores: {errores}  "
+          f"Tiempo total: {time.perf_counter() - inicio:.1f} s")
+    print(f"Resumen guardado en: {ruta_resumen}")
+
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
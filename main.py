@@ -1,18 +1,11 @@
 import customtkinter as ctk;
 from tkinter import filedialog, messagebox;
 import tkinter as tk;
-import xarray as xr;
-import pandas as pd;
-import numpy as np;
-import geopandas as gpd;
-import matplotlib;
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt;
-import cartopy.crs as ccrs;
-import cartopy.feature as cfeature;
-from scipy.interpolate import RBFInterpolator;
-from sklearn.metrics import mean_squared_error;
 import os;
+import queue;
+import fusion;
+import correccion;
+from trabajos import TrabajadorFusion;
 
 class FusionApp(ctk.CTk):
     def __init__(self):
@@ -28,12 +21,19 @@ class FusionApp(ctk.CTk):
         self.ruta_radar = tk.StringVar()
         self.ruta_pluviometros = tk.StringVar()
         self.ruta_salida = tk.StringVar(value=os.path.join(os.getcwd(), "precipitacion_corregida.png"));
-        self.centro_lon = tk.DoubleVar(value=77.849)
-        self.centro_lat = tk.DoubleVar(value=21.4227)
-        self.resolucion_km = tk.DoubleVar(value=1.0)
+        self.centro_lon = tk.DoubleVar(value=fusion.CENTRO_LON)
+        self.centro_lat = tk.DoubleVar(value=fusion.CENTRO_LAT)
+        self.resolucion_km = tk.DoubleVar(value=fusion.RESOLUCION_KM)
+        self.metodo_correccion = tk.StringVar(value="mediana")
+        self.control_calidad = tk.BooleanVar(value=True)
+        
+        # Las fusiones se ejecutan en un hilo aparte; la interfaz solo consulta sus eventos
+        self.trabajador = TrabajadorFusion()
+        self.protocol("WM_DELETE_WINDOW", self.salir)
         
         # Crear widgets
         self.crear_widgets()
+        self.after(100, self.revisar_eventos)
     
     def crear_widgets(self):
         # Frame principal
@@ -60,10 +60,10 @@ class FusionApp(ctk.CTk):
         ctk.CTkButton(file_frame, text="Examinar", command=lambda: self.seleccionar_archivo(self.ruta_radar, [("NetCDF files", "*.nc")])).grid(row=0, column=2, padx=5, pady=2)
         
         # Pluviómetros
-        ctk.CTkLabel(file_frame, text="Archivo Pluviómetros (Excel):").grid(row=1, column=0, sticky="w", padx=5, pady=2)
+        ctk.CTkLabel(file_frame, text="Archivo Pluviómetros (Excel/CSV/Parquet):").grid(row=1, column=0, sticky="w", padx=5, pady=2)
         pluv_entry = ctk.CTkEntry(file_frame, textvariable=self.ruta_pluviometros, width=400)
         pluv_entry.grid(row=1, column=1, padx=5, pady=2)
-        ctk.CTkButton(file_frame, text="Examinar", command=lambda: self.seleccionar_archivo(self.ruta_pluviometros, [("Excel files", "*.xls *.xlsx")])).grid(row=1, column=2, padx=5, pady=2)
+        ctk.CTkButton(file_frame, text="Examinar", command=lambda: self.seleccionar_archivo(self.ruta_pluviometros, [("Excel files", "*.xls *.xlsx"), ("CSV files", "*.csv"), ("Parquet files", "*.parquet")])).grid(row=1, column=2, padx=5, pady=2)
         
         # Salida
         ctk.CTkLabel(file_frame, text="Archivo Salida (PNG):").grid(row=2, column=0, sticky="w", padx=5, pady=2)
@@ -86,6 +86,11 @@ class FusionApp(ctk.CTk):
         ctk.CTkLabel(param_frame, text="Resolución (km):").grid(row=3, column=0, sticky="w", padx=5, pady=2)
         ctk.CTkEntry(param_frame, textvariable=self.resolucion_km, width=100).grid(row=3, column=1, sticky="w", padx=5, pady=2)
         
+        ctk.CTkLabel(param_frame, text="Método de corrección:").grid(row=4, column=0, sticky="w", padx=5, pady=2)
+        ctk.CTkOptionMenu(param_frame, variable=self.metodo_correccion, values=list(correccion.METODOS_CORRECCION), width=140).grid(row=4, column=1, sticky="w", padx=5, pady=2)
+        
+        ctk.CTkCheckBox(param_frame, text="Control de calidad de pluviómetros", variable=self.control_calidad).grid(row=5, column=0, columnspan=2, sticky="w", padx=5, pady=2)
+        
         # Frame de consola
         console_frame = ctk.CTkFrame(main_frame)
         console_frame.pack(fill="both", expand=True, padx=10, pady=(10, 5))
@@ -101,8 +106,12 @@ class FusionApp(ctk.CTk):
         
         ctk.CTkButton(button_frame, text="Ejecutar Fusión", command=self.ejecutar_fusion, 
                       fg_color="green", hover_color="dark green").pack(side="left", padx=5, pady=5)
+        ctk.CTkButton(button_frame, text="Cancelar", command=self.cancelar_fusion, 
+                      fg_color="dark orange", hover_color="orange").pack(side="left", padx=5, pady=5)
         ctk.CTkButton(button_frame, text="Limpiar Consola", command=self.limpiar_consola).pack(side="left", padx=5, pady=5)
-        ctk.CTkButton(button_frame, text="Salir", command=self.destroy, 
+        self.estado_label = ctk.CTkLabel(button_frame, text="Sin trabajos en curso")
+        self.estado_label.pack(side="left", padx=10, pady=5)
+        ctk.CTkButton(button_frame, text="Salir", command=self.salir, 
                       fg_color="red", hover_color="dark red").pack(side="right", padx=5, pady=5)
     
     def seleccionar_archivo(self, variable, filetypes, save=False):
@@ -120,248 +129,87 @@ class FusionApp(ctk.CTk):
     def log_consola(self, mensaje):
         self.console.insert("end", mensaje + "\n")
         self.console.see("end")
-        self.update()
     
-    def cargar_datos_radar(self):
+    def actualizar_estado(self):
+        en_curso = self.trabajador.en_curso
+        pendientes = self.trabajador.pendientes()
+        if en_curso is None and not pendientes:
+            self.estado_label.configure(text="Sin trabajos en curso")
+        elif en_curso is None:
+            self.estado_label.configure(text=f"{pendientes} trabajos en cola")
+        else:
+            self.estado_label.configure(text=f"Ejecutando trabajo #{en_curso}, {pendientes} en cola")
+    
+    def revisar_eventos(self):
+        # Se vacía la cola del trabajador sin bloquear y se vuelve a consultar en 100 ms
         try:
-            self.log_consola("\n[1/3] Cargando radar...")
-            
-            ds = xr.open_dataset(self.ruta_radar.get())
-            self.log_consola("\nMetadatos del radar:")
-            self.log_consola(f"Ubicación: {self.centro_lon.get()}°E, {self.centro_lat.get()}°N")
-            self.log_consola(f"Dimensiones: {ds.dims}")
-            
-            # Detectar automáticamente la variable de precipitación
-            var_precip = None
-            for var in ds.data_vars:
-                if len(ds[var].dims) == 2:  # Buscamos variables 2D (Y, X)
-                    var_precip = var
-                    break
-            
-            if var_precip is None:
-                raise ValueError("No se encontró una variable 2D de precipitación en el archivo NetCDF")
+            while True:
+                evento = self.trabajador.eventos.get_nowait()
                 
-            self.log_consola(f"Variable de precipitación detectada: {var_precip}")
-            
-            # Convertir resolución de km a grados (aproximación)
-            resolucion_grados = self.resolucion_km.get() / 111.32;  # 1° ≈ 111.32 km
-            
-            # Calcular rangos considerando las dimensiones del archivo
-            rango_lon = (ds.sizes['X'] * resolucion_grados) / 2
-            rango_lat = (ds.sizes['Y'] * resolucion_grados) / 2
-            
-            # Generar coordenadas
-            lon = np.linspace(self.centro_lon.get() - rango_lon, self.centro_lon.get() + rango_lon, ds.sizes['X'])
-            lat = np.linspace(self.centro_lat.get() - rango_lat, self.centro_lat.get() + rango_lat, ds.sizes['Y'])
-            
-            # Crear DataArray con coordenadas
-            da = xr.DataArray(
-                data=ds[var_precip].values,
-                dims=['Y', 'X'],
-                coords={
-                    'lat': (['Y'], lat),
-                    'lon': (['X'], lon)
-                },
-                attrs={
-                    'units': ds[var_precip].attrs.get('units', 'mm'),
-                    'description': ds[var_precip].attrs.get('description', ''),
-                    'centro': (self.centro_lon.get(), self.centro_lat.get()),
-                    'resolucion_km': self.resolucion_km.get(),
-                    'variable_original': var_precip
-                }
-            )
-            
-            self.log_consola("\nCoordenadas generadas:")
-            self.log_consola(f"Longitud: {lon.min():.4f} a {lon.max():.4f}")
-            self.log_consola(f"Latitud: {lat.min():.4f} a {lat.max():.4f}")
-            
-            return da
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Error cargando radar: {str(e)}")
-            return None
+                if evento[0] == 'log':
+                    self.log_consola(evento[2])
+                else:
+                    self.mostrar_estado(*evento[1:])
+        except queue.Empty:
+            pass
+        
+        self.actualizar_estado()
+        self.after(100, self.revisar_eventos)
     
-    def cargar_datos_pluviometros(self):
-        try:
-            self.log_consola("\n[2/3] Cargando pluviómetros...")
-            
-            # Primero leemos el archivo sin especificar columnas para ver su estructura
-            df_temp = pd.read_excel(self.ruta_pluviometros.get(), sheet_name=None, nrows=1)
-            
-            # Obtenemos el nombre real de la primera hoja
-            sheet_name = list(df_temp.keys())[0]
-            self.log_consola(f"Leyendo hoja: {sheet_name}")
-            
-            # Leemos el archivo completo
-            df = pd.read_excel(self.ruta_pluviometros.get(), sheet_name=sheet_name, header=None)
-            
-            # Verificamos cuántas columnas tiene el archivo
-            num_cols = df.shape[1]
-            self.log_consola(f"El archivo tiene {num_cols} columnas")
-            
-            # Asignamos nombres a las columnas según lo disponible
-            if num_cols >= 4:
-                df = df.iloc[1:, 0:4];  # Saltamos la primera fila (header) y tomamos 4 columnas
-                df.columns = ['longitud', 'latitud', 'precipitacion', 'tipo']
-            elif num_cols == 3:
-                df = df.iloc[1:, 0:3];  # Saltamos la primera fila y tomamos 3 columnas
-                df.columns = ['longitud', 'latitud', 'precipitacion']
-            else:
-                raise ValueError("El archivo debe tener al menos 3 columnas (longitud, latitud, precipitación)")
-            
-            # Limpieza y conversión
-            df = df.dropna(subset=['longitud', 'latitud', 'precipitacion'])
-            df['precipitacion'] = pd.to_numeric(df['precipitacion'], errors='coerce')
-            df = df[df['precipitacion'] >= 0]
-            
-            # Convertir a GeoDataFrame
-            gdf = gpd.GeoDataFrame(
-                df,
-                geometry=gpd.points_from_xy(df.longitud, df.latitud),
-                crs="EPSG:4326"
-            )
-            
-            self.log_consola(f"\nDatos pluviómetros cargados: {len(gdf)} estaciones")
-            return gdf
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Error cargando pluviómetros: {str(e)}\n\n"
-                                      "Asegúrese que el archivo Excel tenga al menos 3 columnas con:\n"
-                                      "1. Longitud\n2. Latitud\n3. Precipitación\n"
-                                      "Y que no tenga filas vacías al inicio.")
-            return None
+    def mostrar_estado(self, id_trabajo, estado, detalle):
+        if estado == 'iniciado':
+            self.log_consola(f"\n--- Trabajo #{id_trabajo} ---")
+        elif estado == 'ok':
+            self.log_consola(f"Trabajo #{id_trabajo} terminado")
+            messagebox.showinfo("Éxito", f"Proceso completado exitosamente!\nMapa generado en:\n{detalle}")
+        elif estado == 'cancelado':
+            self.log_consola(f"\nTrabajo #{id_trabajo} cancelado")
+        else:
+            self.log_consola(f"\nERROR: {detalle}")
+            messagebox.showerror("Error", f"Error en el trabajo #{id_trabajo}: {detalle}")
     
-    def fusionar_datos(self, radar_da, pluviometros_gdf):
-        try:
-            self.log_consola("\n[3/3] Fusionando datos...")
-            
-            # Preparar puntos para interpolación
-            xx, yy = np.meshgrid(radar_da.lon, radar_da.lat)
-            puntos_radar = np.column_stack([xx.ravel(), yy.ravel()])
-            valores_radar = radar_da.values.ravel()
-            
-            puntos_pluv = np.column_stack([
-                pluviometros_gdf.longitud,
-                pluviometros_gdf.latitud
-            ])
-            valores_pluv = pluviometros_gdf.precipitacion.values
-            
-            # Interpolación
-            interp = RBFInterpolator(puntos_radar, valores_radar, kernel='linear')
-            radar_en_pluv = interp(puntos_pluv)
-            
-            # Filtrar valores válidos
-            mask = (~np.isnan(radar_en_pluv)) & (~np.isnan(valores_pluv))
-            valores_pluv = valores_pluv[mask]
-            radar_en_pluv = radar_en_pluv[mask]
-            
-            if len(valores_pluv) == 0:
-                self.log_consola("\nAdvertencia: No hay puntos válidos para comparación")
-                return radar_da
-            
-            # Calcular factor de corrección
-            ratio = np.median(valores_pluv / radar_en_pluv)
-            self.log_consola(f"\nFactor de corrección: {ratio:.2f}")
-            self.log_consola(f"RMSE antes: {np.sqrt(mean_squared_error(valores_pluv, radar_en_pluv)):.2f}")
-            self.log_consola(f"RMSE después: {np.sqrt(mean_squared_error(valores_pluv, radar_en_pluv * ratio)):.2f}")
+    def ejecutar_fusion(self):
+        # Validar entradas
+        if not self.ruta_radar.get():
+            messagebox.showwarning("Advertencia", "Debe seleccionar un archivo de radar")
+            return
             
-            return radar_da * ratio
+        if not self.ruta_pluviometros.get():
+            messagebox.showwarning("Advertencia", "Debe seleccionar un archivo de pluviómetros")
+            return
             
-        except Exception as e:
-            messagebox.showerror("Error", f"Error en fusión: {str(e)}")
-            return None
-    
-    def generar_mapa(self, radar_da, pluviometros_gdf):
+        if not self.ruta_salida.get():
+            messagebox.showwarning("Advertencia", "Debe especificar una ruta de salida")
+            return
+        
         try:
-            self.log_consola("\nGenerando mapa...")
-            
-            fig = plt.figure(figsize=(12, 10))
-            ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
-            
-            # Configurar mapa
-            ax.add_feature(cfeature.COASTLINE)
-            ax.add_feature(cfeature.BORDERS, linestyle=':')
-            ax.set_extent([
-                radar_da.lon.min() - 0.5,
-                radar_da.lon.max() + 0.5,
-                radar_da.lat.min() - 0.5,
-                radar_da.lat.max() + 0.5
-            ])
-            
-            # Plot precipitación
-            mesh = ax.pcolormesh(
-                radar_da.lon,
-                radar_da.lat,
-                radar_da.values,
-                cmap='YlGnBu',
-                transform=ccrs.PlateCarree()
-            )
-            
-            # Plot pluviómetros
-            pluviometros_gdf.plot(
-                ax=ax,
-                color='red',
-                markersize=50,
-                alpha=0.7,
-                label='Pluviómetros',
-                transform=ccrs.PlateCarree()
+            # Los parámetros se copian ahora: el hilo de trabajo no toca las variables de Tk
+            id_trabajo = self.trabajador.encolar(
+                ruta_radar=self.ruta_radar.get(),
+                ruta_pluviometros=self.ruta_pluviometros.get(),
+                ruta_salida=self.ruta_salida.get(),
+                centro_lon=self.centro_lon.get(),
+                centro_lat=self.centro_lat.get(),
+                resolucion_km=self.resolucion_km.get(),
+                metodo=self.metodo_correccion.get(),
+                control=self.control_calidad.get()
             )
-            
-            # Configuración final
-            plt.colorbar(mesh, label='Precipitación (mm)')
-            ax.set_title('Precipitación Radar Corregida')
-            ax.legend()
-            
-            plt.savefig(self.ruta_salida.get(), dpi=300, bbox_inches='tight')
-            plt.close()
-            self.log_consola(f"\nMapa guardado en: {self.ruta_salida.get()}")
-            
-            # Mostrar mensaje de éxito
-            messagebox.showinfo("Éxito", "Proceso completado exitosamente!\nEl mapa se ha generado correctamente.")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Error generando mapa: {str(e)}")
+        except tk.TclError as e:
+            messagebox.showerror("Error", f"Parámetros del radar no válidos: {str(e)}")
+            return
+        
+        self.log_consola(f"Trabajo #{id_trabajo} en cola: {os.path.basename(self.ruta_radar.get())}")
+        self.actualizar_estado()
     
-    def ejecutar_fusion(self):
-        try:
-            self.log_consola("=== INICIANDO PROCESO DE FUSIÓN ===")
-            
-            # Validar entradas
-            if not self.ruta_radar.get():
-                messagebox.showwarning("Advertencia", "Debe seleccionar un archivo de radar")
-                return
-                
-            if not self.ruta_pluviometros.get():
-                messagebox.showwarning("Advertencia", "Debe seleccionar un archivo de pluviómetros")
-                return
-                
-            if not self.ruta_salida.get():
-                messagebox.showwarning("Advertencia", "Debe especificar una ruta de salida")
-                return
-            
-            # 1. Cargar datos
-            radar = self.cargar_datos_radar()
-            
-            if radar is None:
-                return
-                
-            pluv = self.cargar_datos_pluviometros()
-            if pluv is None:
-                return
-            
-            # 2. Fusionar datos
-            radar_corregido = self.fusionar_datos(radar, pluv)
-            if radar_corregido is None:
-                return
-            
-            # 3. Generar mapa
-            self.generar_mapa(radar_corregido, pluv)
-            
-            self.log_consola("\nProceso completado exitosamente!")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Error inesperado: {str(e)}")
-            self.log_consola(f"\nERROR: {str(e)}")
+    def cancelar_fusion(self):
+        if self.trabajador.en_curso is None and not self.trabajador.pendientes():
+            return
+        self.log_consola("\nCancelando...")
+        self.trabajador.cancelar(todos=True)
+    
+    def salir(self):
+        self.trabajador.detener()
+        self.destroy()
 
 if __name__ == "__main__":
     app = FusionApp()
@@ -0,0 +1,158 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Métodos de muestreo disponibles sobre la rejilla regular del radar
+METODOS_MUESTREO = ('vecino', 'bilineal', 'bicubico')
+
+# Píxeles (índices sobre la rejilla aplanada) y pesos de cada punto muestreado
+PlanMuestreo = namedtuple('PlanMuestreo', ['indices', 'pesos', 'dentro'])
+
+
+def _indices_fraccionales(eje, coords):
+    """Convierte coordenadas a índices fraccionales sobre un eje regular"""
+    eje = np.asarray(eje, dtype=float)
+    if eje.size < 2:
+        raise ValueError("El eje de la rejilla debe tener al menos 2 puntos")
+
+    paso = (eje[-1] - eje[0]) / (eje.size - 1)
+    if paso == 0:
+        raise ValueError("El eje de la rejilla no puede tener paso nulo")
+
+    return (np.asarray(coords, dtype=float) - eje[0]) / paso
+
+
+def _pesos_cubicos(t, a=-0.5):
+    """Pesos del núcleo cúbico de Keys (Catmull-Rom) para los 4 vecinos"""
+    t2 = t * t
+    t3 = t2 * t
+    return (
+        a * (t3 - 2 * t2 + t),
+        (a + 2) * t3 - (a + 3) * t2 + 1,
+        -(a + 2) * t3 + (2 * a + 3) * t2 - a * t,
+        -a * (t3 - t2),
+    )
+
+
+def preparar_muestreo(lon, lat, lon_pts, lat_pts, metodo='bilineal'):
+    """Precalcula los píxeles y pesos con los que se muestrea cada punto.
+
+    ``lon``/``lat`` son los ejes regulares de la rejilla y los puntos van en
+    el mismo sistema (lon/lat, o x/y en km en la rejilla nativa del radar).
+
+    El plan solo depende de la rejilla y de los puntos, no de los valores, así
+    que puede reutilizarse para todos los escaneos con la misma geometría.
+    Devuelve un ``PlanMuestreo`` con ``indices`` y ``pesos`` de forma
+    (vecinos, puntos) sobre la rejilla aplanada y la máscara ``dentro``.
+    """
+    if metodo not in METODOS_MUESTREO:
+        raise ValueError(f"Método de muestreo desconocido: {metodo} "
+                         f"(opciones: {', '.join(METODOS_MUESTREO)})")
+
+    nx = np.size(lon)
+    ny = np.size(lat)
+
+    fx = np.atleast_1d(_indices_fraccionales(lon, lon_pts))
+    fy = np.atleast_1d(_indices_fraccionales(lat, lat_pts))
+
+    # Puntos dentro del dominio de la rejilla (los NaN quedan fuera)
+    dentro = (fx >= 0) & (fx <= nx - 1) & (fy >= 0) & (fy <= ny - 1)
+    fx = fx[dentro]
+    fy = fy[dentro]
+
+    if metodo == 'vecino':
+        ix = np.rint(fx).astype(np.intp)
+        iy = np.rint(fy).astype(np.intp)
+        return PlanMuestreo((iy * nx + ix)[np.newaxis], np.ones((1, fx.size)), dentro)
+
+    # Celda inferior izquierda y posición relativa dentro de la celda
+    ix = np.clip(np.floor(fx).astype(np.intp), 0, nx - 2)
+    iy = np.clip(np.floor(fy).astype(np.intp), 0, ny - 2)
+    tx = fx - ix
+    ty = fy - iy
+
+    if metodo == 'bilineal':
+        indices = np.stack([
+            iy * nx + ix,
+            iy * nx + ix + 1,
+            (iy + 1) * nx + ix,
+            (iy + 1) * nx + ix + 1,
+        ])
+        pesos = np.stack([
+            (1 - ty) * (1 - tx),
+            (1 - ty) * tx,
+            ty * (1 - tx),
+            ty * tx,
+        ])
+        return PlanMuestreo(indices, pesos, dentro)
+
+    # Bicúbico: plantilla 4x4 con índices recortados en los bordes
+    wx = _pesos_cubicos(tx)
+    wy = _pesos_cubicos(ty)
+    indices = []
+    pesos = []
+    for j, peso_y in enumerate(wy):
+        fila = np.clip(iy + j - 1, 0, ny - 1)
+        for i, peso_x in enumerate(wx):
+            columna = np.clip(ix + i - 1, 0, nx - 1)
+            indices.append(fila * nx + columna)
+            pesos.append(peso_y * peso_x)
+    return PlanMuestreo(np.stack(indices), np.stack(pesos), dentro)
+
+
+def aplicar_muestreo(plan, valores):
+    """Evalúa un plan de muestreo sobre un campo 2D; fuera del dominio devuelve NaN"""
+    plano = np.asarray(valores).ravel()
+    resultado = np.full(plan.dentro.shape, np.nan)
+    if plan.indices.shape[1]:
+        resultado[plan.dentro] = np.sum(plan.pesos * plano[plan.indices], axis=0)
+    return resultado
+
+
+def muestrear_rejilla(lon, lat, valores, lon_pts, lat_pts, metodo='bilineal'):
+    """Muestrea un campo 2D (Y, X) de rejilla regular en puntos arbitrarios.
+
+    Todos los puntos se procesan a la vez; el coste es O(puntos) y la memoria
+    no depende del tamaño de la rejilla. Los puntos fuera del dominio del
+    radar devuelven NaN.
+    """
+    if np.shape(valores) != (np.size(lat), np.size(lon)):
+        raise ValueError("La forma del campo no coincide con los ejes lon/lat")
+
+    return aplicar_muestreo(preparar_muestreo(lon, lat, lon_pts, lat_pts, metodo), valores)
+
+
+def indices_pixel_cercano(lon, lat, lon_pts, lat_pts):
+    """Índices (fila, columna) del píxel más cercano a cada punto, en una sola pasada.
+
+    Devuelve también la máscara ``dentro``: los puntos que caen fuera de la
+    rejilla (más de medio píxel más allá del borde) se marcan como fuera del
+    dominio en vez de asignarles el píxel del borde; sus índices valen -1.
+    """
+    fx = np.atleast_1d(_indices_fraccionales(lon, lon_pts))
+    fy = np.atleast_1d(_indices_fraccionales(lat, lat_pts))
+    nx = np.size(lon)
+    ny = np.size(lat)
+
+    dentro = (fx >= -0.5) & (fx <= nx - 0.5) & (fy >= -0.5) & (fy <= ny - 0.5)
+    ix = np.full(fx.shape, -1, dtype=np.intp)
+    iy = np.full(fy.shape, -1, dtype=np.intp)
+    ix[dentro] = np.clip(np.rint(fx[dentro]), 0, nx - 1)
+    iy[dentro] = np.clip(np.rint(fy[dentro]), 0, ny - 1)
+    return iy, ix, dentro
+
+
+def muestrear_radar(radar_da, lon_pts, lat_pts, metodo='bilineal'):
+    """Muestrea un DataArray con ejes lon/lat 1D en los puntos dados.
+
+    Los radares de ``fusion`` (rejilla x/y en km) se muestrean con el plan de
+    su geometría (``fusion.muestrear_pluviometros``).
+    """
+    return muestrear_rejilla(
+        radar_da.lon.values,
+        radar_da.lat.values,
+        radar_da.values,
+        lon_pts,
+        lat_pts,
+        metodo=metodo
+    )
@@ -0,0 +1,179 @@
+"""Lectura de tablas de pluviómetros con caché en formato columnar.
+
+Leer un ``.xls`` es de lo más lento del proceso, así que cada libro se lee
+una sola vez: la tabla limpia se guarda en Parquet (o en pickle si no hay
+motor de Parquet instalado) junto a la fecha de modificación, el tamaño y
+el hash del archivo original. Las siguientes lecturas del mismo archivo
+sin cambios salen de la caché en milisegundos. CSV y Parquet también se
+aceptan como entradas directas.
+"""
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+EXTENSIONES_EXCEL = ('.xls', '.xlsx')
+EXTENSIONES = EXTENSIONES_EXCEL + ('.csv', '.parquet', '.feather')
+
+COLUMNAS = ['longitud', 'latitud', 'precipitacion', 'tipo']
+
+# Directorio de la caché de tablas (None = solo caché en memoria)
+DIRECTORIO_CACHE = None
+
+# Tablas ya leídas en este proceso: clave -> (firma, DataFrame)
+_memoria = {}
+
+
+def configurar_cache(directorio=None):
+    """Activa (o desactiva con None) la caché en disco de las tablas"""
+    global DIRECTORIO_CACHE
+    DIRECTORIO_CACHE = directorio
+
+
+def _hash_archivo(ruta):
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def _leer_original(ruta, log):
+    """Lee el archivo de origen según su extensión; devuelve el DataFrame sin limpiar"""
+    extension = os.path.splitext(ruta)[1].lower()
+
+    if extension in EXTENSIONES_EXCEL:
+        # Una sola lectura del libro: la primera hoja, sin cabecera
+        with pd.ExcelFile(ruta) as libro:
+            hoja = libro.sheet_names[0]
+            log(f"Leyendo hoja: {hoja}")
+            return libro.parse(hoja, header=None), True
+
+    if extension == '.csv':
+        return pd.read_csv(ruta, header=None), True
+
+    if extension == '.parquet':
+        return pd.read_parquet(ruta), False
+
+    if extension == '.feather':
+        return pd.read_feather(ruta), False
+
+    raise ValueError(f"Formato de pluviómetros no soportado: {extension} "
+                     f"(opciones: {', '.join(EXTENSIONES)})")
+
+
+def limpiar_tabla(df, con_cabecera=True, log=print):
+    """Valida y normaliza la tabla a las columnas longitud, latitud, precipitación (y tipo).
+
+    Con ``con_cabecera`` la primera fila es la cabecera del libro y las columnas
+    se toman por posición; si no, se esperan ya con sus nombres (Parquet/Feather).
+    """
+    if con_cabecera:
+        # Verificamos cuántas columnas tiene el archivo
+        num_cols = df.shape[1]
+        log(f"El archivo tiene {num_cols} columnas")
+
+        # Asignamos nombres a las columnas según lo disponible
+        if num_cols >= 4:
+            df = df.iloc[1:, 0:4]  # Saltamos la primera fila (header) y tomamos 4 columnas
+            df.columns = COLUMNAS
+        elif num_cols == 3:
+            df = df.iloc[1:, 0:3]  # Saltamos la primera fila y tomamos 3 columnas
+            df.columns = COLUMNAS[:3]
+        else:
+            raise ValueError("El archivo debe tener al menos 3 columnas (longitud, latitud, precipitación)")
+    else:
+        faltan = [c for c in COLUMNAS[:3] if c not in df.columns]
+        if faltan:
+            raise ValueError(f"Faltan columnas en la tabla de pluviómetros: {', '.join(faltan)}")
+        df = df[[c for c in COLUMNAS if c in df.columns]]
+
+    # Limpieza y conversión
+    df = df.dropna(subset=['longitud', 'latitud', 'precipitacion']).copy()
+    for columna in ('longitud', 'latitud', 'precipitacion'):
+        df[columna] = pd.to_numeric(df[columna], errors='coerce')
+    df = df.dropna(subset=['longitud', 'latitud'])
+    df = df[df['precipitacion'] >= 0]
+    if 'tipo' in df.columns:
+        df['tipo'] = df['tipo'].astype(str)
+
+    return df.reset_index(drop=True)
+
+
+def _rutas_cache(ruta):
+    clave = hashlib.sha1(os.path.abspath(ruta).encode()).hexdigest()[:16]
+    base = os.path.join(DIRECTORIO_CACHE, f"pluviometros_{clave}")
+    return base + '.json', base
+
+
+def _guardar_cache(df, ruta, firma):
+    ruta_meta, base = _rutas_cache(ruta)
+    os.makedirs(DIRECTORIO_CACHE, exist_ok=True)
+
+    try:
+        datos = base + '.parquet'
+        df.to_parquet(datos, index=False)
+    except ImportError:
+        datos = base + '.pkl'
+        df.to_pickle(datos)
+
+    with open(ruta_meta, 'w', encoding='utf-8') as f:
+        json.dump(dict(firma, datos=datos, origen=os.path.abspath(ruta)), f)
+
+
+def _leer_cache(ruta, firma):
+    """Tabla cacheada si corresponde al mismo archivo; None si no hay o está obsoleta"""
+    ruta_meta, _ = _rutas_cache(ruta)
+    if not os.path.exists(ruta_meta):
+        return None
+
+    with open(ruta_meta, encoding='utf-8') as f:
+        meta = json.load(f)
+
+    # Misma fecha y tamaño: no hace falta ni calcular el hash
+    vigente = meta['mtime'] == firma['mtime'] and meta['tamano'] == firma['tamano']
+    if not vigente:
+        firma['hash'] = _hash_archivo(ruta)
+        vigente = meta.get('hash') == firma['hash']
+    if not vigente or not os.path.exists(meta['datos']):
+        return None
+
+    if meta['mtime'] != firma['mtime']:
+        # Archivo tocado pero idéntico: se actualiza la firma para la próxima vez
+        meta.update(firma)
+        with open(ruta_meta, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+    if meta['datos'].endswith('.parquet'):
+        return pd.read_parquet(meta['datos'])
+    return pd.read_pickle(meta['datos'])
+
+
+def cargar_tabla(ruta, log=print):
+    """Tabla limpia de pluviómetros (DataFrame), desde la caché si el archivo no cambió"""
+    estado = os.stat(ruta)
+    firma = {'mtime': estado.st_mtime_ns, 'tamano': estado.st_size}
+    clave = os.path.abspath(ruta)
+
+    en_memoria = _memoria.get(clave)
+    if en_memoria is not None and en_memoria[0] == firma:
+        log("Tabla de pluviómetros en memoria")
+        return en_memoria[1].copy()
+
+    df = None
+    if DIRECTORIO_CACHE is not None:
+        df = _leer_cache(ruta, dict(firma))
+        if df is not None:
+            log("Tabla de pluviómetros leída de la caché")
+
+    if df is None:
+        original, con_cabecera = _leer_original(ruta, log)
+        df = limpiar_tabla(original, con_cabecera, log=log)
+        # Parquet/Feather ya son columnares: solo se cachean Excel y CSV
+        if DIRECTORIO_CACHE is not None and con_cabecera:
+            firma['hash'] = _hash_archivo(ruta)
+            _guardar_cache(df, ruta, firma)
+
+    _memoria[clave] = ({'mtime': firma['mtime'], 'tamano': firma['tamano']}, df)
+    return df.copy()
@@ -0,0 +1,219 @@
+"""Ingesta de barridos polares (acimut × distancia) sobre la rejilla cartesiana del radar.
+
+El radar entrega barridos en coordenadas polares. Para llevarlos a la
+rejilla x/y de ``geometria`` se precalcula una matriz dispersa
+(píxeles × celdas polares) con los pesos de interpolación bilineal en
+acimut y distancia; cada barrido nuevo es entonces un único producto
+matriz dispersa-vector.
+
+Los acimuts reales varían unas centésimas de grado entre barridos, así que
+los rayos se asignan a acimuts nominales (paso y desfase estimados del
+propio barrido) y la matriz se construye una vez por configuración del
+radar (rayos, celdas, elevación), cacheada con la geometría.
+
+Formatos reconocidos en NetCDF:
+- Variable (acimut, distancia) con coordenadas ``azimuth``/``range``.
+- CfRadial: variable (time, range) con ``azimuth`` por rayo y barridos
+  delimitados por ``sweep_start_ray_index``/``sweep_end_ray_index``.
+"""
+import numpy as np
+from scipy import sparse
+
+from geometria import huella_puntos
+
+# Nombres habituales de las dimensiones y coordenadas polares
+NOMBRES_DISTANCIA = ('range', 'rango', 'distancia', 'bin', 'gate')
+NOMBRES_ACIMUT = ('azimuth', 'azimut', 'acimut', 'ray')
+NOMBRES_ELEVACION = ('elevation', 'elevacion', 'fixed_angle')
+
+# Radio efectivo de la Tierra para la propagación estándar (modelo 4/3)
+RADIO_EFECTIVO_KM = 4.0 / 3.0 * 6371.0
+
+METODOS_REGRILLADO = ('bilineal', 'vecino')
+
+# Matrices ya montadas en este proceso: (clave geometría, nombre) -> matriz CSR
+_matrices = {}
+
+
+def _buscar(nombres, candidatos):
+    for nombre in candidatos:
+        if nombre in nombres:
+            return nombre
+    return None
+
+
+def dimensiones_polares(ds):
+    """(variable, dim. de rayos, dim. de distancia) del primer campo polar, o None si no lo hay"""
+    for var in ds.data_vars:
+        dims = ds[var].dims
+        if len(dims) != 2:
+            continue
+        dim_distancia = _buscar(dims, NOMBRES_DISTANCIA)
+        if dim_distancia is None:
+            continue
+        dim_rayos = _buscar(dims, NOMBRES_ACIMUT)
+        # CfRadial: los rayos van a lo largo de 'time' y el acimut es una variable por rayo
+        if dim_rayos is None and 'time' in dims and _buscar(ds.variables, NOMBRES_ACIMUT):
+            dim_rayos = 'time'
+        if dim_rayos is not None:
+            return var, dim_rayos, dim_distancia
+    return None
+
+
+def es_polar(ds):
+    return dimensiones_polares(ds) is not None
+
+
+def _distancias_km(ds, dim_distancia):
+    distancias = np.asarray(ds[dim_distancia].values, dtype=float)
+    unidades = str(ds[dim_distancia].attrs.get('units', '')).strip().lower()
+    if unidades in ('m', 'meters', 'metres', 'metros') or (not unidades and distancias.max() > 2000):
+        distancias = distancias / 1000.0
+    return distancias
+
+
+def leer_barrido(ds, barrido=0):
+    """Datos, acimuts (°), distancias oblicuas (km) y elevación (°) de un barrido del dataset"""
+    var, dim_rayos, dim_distancia = dimensiones_polares(ds)
+    campo = ds[var].transpose(dim_rayos, dim_distancia)
+    acimuts = np.asarray(ds[_buscar(ds.variables, NOMBRES_ACIMUT)].values, dtype=float)
+
+    nombre_elevacion = _buscar(ds.variables, NOMBRES_ELEVACION)
+    elevaciones = (np.asarray(ds[nombre_elevacion].values, dtype=float) if nombre_elevacion
+                   else np.zeros(1))
+
+    rayos = slice(None)
+    if 'sweep_start_ray_index' in ds.variables:
+        inicios = np.atleast_1d(ds['sweep_start_ray_index'].values)
+        fines = np.atleast_1d(ds['sweep_end_ray_index'].values)
+        if barrido >= len(inicios):
+            raise ValueError(f"El archivo tiene {len(inicios)} barridos; no existe el barrido {barrido}")
+        rayos = slice(int(inicios[barrido]), int(fines[barrido]) + 1)
+        if nombre_elevacion == 'fixed_angle':
+            elevaciones = np.atleast_1d(elevaciones)[barrido:barrido + 1]
+        elif elevaciones.size > 1:
+            elevaciones = elevaciones[rayos]
+
+    datos = np.asarray(campo.isel({dim_rayos: rayos}).values, dtype=float)
+    if acimuts.size == campo.sizes[dim_rayos]:
+        acimuts = acimuts[rayos]
+
+    return {
+        'variable': var,
+        'datos': datos,
+        'acimuts': acimuts % 360.0,
+        'distancias_km': _distancias_km(ds, dim_distancia),
+        'elevacion': float(np.nanmean(elevaciones)) if elevaciones.size else 0.0,
+        'unidades': campo.attrs.get('units', ''),
+    }
+
+
+def distancia_suelo_km(distancias_km, elevacion):
+    """Distancia sobre el suelo de cada celda a partir de su distancia oblicua (modelo 4/3)"""
+    s = np.asarray(distancias_km, dtype=float)
+    theta = np.radians(elevacion)
+    altura = np.sqrt(s ** 2 + RADIO_EFECTIVO_KM ** 2 + 2 * s * RADIO_EFECTIVO_KM * np.sin(theta)) - RADIO_EFECTIVO_KM
+    return RADIO_EFECTIVO_KM * np.arcsin(s * np.cos(theta) / (RADIO_EFECTIVO_KM + altura))
+
+
+def acimuts_nominales(acimuts):
+    """(número de rayos, paso, desfase) nominales de un barrido a partir de sus acimuts reales"""
+    ordenados = np.sort(acimuts)
+    saltos = np.diff(ordenados)
+    n = int(round(360.0 / float(np.median(saltos[saltos > 0]))))
+    paso = 360.0 / n
+    # Fase circular de los acimuts módulo el paso: robusta a rayos que faltan y al cruce por 0°
+    fase = np.angle(np.mean(np.exp(1j * np.radians(acimuts) * n)))
+    desfase = round(float(np.degrees(fase) / n) % paso, 2) % paso
+    return n, paso, desfase
+
+
+def ordenar_rayos(datos, acimuts, n, paso, desfase):
+    """Rayos reordenados en los ``n`` acimuts nominales; los que faltan quedan en NaN"""
+    nominal = np.rint((acimuts - desfase) / paso).astype(np.intp) % n
+    ordenados = np.full((n, datos.shape[1]), np.nan)
+    ordenados[nominal] = datos
+    return ordenados
+
+
+def _construir_matriz(geometria, n, paso, desfase, distancias_suelo, metodo):
+    xx, yy = np.meshgrid(geometria.x, geometria.y)
+    # En la acimutal equidistante del sitio, distancia y acimut desde el radar son exactos
+    d = np.hypot(xx, yy).ravel()
+    acimut = np.degrees(np.arctan2(xx, yy)).ravel() % 360.0
+
+    n_celdas = len(distancias_suelo)
+    fg = np.interp(d, distancias_suelo, np.arange(n_celdas, dtype=float))
+    medio = (distancias_suelo[-1] - distancias_suelo[0]) / max(n_celdas - 1, 1) / 2
+    dentro = (d >= distancias_suelo[0] - medio) & (d <= distancias_suelo[-1] + medio)
+    fa = ((acimut - desfase) / paso) % n
+
+    pixeles = np.flatnonzero(dentro)
+    fg = fg[dentro]
+    fa = fa[dentro]
+
+    if metodo == 'vecino':
+        rayo = np.rint(fa).astype(np.intp) % n
+        celda = np.rint(fg).astype(np.intp)
+        filas, columnas, pesos = pixeles, rayo * n_celdas + celda, np.ones(len(pixeles))
+    else:
+        r0 = np.floor(fa).astype(np.intp)
+        t = fa - r0
+        r1 = (r0 + 1) % n
+        g0 = np.clip(np.floor(fg).astype(np.intp), 0, max(n_celdas - 2, 0))
+        u = np.clip(fg - g0, 0.0, 1.0)
+        g1 = np.minimum(g0 + 1, n_celdas - 1)
+        filas = np.tile(pixeles, 4)
+        columnas = np.concatenate([r0 * n_celdas + g0, r0 * n_celdas + g1, r1 * n_celdas + g0, r1 * n_celdas + g1])
+        pesos = np.concatenate([(1 - t) * (1 - u), (1 - t) * u, t * (1 - u), t * u])
+
+    matriz = sparse.csr_matrix((pesos, (filas, columnas)), shape=(d.size, n * n_celdas))
+    return {'datos': matriz.data, 'indices': matriz.indices, 'punteros': matriz.indptr,
+            'forma': np.array(matriz.shape)}
+
+
+def matriz_regrillado(geometria, n, paso, desfase, distancias_km, elevacion, metodo='bilineal'):
+    """Matriz dispersa (píxeles × rayos·celdas) de una configuración polar, cacheada con la geometría"""
+    if metodo not in METODOS_REGRILLADO:
+        raise ValueError(f"Método de regrillado desconocido: {metodo} "
+                         f"(opciones: {', '.join(METODOS_REGRILLADO)})")
+
+    huella = huella_puntos(distancias_km, [n, desfase, round(elevacion, 1)])
+    nombre = f"polar|{metodo}|{huella}"
+    clave = (geometria.clave, nombre)
+    if clave not in _matrices:
+        suelo = distancia_suelo_km(distancias_km, elevacion)
+        partes = geometria.arrays(nombre, lambda g: _construir_matriz(g, n, paso, desfase, suelo, metodo))
+        _matrices[clave] = sparse.csr_matrix((partes['datos'], partes['indices'], partes['punteros']),
+                                             shape=tuple(partes['forma']))
+    return _matrices[clave]
+
+
+def regrillar(matriz, ordenados, forma):
+    """Campo (Y, X) a partir de los rayos en orden nominal: un producto disperso por barrido.
+
+    Las celdas sin dato no cuentan: los pesos se renormalizan con los vecinos válidos.
+    """
+    valores = ordenados.ravel()
+    validos = np.isfinite(valores)
+    # Valores y pesos válidos en dos columnas: la misma pasada por la matriz da ambos
+    suma, peso = (matriz @ np.column_stack([np.where(validos, valores, 0.0), validos])).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        campo = np.where(peso > 1e-9, suma / peso, np.nan)
+    return campo.reshape(forma)
+
+
+def forma_cartesiana(distancias_km, elevacion, resolucion_km):
+    """Forma (Y, X) de la rejilla que cubre el alcance del barrido, con el radar en el píxel central"""
+    alcance = float(distancia_suelo_km(distancias_km[-1:], elevacion)[0])
+    n = 2 * int(np.ceil(alcance / resolucion_km)) + 1
+    return n, n
+
+
+def barrido_a_rejilla(barrido, geometria, metodo='bilineal'):
+    """Campo cartesiano (Y, X) de la geometría a partir de un barrido de ``leer_barrido``"""
+    n, paso, desfase = acimuts_nominales(barrido['acimuts'])
+    matriz = matriz_regrillado(geometria, n, paso, desfase, barrido['distancias_km'],
+                               barrido['elevacion'], metodo)
+    ordenados = ordenar_rayos(barrido['datos'], barrido['acimuts'], n, paso, desfase)
+    return regrillar(matriz, ordenados, geometria.forma)
@@ -0,0 +1,315 @@
+"""Productos de datos del campo corregido, además del mapa PNG.
+
+El campo de precipitación corregido se guarda en formatos que los modelos
+hidrológicos pueden leer por trozos sin repetir la fusión:
+
+- NetCDF4 (``.nc``): comprimido (zlib + shuffle), en bloques de
+  ``BLOQUE_ESPACIAL`` píxeles por paso de tiempo, con coordenadas CF
+  (ejes x/y en km de la proyección acimutal equidistante del radar, lat/lon
+  de cada píxel como coordenadas auxiliares) y dimensión ``time`` ilimitada.
+- Zarr (``.zarr``): los mismos datos y metadatos en un almacén por bloques
+  (necesita el paquete ``zarr``).
+- GeoTIFF (``.tif``): un raster por escaneo, en teselas comprimidas y como
+  COG si GDAL lo permite (necesita ``rasterio``).
+- Archivo de campos (``.arch``): float32 en memoria mapeada, transpuesto por
+  bloques para leer series temporales por píxel (ver ``archivo``).
+
+NetCDF, Zarr y el archivo de campos son acumulables: cada escaneo nuevo se añade como un paso más
+de ``time`` y, si ese instante ya estaba, lo sustituye. Un escaneo anterior al último guardado se
+rechaza en los tres formatos, para que ``time`` quede siempre ordenado.
+
+Ejemplo:
+    python fusion_cli.py lluvia8junio.nc lluvia.xls --producto serie.nc --producto lluvia.tif
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from geometria import geometria_de
+
+# Extensión del archivo -> formato
+FORMATOS = {
+    '.nc': 'netcdf',
+    '.nc4': 'netcdf',
+    '.zarr': 'zarr',
+    '.tif': 'geotiff',
+    '.tiff': 'geotiff',
+    '.arch': 'archivo',
+}
+
+# Píxeles por lado de cada bloque (NetCDF/Zarr) y tesela (GeoTIFF)
+BLOQUE_ESPACIAL = 256
+
+NIVEL_COMPRESION = 4
+
+UNIDADES_TIEMPO = 'seconds since 1970-01-01 00:00:00'
+
+VARIABLE = 'precipitacion'
+
+
+def formato_de(ruta):
+    """Formato del producto según la extensión de ``ruta``"""
+    extension = os.path.splitext(ruta.rstrip('/\\'))[1].lower()
+    if extension not in FORMATOS:
+        raise ValueError(f"Formato de producto no reconocido: {ruta} "
+                         f"(extensiones: {', '.join(FORMATOS)})")
+    return FORMATOS[extension]
+
+
+def tiempo_campo(campo_da):
+    """Instante del campo: fin de la ventana acumulada o hora del escaneo"""
+    for clave in ('fin', 'tiempo'):
+        if campo_da.attrs.get(clave):
+            return pd.Timestamp(campo_da.attrs[clave])
+    raise ValueError("El campo no tiene hora de escaneo; indique el tiempo del producto")
+
+
+def _mapeo_rejilla(geometria):
+    """Atributos CF de la proyección acimutal equidistante del radar"""
+    from pyproj import CRS
+
+    centro_lon, centro_lat = geometria.centro
+    return {
+        'grid_mapping_name': 'azimuthal_equidistant',
+        'longitude_of_projection_origin': centro_lon,
+        'latitude_of_projection_origin': centro_lat,
+        'false_easting': 0.0,
+        'false_northing': 0.0,
+        'semi_major_axis': 6378137.0,
+        'inverse_flattening': 298.257223563,
+        'crs_wkt': CRS.from_proj4(geometria.proyeccion).to_wkt(),
+    }
+
+
+def conjunto_producto(campo_da, tiempo=None, lonlat=True):
+    """Dataset CF (time, y, x) de un paso, en float32 y en la rejilla nativa del radar.
+
+    Con ``lonlat`` se incluyen lat/lon de cada píxel como coordenadas auxiliares.
+    """
+    geometria = geometria_de(campo_da)
+    tiempo = tiempo_campo(campo_da) if tiempo is None else pd.Timestamp(tiempo)
+    datos = np.asarray(campo_da.values, dtype=np.float32)[np.newaxis]
+
+    atributos = {
+        'long_name': 'Precipitación radar corregida con pluviómetros',
+        'standard_name': 'lwe_thickness_of_precipitation_amount',
+        'units': campo_da.attrs.get('units', 'mm'),
+        'grid_mapping': 'crs',
+    }
+    if campo_da.attrs.get('metodo_correccion'):
+        atributos['metodo_correccion'] = campo_da.attrs['metodo_correccion']
+    if campo_da.attrs.get('ventana'):
+        atributos['cell_methods'] = f"time: sum (interval: {campo_da.attrs['ventana']})"
+
+    ds = xr.Dataset(
+        {
+            VARIABLE: (('time', 'y', 'x'), datos, atributos),
+            'crs': ((), np.int32(0), _mapeo_rejilla(geometria)),
+        },
+        coords={
+            'time': ('time', [tiempo], {'standard_name': 'time', 'axis': 'T'}),
+            'y': ('y', geometria.y, {'standard_name': 'projection_y_coordinate', 'units': 'km', 'axis': 'Y'}),
+            'x': ('x', geometria.x, {'standard_name': 'projection_x_coordinate', 'units': 'km', 'axis': 'X'}),
+        },
+        attrs={
+            'Conventions': 'CF-1.8',
+            'title': 'Precipitación radar-pluviómetros',
+            'source': 'Radar de Camagüey corregido con pluviómetros',
+            'history': f"{datetime.now().isoformat(timespec='seconds')} fusión radar-pluviómetros",
+            'centro_radar': np.asarray(geometria.centro, dtype=np.float64),
+            'resolucion_km': geometria.resolucion_km,
+        }
+    )
+    if lonlat:
+        ds = ds.assign_coords(
+            lat=(('y', 'x'), geometria.lat, {'standard_name': 'latitude', 'units': 'degrees_north'}),
+            lon=(('y', 'x'), geometria.lon, {'standard_name': 'longitude', 'units': 'degrees_east'}),
+        )
+    return ds
+
+
+def _bloques(forma):
+    ny, nx = forma
+    return 1, min(BLOQUE_ESPACIAL, ny), min(BLOQUE_ESPACIAL, nx)
+
+
+def _comprobar_rejilla(x, y, centro, ds):
+    if (len(x) != ds.sizes['x'] or len(y) != ds.sizes['y']
+            or not np.allclose(x, ds['x'].values) or not np.allclose(y, ds['y'].values)
+            or not np.allclose(centro, ds.attrs['centro_radar'])):
+        raise ValueError("La rejilla del campo no coincide con la del producto existente")
+
+
+def _comprobar_orden(tiempos, tiempo, ruta):
+    if len(tiempos) and tiempo not in tiempos and tiempo < max(tiempos):
+        raise ValueError(f"{ruta} solo admite pasos posteriores al último ({max(tiempos)}); "
+                         f"el campo es de {tiempo}")
+
+
+def tiempos_guardados(ruta):
+    """Pasos de ``time`` ya guardados en un producto acumulable (vacío si no existe)"""
+    formato = formato_de(ruta)
+    if formato == 'archivo':
+        if not os.path.exists(os.path.join(ruta, 'indice.json')):
+            return pd.DatetimeIndex([])
+        import archivo
+
+        return archivo.ArchivoCampos(ruta).tiempos
+    if formato == 'geotiff' or not os.path.exists(ruta):
+        return pd.DatetimeIndex([])
+    with (xr.open_zarr(ruta) if formato == 'zarr' else xr.open_dataset(ruta)) as existente:
+        # ``time`` va en segundos float64: al decodificar queda ruido por debajo del microsegundo
+        return pd.DatetimeIndex(existente['time'].values).round('us')
+
+
+def comprobar_producto(ruta, tiempo):
+    """Error si el paso ``tiempo`` no puede añadirse a ``ruta`` sin desordenar su ``time``"""
+    _comprobar_orden(tiempos_guardados(ruta), pd.Timestamp(tiempo), ruta)
+
+
+def escribir_netcdf(ds, ruta):
+    """Crea el NetCDF4 o añade el paso de ``ds`` a la dimensión ``time`` existente"""
+    if not os.path.exists(ruta):
+        ds.to_netcdf(ruta, format='NETCDF4', unlimited_dims=['time'], encoding={
+            VARIABLE: {'zlib': True, 'complevel': NIVEL_COMPRESION, 'shuffle': True,
+                       'chunksizes': _bloques(ds[VARIABLE].shape[1:]), '_FillValue': np.float32(np.nan)},
+            'time': {'units': UNIDADES_TIEMPO, 'calendar': 'standard', 'dtype': 'float64'},
+            'x': {'_FillValue': None},
+            'y': {'_FillValue': None},
+            'lat': {'_FillValue': None, 'zlib': True, 'chunksizes': _bloques(ds['lat'].shape)[1:]},
+            'lon': {'_FillValue': None, 'zlib': True, 'chunksizes': _bloques(ds['lon'].shape)[1:]},
+        })
+        return ruta
+
+    import netCDF4
+
+    with netCDF4.Dataset(ruta, 'a') as nc:
+        _comprobar_rejilla(nc['x'][:], nc['y'][:], nc.getncattr('centro_radar'), ds)
+        tiempos = nc['time']
+        calendario = getattr(tiempos, 'calendar', 'standard')
+        tiempo = pd.Timestamp(ds['time'].values[0]).to_pydatetime()
+        guardados = netCDF4.num2date(tiempos[:], tiempos.units, calendario, only_use_cftime_datetimes=False,
+                                     only_use_python_datetimes=True) if len(tiempos) else []
+        # Un escaneo repetido sustituye a su paso; uno nuevo va al final
+        _comprobar_orden(guardados, tiempo, ruta)
+        existentes = [i for i, guardado in enumerate(guardados) if guardado == tiempo]
+        indice = existentes[0] if existentes else len(tiempos)
+        # En las unidades del propio archivo, por si otra herramienta lo creó
+        tiempos[indice] = netCDF4.date2num(tiempo, tiempos.units, calendario)
+        nc[VARIABLE][indice, :, :] = ds[VARIABLE].values[0]
+        nc.history = f"{nc.history}\n{ds.attrs['history']}" if 'history' in nc.ncattrs() else ds.attrs['history']
+    return ruta
+
+
+def escribir_zarr(ds, ruta):
+    """Crea el almacén Zarr o añade el paso de ``ds`` a lo largo de ``time``"""
+    try:
+        import zarr  # noqa: F401
+    except ImportError:
+        raise ImportError("Para productos Zarr instale el paquete 'zarr'") from None
+
+    if not os.path.exists(ruta):
+        ds.to_zarr(ruta, mode='w-', encoding={
+            VARIABLE: {'chunks': _bloques(ds[VARIABLE].shape[1:])},
+            'time': {'units': UNIDADES_TIEMPO, 'calendar': 'standard', 'dtype': 'float64'},
+        })
+        return ruta
+
+    with xr.open_zarr(ruta) as existente:
+        _comprobar_rejilla(existente['x'].values, existente['y'].values, existente.attrs['centro_radar'], ds)
+    tiempos = tiempos_guardados(ruta)
+
+    tiempo = pd.Timestamp(ds['time'].values[0])
+    if tiempo in tiempos:
+        # Sustituir el paso ya guardado escribiendo solo su región
+        indice = tiempos.get_loc(tiempo)
+        ds[[VARIABLE]].drop_vars(['x', 'y', 'lat', 'lon']).to_zarr(ruta, region={'time': slice(indice, indice + 1)})
+    else:
+        _comprobar_orden(tiempos, tiempo, ruta)
+        ds[[VARIABLE]].drop_vars(['lat', 'lon']).to_zarr(ruta, append_dim='time')
+    return ruta
+
+
+def escribir_geotiff(ds, ruta):
+    """GeoTIFF en teselas comprimidas del paso de ``ds`` (COG si GDAL tiene el controlador)"""
+    try:
+        import rasterio
+        import rasterio.shutil
+        from rasterio.io import MemoryFile
+        from rasterio.transform import from_bounds
+    except ImportError:
+        raise ImportError("Para productos GeoTIFF instale el paquete 'rasterio'") from None
+
+    datos = ds[VARIABLE].values[0]
+    x = ds['x'].values
+    y = ds['y'].values
+    # GeoTIFF va de norte a sur y de oeste a este
+    if y[0] < y[-1]:
+        datos = datos[::-1]
+    if x[0] > x[-1]:
+        datos = datos[:, ::-1]
+
+    # Misma proyección del radar, en metros como esperan los SIG
+    medio_x = abs(x[-1] - x[0]) / max(len(x) - 1, 1) / 2
+    medio_y = abs(y[-1] - y[0]) / max(len(y) - 1, 1) / 2
+    transformacion = from_bounds(1000.0 * float(x.min() - medio_x), 1000.0 * float(y.min() - medio_y),
+                                 1000.0 * float(x.max() + medio_x), 1000.0 * float(y.max() + medio_y),
+                                 len(x), len(y))
+    crs = ds['crs'].attrs
+    proyeccion = (f"+proj=aeqd +lat_0={crs['latitude_of_projection_origin']} "
+                  f"+lon_0={crs['longitude_of_projection_origin']} +datum=WGS84 +units=m +no_defs")
+    perfil = {
+        'driver': 'GTiff', 'width': len(x), 'height': len(y), 'count': 1, 'dtype': 'float32',
+        'crs': proyeccion, 'transform': transformacion, 'nodata': np.nan,
+    }
+    opciones = {'compress': 'DEFLATE', 'predictor': 3, 'blocksize': BLOQUE_ESPACIAL}
+    etiquetas = {'units': ds[VARIABLE].attrs['units'], 'time': str(pd.Timestamp(ds['time'].values[0]))}
+
+    with MemoryFile() as memoria:
+        with memoria.open(**perfil) as temporal:
+            temporal.write(datos, 1)
+            temporal.update_tags(**etiquetas)
+        with memoria.open() as temporal, rasterio.Env() as entorno:
+            if 'COG' in entorno.drivers():
+                rasterio.shutil.copy(temporal, ruta, driver='COG', **opciones)
+            else:
+                rasterio.shutil.copy(temporal, ruta, driver='GTiff', tiled=True,
+                                     blockxsize=BLOQUE_ESPACIAL, blockysize=BLOQUE_ESPACIAL,
+                                     compress='DEFLATE', predictor=3)
+    return ruta
+
+
+def escribir_archivo(ds, ruta):
+    """Añade el paso al archivo de campos en memoria mapeada (lo crea si no existe)"""
+    import archivo
+
+    campo = ds[VARIABLE]
+    destino = archivo.abrir_o_crear(ruta, ds.attrs['centro_radar'], ds.attrs['resolucion_km'],
+                                    campo.shape[1:], unidades=campo.attrs.get('units', 'mm'))
+    destino.agregar(campo.values[0], pd.Timestamp(ds['time'].values[0]))
+
+
+ESCRITORES = {
+    'netcdf': escribir_netcdf,
+    'zarr': escribir_zarr,
+    'geotiff': escribir_geotiff,
+    'archivo': escribir_archivo,
+}
+
+
+def guardar_producto(campo_da, ruta, tiempo=None, log=print):
+    """Guarda (o añade) el campo corregido 2D en ``ruta``; el formato sale de la extensión"""
+    if campo_da.ndim != 2:
+        raise ValueError("Los productos se escriben paso a paso a partir de un campo 2D")
+
+    formato = formato_de(ruta)
+    ds = conjunto_producto(campo_da, tiempo, lonlat=formato not in ('geotiff', 'archivo'))
+    directorio = os.path.dirname(os.path.abspath(ruta))
+    os.makedirs(directorio, exist_ok=True)
+
+    ESCRITORES[formato](ds, ruta)
+    log(f"Producto {formato} guardado en: {ruta} ({pd.Timestamp(ds['time'].values[0])})")
+    return ruta
@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 from matplotlib.patches import Rectangle
+from capas import dibujar_limites
 
 def cargar_datos_pluviometros(ruta_archivo):
     """Carga y procesa los datos de pluviómetros desde un archivo Excel"""
@@ -42,29 +43,9 @@ def plotear_mapa_camaguey(gdf, titulo="Precipitación en Pluviómetros"):
         # Define los límites del mapa manualmente
         ax.set_extent([-78.8, -76.8, 20.5, 22.0])  # Ajusta según Camagüey
 
-        # -- Intento 1: Usar shapefiles locales --
+        # -- Intento 1: Usar shapefiles locales (almacén de capas) --
         try:
-            # Cargar shapefile de Cuba
-            cuba = gpd.read_file('cu_shp/cuba.shp')
-            cuba.boundary.plot(ax=ax, linewidth=1, edgecolor='gray')
-            
-            # Intentar resaltar Camagüey (prueba con diferentes nombres de campo)
-            nombres_posibles = ['NAME_1', 'name_1', 'NAM', 'nombre', 'provincia']
-            encontrado = False
-            
-            for nombre in nombres_posibles:
-                if nombre in cuba.columns:
-                    try:
-                        camaguey = cuba[cuba[nombre].str.contains('Camagüey|Camaguey', case=False, regex=True)]
-                        if not camaguey.empty:
-                            camaguey.plot(ax=ax, color='none', edgecolor='red', linewidth=2)
-                            encontrado = True
-                            break
-                    except:
-                        continue
-            
-            if not encontrado:
-                print("No se pudo identificar Camagüey en el shapefile")
+            if not dibujar_limites(ax, [-78.8, -76.8, 20.5, 22.0], resaltar='Camagüey'):
                 # Dibujar un rectángulo aproximado para Camagüey
                 ax.add_patch(Rectangle((-78.5, 20.7), 1.7, 1.3, 
                                     fill=False, color='red', linewidth=2, 
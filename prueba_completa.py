@@ -12,6 +12,9 @@ import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 from matplotlib.patches import Rectangle
 import os
+from muestreo import indices_pixel_cercano
+from capas import dibujar_limites
+from geometria import geometria_de, obtener_geometria
 
 class RadarLluviaApp:
     def __init__(self, root):
@@ -203,21 +206,30 @@ class RadarLluviaApp:
         self.canvas.draw()
     
     def calculate_comparison_stats(self):
-        # Interpolar datos de radar a ubicaciones de pluviómetros
-        radar_values = []
-        
-        for idx, row in self.gdf_pluv.iterrows():
-            # Encontrar el píxel más cercano en los datos del radar
-            dist = (self.da_radar.lon - row['longitud'])**2 + (self.da_radar.lat - row['latitud'])**2
-            y_idx, x_idx = np.unravel_index(dist.argmin(), dist.shape)
-            radar_values.append(float(self.da_radar.values[y_idx, x_idx]))
+        # Píxel de radar más cercano a cada pluviómetro (todas las estaciones a la vez),
+        # buscado en la rejilla x/y del radar como en la fusión
+        geometria = geometria_de(self.da_radar)
+        x_pluv, y_pluv = geometria.proyectar(
+            self.gdf_pluv['longitud'].values.astype(float),
+            self.gdf_pluv['latitud'].values.astype(float)
+        )
+        iy, ix, dentro = indices_pixel_cercano(geometria.x, geometria.y, x_pluv, y_pluv)
+        radar_values = np.full(len(self.gdf_pluv), np.nan)
+        radar_values[dentro] = self.da_radar.values[iy[dentro], ix[dentro]]
         
-        # Crear DataFrame de comparación
+        # Crear DataFrame de comparación (las estaciones fuera del radar quedan con NaN)
         self.comparison_data = pd.DataFrame({
-            'Pluviometro': self.gdf_pluv['precipitacion'],
+            'Longitud': self.gdf_pluv['longitud'].values,
+            'Latitud': self.gdf_pluv['latitud'].values,
+            'Pluviometro': self.gdf_pluv['precipitacion'].values,
             'Radar': radar_values,
-            'Diferencia': self.gdf_pluv['precipitacion'] - radar_values
+            'Diferencia': self.gdf_pluv['precipitacion'].values - radar_values,
+            'Dentro_dominio': dentro
         })
+        fuera = self.comparison_data[~dentro]
+        if not fuera.empty:
+            print(f"Estaciones fuera del dominio del radar: {len(fuera)}")
+            print(fuera[['Longitud', 'Latitud', 'Pluviometro']].to_string(index=False))
         
         # Mostrar estadísticas en una ventana nueva
         stats_window = tk.Toplevel(self.root)
@@ -234,6 +246,8 @@ class RadarLluviaApp:
         ttk.Label(stats_window, text=f"Error Absoluto Medio (MAE): {mae:.2f} mm").pack(pady=5)
         ttk.Label(stats_window, text=f"Raíz del Error Cuadrático Medio (RMSE): {rmse:.2f} mm").pack(pady=5)
         ttk.Label(stats_window, text=f"Correlación: {correlation:.2f}").pack(pady=5)
+        if not fuera.empty:
+            ttk.Label(stats_window, text=f"Estaciones fuera del dominio del radar (excluidas): {len(fuera)}").pack(pady=5)
         
         # Botón para guardar resultados
         ttk.Button(stats_window, text="Guardar Resultados", 
@@ -262,27 +276,9 @@ class RadarLluviaApp:
         self.ax.clear()
         self.ax.set_extent([-78.8, -76.8, 20.5, 22.0])  # Ajustado para Camagüey
         
-        # Intentar cargar shapefile de Cuba
+        # Límites de Cuba desde el almacén de capas (leídos y simplificados una sola vez)
         try:
-            cuba = gpd.read_file('cu_shp/cg.shp')
-            cuba.boundary.plot(ax=self.ax, linewidth=1, edgecolor='gray')
-            
-            # Resaltar Camagüey
-            nombres_posibles = ['NAME_1', 'name_1', 'NAM', 'nombre', 'provincia']
-            encontrado = False
-            
-            for nombre in nombres_posibles:
-                if nombre in cuba.columns:
-                    try:
-                        camaguey = cuba[cuba[nombre].str.contains('Camagüey|Camaguey', case=False, regex=True)]
-                        if not camaguey.empty:
-                            camaguey.plot(ax=self.ax, color='none', edgecolor='red', linewidth=2)
-                            encontrado = True
-                            break
-                    except:
-                        continue
-            
-            if not encontrado:
+            if not dibujar_limites(self.ax, [-78.8, -76.8, 20.5, 22.0], resaltar='Camagüey'):
                 # Dibujar un rectángulo aproximado para Camagüey
                 self.ax.add_patch(Rectangle((-78.5, 20.7), 1.7, 1.3, 
                                  fill=False, color='red', linewidth=2, 
@@ -335,31 +331,25 @@ class RadarLluviaApp:
     
     def cargar_datos_radar(self, ruta_archivo, centro_lon=-77.849, centro_lat=21.4227, resolucion_km=1.0):
         """Carga y procesa los datos de radar desde un archivo NetCDF"""
-        ds = xr.open_dataset(ruta_archivo)
-        
-        # Detectar variable de precipitación
-        var_precip = 'Ra'  # Según tu output, la variable es 'Ra'
-        
-        # Convertir resolución de km a grados (aproximadamente)
-        resolucion_grados = resolucion_km / 111.32
-        
-        # Calcular rangos
-        rango_lon = (ds.sizes['X'] * resolucion_grados) / 2
-        rango_lat = (ds.sizes['Y'] * resolucion_grados) / 2
-        
-        # Generar coordenadas
-        lon = np.linspace(centro_lon - rango_lon, centro_lon + rango_lon, ds.sizes['X'])
-        lat = np.linspace(centro_lat - rango_lat, centro_lat + rango_lat, ds.sizes['Y'])
-        
-        # Crear DataArray
-        da = xr.DataArray(
-            data=ds[var_precip].values,
-            dims=['Y', 'X'],
-            coords={
-                'lat': (['Y'], lat),
-                'lon': (['X'], lon)
-            }
-        )
+        with xr.open_dataset(ruta_archivo) as ds:
+            # Detectar variable de precipitación
+            var_precip = 'Ra'  # Según tu output, la variable es 'Ra'
+        
+            # Rejilla acimutal equidistante del sitio, la misma que usa la fusión
+            geometria = obtener_geometria(centro_lon, centro_lat, resolucion_km, (ds.sizes['Y'], ds.sizes['X']))
+        
+            # Crear DataArray (ejes x/y en km y lon/lat de cada píxel)
+            da = xr.DataArray(
+                data=ds[var_precip].values,
+                dims=['Y', 'X'],
+                coords={
+                    'y': (['Y'], geometria.y),
+                    'x': (['X'], geometria.x),
+                    'lat': (['Y', 'X'], geometria.lat),
+                    'lon': (['Y', 'X'], geometria.lon)
+                },
+                attrs={'centro': geometria.centro, 'resolucion_km': geometria.resolucion_km}
+            )
         
         return da
 
@@ -2,43 +2,38 @@ import matplotlib
 matplotlib.use('Agg')  # Backend no interactivo
 import matplotlib.pyplot as plt
 import xarray as xr
-import numpy as np
 import cartopy.crs as ccrs
-import geopandas as gpd
+from capas import dibujar_limites
+from geometria import obtener_geometria
 
 def cargar_datos_radar(ruta_archivo, centro_lon=-77.849, centro_lat=21.4227, resolucion_km=1.0):
     """Carga y procesa los datos de radar desde un archivo NetCDF"""
     try:
         print("\nCargando radar...")
-        ds = xr.open_dataset(ruta_archivo)
+        with xr.open_dataset(ruta_archivo) as ds:
+            # Detectar variable de precipitación (ajustado para tu archivo)
+            var_precip = 'Ra'  # Según tu output, la variable es 'Ra'
         
-        # Detectar variable de precipitación (ajustado para tu archivo)
-        var_precip = 'Ra'  # Según tu output, la variable es 'Ra'
+            # Rejilla acimutal equidistante del sitio, la misma que usa la fusión
+            geometria = obtener_geometria(centro_lon, centro_lat, resolucion_km, (ds.sizes['Y'], ds.sizes['X']))
         
-        # Convertir resolución de km a grados (aproximadamente)
-        resolucion_grados = resolucion_km / 111.32
-        
-        # Calcular rangos
-        rango_lon = (ds.sizes['X'] * resolucion_grados) / 2
-        rango_lat = (ds.sizes['Y'] * resolucion_grados) / 2
-        
-        # Generar coordenadas
-        lon = np.linspace(centro_lon - rango_lon, centro_lon + rango_lon, ds.sizes['X'])
-        lat = np.linspace(centro_lat - rango_lat, centro_lat + rango_lat, ds.sizes['Y'])
-        
-        # Crear DataArray
-        da = xr.DataArray(
-            data=ds[var_precip].values,
-            dims=['Y', 'X'],
-            coords={
-                'lat': (['Y'], lat),
-                'lon': (['X'], lon)
-            }
-        )
+            # Crear DataArray (ejes x/y en km y lon/lat de cada píxel)
+            da = xr.DataArray(
+                data=ds[var_precip].values,
+                dims=['Y', 'X'],
+                coords={
+                    'y': (['Y'], geometria.y),
+                    'x': (['X'], geometria.x),
+                    'lat': (['Y', 'X'], geometria.lat),
+                    'lon': (['Y', 'X'], geometria.lon)
+                },
+                attrs={'centro': geometria.centro, 'resolucion_km': geometria.resolucion_km}
+            )
         
+        lon_min, lon_max, lat_min, lat_max = geometria.extension_lonlat()
         print("\nCoordenadas generadas:")
-        print(f"Longitud: {lon.min():.4f} a {lon.max():.4f}")
-        print(f"Latitud: {lat.min():.4f} a {lat.max():.4f}")
+        print(f"Longitud: {lon_min:.4f} a {lon_max:.4f}")
+        print(f"Latitud: {lat_min:.4f} a {lat_max:.4f}")
         
         return da
             
@@ -55,14 +50,9 @@ def plotear_radar_camaguey(da_radar, output_file='precipitacion_camaguey.png'):
         # Configuración del mapa para Camagüey
         ax.set_extent([-78.8, -76.8, 20.5, 22.0])  # Ajustado para Camagüey
 
-        # -- Opción 1: Usar el shapefile de Cuba para el contorno --
+        # -- Opción 1: Usar el shapefile de Cuba para el contorno (almacén de capas) --
         try:
-            cuba = gpd.read_file('cu_shp/cuba.shp')
-            cuba.boundary.plot(ax=ax, linewidth=1, edgecolor='gray')
-            
-            # Resaltar Camagüey (ajusta 'NAME_1' según tu shapefile)
-            camaguey = cuba[cuba['NAME_1'] == 'Camagüey']
-            camaguey.plot(ax=ax, color='none', edgecolor='red', linewidth=2)
+            dibujar_limites(ax, [-78.8, -76.8, 20.5, 22.0], resaltar='Camagüey')
         except Exception as e:
             print(f"Error con shapefile: {e}")
             # -- Opción 2: Dibujar la costa manualmente (si no tienes shapefile) --
@@ -0,0 +1,133 @@
+"""Conversión de reflectividad (dBZ) a intensidad de lluvia con una relación Z-R.
+
+Z = a·R^b, con Z en mm⁶/m³ y R en mm/h, de modo que
+
+    R = (10^(dBZ/10) / a)^(1/b) = a^(-1/b) · exp(dBZ · ln10 / (10·b))
+
+La conversión trabaja en float32 y sobre el propio array del paso (un
+producto, una exponencial y otro producto in situ), así que convertir un
+cubo de reflectividad no crea temporales float64 del tamaño del campo; la
+acumulación (``acumulacion``) convierte cada paso según lo lee.
+
+Máscaras:
+- ``umbral_dbz``: por debajo no se considera lluvia (0 mm/h).
+- ``max_dbz``: tope para que el granizo no dispare la intensidad.
+- ``clutter``: píxeles (Y, X) de ecos fijos, que quedan sin dato (NaN).
+"""
+import numpy as np
+import xarray as xr
+
+# (a, b) de las relaciones habituales
+RELACIONES_ZR = {
+    'marshall-palmer': (200.0, 1.6),
+    'convectiva': (300.0, 1.4),
+}
+
+UMBRAL_DBZ = 7.0
+MAX_DBZ = 53.0
+
+UNIDADES_REFLECTIVIDAD = ('dbz', 'dbzh', 'dbz_h')
+
+
+class RelacionZR:
+    """Relación Z = a·R^b con sus máscaras de umbral, tope y clutter"""
+
+    def __init__(self, a=200.0, b=1.6, umbral_dbz=UMBRAL_DBZ, max_dbz=MAX_DBZ, clutter=None):
+        if a <= 0 or b <= 0:
+            raise ValueError(f"Los coeficientes de la relación Z-R deben ser positivos (a={a}, b={b})")
+        self.a = float(a)
+        self.b = float(b)
+        self.umbral_dbz = umbral_dbz
+        self.max_dbz = max_dbz
+        self.clutter = None if clutter is None else np.asarray(clutter, dtype=bool)
+        # Constantes de la exponencial, en float32 para no promocionar los pasos
+        self._k = np.float32(np.log(10.0) / (10.0 * self.b))
+        self._c = np.float32(self.a ** (-1.0 / self.b))
+
+    def __repr__(self):
+        return f"Z = {self.a:g}·R^{self.b:g}"
+
+    def intensidad(self, paso):
+        """Convierte in situ un array float32 de dBZ en mm/h y lo devuelve"""
+        if paso.dtype != np.float32:
+            raise TypeError(f"La conversión Z-R trabaja in situ sobre float32, no sobre {paso.dtype}")
+        if self.clutter is not None and self.clutter.shape != paso.shape[-2:]:
+            raise ValueError(f"La máscara de clutter {self.clutter.shape} no coincide con el radar "
+                             f"{paso.shape[-2:]}")
+
+        # NaN < umbral es False: los píxeles sin dato siguen sin dato
+        sin_lluvia = paso < self.umbral_dbz if self.umbral_dbz is not None else None
+        if self.max_dbz is not None:
+            np.minimum(paso, np.float32(self.max_dbz), out=paso)
+        paso *= self._k
+        np.exp(paso, out=paso)
+        paso *= self._c
+
+        if sin_lluvia is not None:
+            paso[sin_lluvia] = 0.0
+        if self.clutter is not None:
+            paso[..., self.clutter] = np.nan
+        return paso
+
+
+def relacion_zr(nombre='marshall-palmer', a=None, b=None, **opciones):
+    """RelacionZR de ``RELACIONES_ZR`` con ``a``/``b`` opcionales que la sustituyen"""
+    if nombre not in RELACIONES_ZR:
+        raise ValueError(f"Relación Z-R desconocida: {nombre} (opciones: {', '.join(RELACIONES_ZR)})")
+    a_tabla, b_tabla = RELACIONES_ZR[nombre]
+    return RelacionZR(a_tabla if a is None else a, b_tabla if b is None else b, **opciones)
+
+
+def es_reflectividad(radar_da):
+    """True si las unidades del campo son de reflectividad (dBZ)"""
+    unidades = str(radar_da.attrs.get('units', '')).strip().lower()
+    return unidades in UNIDADES_REFLECTIVIDAD
+
+
+def cargar_clutter(ruta):
+    """Máscara booleana (Y, X) de clutter desde un .npy o la primera variable de un NetCDF"""
+    if ruta.lower().endswith('.npy'):
+        return np.load(ruta).astype(bool)
+    with xr.open_dataset(ruta) as ds:
+        return np.asarray(ds[list(ds.data_vars)[0]].values).astype(bool)
+
+
+def convertir_campo(radar_da, zr, en_sitio=False):
+    """Campo de dBZ convertido en intensidad (mm/h, float32).
+
+    Lee el campo entero: los cubos grandes conviene convertirlos al acumular
+    (``acumulacion``, ``tipo='reflectividad'``). Con ``en_sitio=True`` y datos
+    ya float32 en memoria se reutiliza su array.
+    """
+    valores = radar_da.values
+    if not en_sitio or valores.dtype != np.float32:
+        valores = np.array(valores, dtype=np.float32)
+    zr.intensidad(valores)
+
+    convertido = radar_da.copy(data=valores)
+    convertido.attrs.update({'units': 'mm/h', 'relacion_zr': repr(zr)})
+    return convertido
+
+
+def agregar_argumentos(parser):
+    """Opciones de conversión Z-R comunes a las herramientas de línea de comandos"""
+    parser.add_argument("--zr", default="marshall-palmer", choices=tuple(RELACIONES_ZR),
+                        help="Relación Z-R para radares en reflectividad (dBZ)")
+    parser.add_argument("--zr-a", type=float, default=None,
+                        help="Coeficiente a de Z = a·R^b (sustituye al de --zr)")
+    parser.add_argument("--zr-b", type=float, default=None,
+                        help="Exponente b de Z = a·R^b (sustituye al de --zr)")
+    parser.add_argument("--umbral-dbz", type=float, default=UMBRAL_DBZ,
+                        help="Reflectividad mínima considerada lluvia (dBZ)")
+    parser.add_argument("--max-dbz", type=float, default=MAX_DBZ,
+                        help="Tope de reflectividad antes de convertir (dBZ), para limitar el granizo")
+    parser.add_argument("--clutter", default=None,
+                        help="Máscara de clutter (.npy o NetCDF, no nulo = clutter) del tamaño del radar")
+    return parser
+
+
+def desde_argumentos(args):
+    """RelacionZR configurada con las opciones de ``agregar_argumentos``"""
+    clutter = cargar_clutter(args.clutter) if args.clutter else None
+    return relacion_zr(args.zr, args.zr_a, args.zr_b, umbral_dbz=args.umbral_dbz, max_dbz=args.max_dbz,
+                       clutter=clutter)
@@ -0,0 +1,303 @@
+"""Motor de renderizado de mapas con mapa base reutilizable.
+
+Crear la figura de cartopy, dibujar costas, fronteras, límites y rejilla y
+guardar con ``bbox_inches='tight'`` es lo más caro de cada mapa. El motor
+dibuja todo eso una sola vez por geometría y calidad, guarda el fondo ya
+rasterizado y, en cada cuadro, solo actualiza los datos de la imagen y
+la posición de los pluviómetros, los pinta sobre el fondo (blit) y escribe
+el buffer directamente a PNG.
+
+El mapa se dibuja en la proyección nativa del radar (acimutal equidistante
+del sitio), así que la rejilla se pinta como una imagen sin reproyectar y
+solo las costas, los límites y los pluviómetros se transforman.
+
+Tras un cambio local del campo (ver ``incremental``) basta con repintar las
+regiones afectadas sobre el último cuadro: se restaura el fondo solo en
+ellas y la imagen y los pluviómetros se dibujan recortados a esas cajas.
+
+Calidades:
+- ``borrador``: baja resolución para vistas previas y animaciones.
+- ``final``: la misma calidad que los mapas de siempre (300 dpi).
+"""
+import os
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
+from matplotlib.transforms import Bbox
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+
+import capas
+from geometria import geometria_de
+
+CALIDADES = {
+    'borrador': {'dpi': 80, 'figsize': (8, 6.5), 'escala_costas': '50m'},
+    'final': {'dpi': 300, 'figsize': (12, 10), 'escala_costas': None},
+}
+
+# Margen del mapa alrededor de la rejilla del radar (km)
+MARGEN_KM = 50.0
+
+# Motores ya construidos en este proceso: (geometría, calidad, vmax) -> MotorMapa
+_motores = {}
+
+
+def proyeccion_cartopy(geometria):
+    """Proyección de cartopy (en metros) equivalente a la rejilla del radar"""
+    centro_lon, centro_lat = geometria.centro
+    return ccrs.AzimuthalEquidistant(central_longitude=centro_lon, central_latitude=centro_lat,
+                                     globe=ccrs.Globe(ellipse='WGS84'))
+
+
+class MotorMapa:
+    """Figura de cartopy con el mapa base ya dibujado; cada cuadro solo cambia los datos"""
+
+    def __init__(self, geometria, calidad='final', vmin=0.0, vmax=None, titulo='Precipitación Radar Corregida',
+                 capa='cuba', costas=True, log=print):
+        if calidad not in CALIDADES:
+            raise ValueError(f"Calidad desconocida: {calidad} (opciones: {', '.join(CALIDADES)})")
+
+        opciones = CALIDADES[calidad]
+        self.calidad = calidad
+        self.dpi = opciones['dpi']
+        self.forma = tuple(geometria.forma)
+        proyeccion = proyeccion_cartopy(geometria)
+        self.fig = plt.figure(figsize=opciones['figsize'], dpi=self.dpi)
+        self.ax = self.fig.add_subplot(1, 1, 1, projection=proyeccion)
+
+        # Bordes de la rejilla en metros, en la proyección de los ejes
+        medio = geometria.resolucion_km / 2
+        bordes = 1000.0 * np.array([geometria.x[0] - medio, geometria.x[-1] + medio,
+                                    geometria.y[0] - medio, geometria.y[-1] + medio])
+        margen = 1000.0 * MARGEN_KM * np.array([-1, 1, -1, 1])
+        self._bordes = bordes
+        self._paso_m = 1000.0 * geometria.resolucion_km
+
+        # Configurar mapa (las costas de Natural Earth se descargan la primera vez)
+        if costas:
+            linea_costa = cfeature.COASTLINE
+            if opciones['escala_costas']:
+                linea_costa = linea_costa.with_scale(opciones['escala_costas'])
+            self.ax.add_feature(linea_costa)
+            self.ax.add_feature(cfeature.BORDERS, linestyle=':')
+        extension = geometria.extension_lonlat(MARGEN_KM)
+        try:
+            capas.dibujar_limites(self.ax, extension, capa=capa, log=log)
+        except Exception as e:
+            log(f"Error con shapefile: {str(e)}")
+        self.ax.set_extent(list(bordes + margen), crs=proyeccion)
+        rejilla = self.ax.gridlines(draw_labels=True, linewidth=0.3)
+        rejilla.top_labels = False
+        rejilla.right_labels = False
+
+        # Artistas que cambian en cada cuadro; la escala de colores queda fija
+        self.norma = Normalize(vmin=vmin, vmax=1.0 if vmax is None else vmax)
+        self.escala_fija = vmax is not None
+        # La rejilla es regular en la proyección de los ejes: una imagen con los bordes
+        # de las celdas equivale al pcolormesh sin construir un polígono por píxel
+        self.mesh = self.ax.imshow(
+            np.zeros(self.forma), cmap='YlGnBu', norm=self.norma, origin='lower', extent=list(bordes),
+            transform=proyeccion, interpolation='nearest', animated=True
+        )
+        self.pluviometros = self.ax.scatter([], [], s=50, c='red', alpha=0.7, label='Pluviómetros',
+                                            transform=ccrs.PlateCarree(), animated=True)
+
+        # La barra de colores también se repinta en cada cuadro para que el fondo no cambie con la escala
+        self.barra = self.fig.colorbar(self.mesh, ax=self.ax, label='Precipitación (mm)')
+        self.barra.ax.set_animated(True)
+        self.ax.set_title(titulo)
+        self.ax.legend(handles=[self.pluviometros], loc='upper right')
+        self._fondo = None
+        self._pintado = False
+
+    def _capturar_fondo(self):
+        """Dibuja la figura sin los artistas animados y guarda el fondo rasterizado"""
+        self.fig.canvas.draw()
+        self._fondo = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def _actualizar_escala(self, valores):
+        """Ajusta la escala libre al máximo del campo; True si ha cambiado"""
+        if self.escala_fija:
+            return False
+        vmax = float(np.nanmax(valores)) if np.isfinite(valores).any() else 1.0
+        if vmax > 0 and vmax != self.norma.vmax:
+            self.norma.vmax = vmax
+            self.barra.update_normal(self.mesh)
+            return True
+        return False
+
+    def cuadro(self, valores, lon_pts=None, lat_pts=None, regiones=None, puntos_cambiados=None):
+        """Pinta un cuadro sobre el mapa base y devuelve la imagen RGBA (alto, ancho, 4).
+
+        Con ``regiones`` (lista de (fila0, fila1, col0, col1) de la rejilla) solo
+        se repintan esas regiones y, con ``puntos_cambiados`` (lon, lat), la
+        huella de los pluviómetros que han cambiado; el resto de la imagen es
+        el cuadro anterior de este motor. Si la escala de colores cambia, o no
+        hay cuadro anterior, se pinta el cuadro completo.
+        """
+        valores = np.asarray(valores)
+        if valores.shape != self.forma:
+            raise ValueError(f"El campo {valores.shape} no coincide con la rejilla del motor {self.forma}")
+
+        # Sin escala fija, la barra de colores sigue al campo
+        escala_cambiada = self._actualizar_escala(valores)
+
+        if self._fondo is None:
+            self._capturar_fondo()
+
+        self.mesh.set_data(np.ma.masked_invalid(valores))
+        if lon_pts is not None:
+            self.pluviometros.set_offsets(np.column_stack([lon_pts, lat_pts]))
+
+        canvas = self.fig.canvas
+        if regiones is None or escala_cambiada or not self._pintado:
+            canvas.restore_region(self._fondo)
+            self.ax.draw_artist(self.mesh)
+            self.ax.draw_artist(self.pluviometros)
+            self.fig.draw_artist(self.barra.ax)
+        else:
+            cajas = [self._caja_region(*region) for region in regiones]
+            if puntos_cambiados is not None:
+                cajas += self._cajas_puntos(*puntos_cambiados)
+            self._repintar_cajas(cajas, valores)
+        self._pintado = True
+        return np.asarray(canvas.buffer_rgba())
+
+    def _caja_region(self, fila0, fila1, col0, col1):
+        """Caja en píxeles de pantalla (x0, y0, x1, y1) de una región de la rejilla"""
+        x0, y0 = self._bordes[0], self._bordes[2]
+        esquinas = np.array([[x0 + col0 * self._paso_m, y0 + fila0 * self._paso_m],
+                             [x0 + col1 * self._paso_m, y0 + fila1 * self._paso_m]])
+        (px0, py0), (px1, py1) = self.ax.transData.transform(esquinas)
+        return min(px0, px1), min(py0, py1), max(px0, px1), max(py0, py1)
+
+    def _radio_marcador(self):
+        """Radio de los marcadores de pluviómetro en píxeles (con su borde), con margen para el antialias"""
+        borde = float(np.max(self.pluviometros.get_linewidths())) if len(self.pluviometros.get_linewidths()) else 0.0
+        return (np.sqrt(self.pluviometros.get_sizes().max()) + borde) / 2 * self.dpi / 72.0 + 2.0
+
+    def _cajas_puntos(self, lon_pts, lat_pts):
+        """Cajas de pantalla que cubren el marcador de cada punto"""
+        if len(lon_pts) == 0:
+            return []
+        centros = self.pluviometros.get_offset_transform().transform(
+            np.column_stack([np.asarray(lon_pts, dtype=float), np.asarray(lat_pts, dtype=float)]))
+        radio = self._radio_marcador()
+        return [(px - radio, py - radio, px + radio, py + radio) for px, py in centros if np.isfinite(px)]
+
+    def _celdas_caja(self, x0, y0, x1, y1):
+        """Filas y columnas (fila0, fila1, col0, col1) de la rejilla bajo una caja de pantalla, con una de margen"""
+        (xa, ya), (xb, yb) = self.ax.transData.inverted().transform([[x0, y0], [x1, y1]])
+        cols = np.floor((np.array([min(xa, xb), max(xa, xb)]) - self._bordes[0]) / self._paso_m).astype(int)
+        filas = np.floor((np.array([min(ya, yb), max(ya, yb)]) - self._bordes[2]) / self._paso_m).astype(int)
+        ny, nx = self.forma
+        return (max(filas[0] - 1, 0), min(filas[1] + 2, ny), max(cols[0] - 1, 0), min(cols[1] + 2, nx))
+
+    def _repintar_cajas(self, cajas, valores):
+        """Restaura el fondo y redibuja la imagen y los pluviómetros solo dentro de cada caja.
+
+        En cada caja la imagen se dibuja solo con las celdas que cubre, así que
+        el coste de normalizar y remuestrear no depende del tamaño del campo.
+        """
+        canvas = self.fig.canvas
+        ancho, alto = canvas.get_width_height()
+        offsets = self.pluviometros.get_offsets()
+        centros = self.pluviometros.get_offset_transform().transform(offsets) if len(offsets) else np.empty((0, 2))
+        radio = self._radio_marcador()
+        recortes = (self.mesh.get_clip_box(), self.pluviometros.get_clip_box(), self.pluviometros.get_clip_path())
+        extension = self.mesh.get_extent()
+        # Agg ignora el rectángulo de recorte de los marcadores con un trazado de recorte; el
+        # contorno del mapa es el rectángulo de los ejes, así que basta con recortar a su caja
+        self.pluviometros.set_clip_path(None)
+        try:
+            for x0, y0, x1, y1 in cajas:
+                # Cajas enteras (un píxel de margen) para que fondo y recorte coincidan
+                x0, y0 = max(int(np.floor(x0)) - 1, 0), max(int(np.floor(y0)) - 1, 0)
+                x1, y1 = min(int(np.ceil(x1)) + 1, ancho), min(int(np.ceil(y1)) + 1, alto)
+                if x1 <= x0 or y1 <= y0:
+                    continue
+                caja = Bbox.from_extents(x0, y0, x1, y1)
+                # La región guardada va en coordenadas del buffer (origen arriba a la izquierda)
+                # y Agg incluye la última fila y columna del rectángulo
+                canvas.restore_region(self._fondo, bbox=(x0, alto - y1, x1 - 1, alto - y0 - 1), xy=(0, 0))
+
+                fila0, fila1, col0, col1 = self._celdas_caja(x0, y0, x1, y1)
+                if fila1 > fila0 and col1 > col0:
+                    self.mesh.set_data(np.ma.masked_invalid(valores[fila0:fila1, col0:col1]))
+                    self.mesh.set_extent([self._bordes[0] + col0 * self._paso_m, self._bordes[0] + col1 * self._paso_m,
+                                          self._bordes[2] + fila0 * self._paso_m, self._bordes[2] + fila1 * self._paso_m])
+                    self.mesh.set_clip_box(caja)
+                    self.ax.draw_artist(self.mesh)
+
+                tocados = ((centros[:, 0] + radio >= x0) & (centros[:, 0] - radio <= x1)
+                           & (centros[:, 1] + radio >= y0) & (centros[:, 1] - radio <= y1))
+                if tocados.any():
+                    self.pluviometros.set_offsets(offsets[tocados])
+                    # El recorte de los marcadores también incluye la última columna y la fila de abajo
+                    recorte = Bbox.intersection(Bbox.from_extents(x0, y0 + 1, x1 - 1, y1), self.ax.bbox)
+                    if recorte is not None:
+                        self.pluviometros.set_clip_box(recorte)
+                        self.ax.draw_artist(self.pluviometros)
+        finally:
+            self.mesh.set_clip_box(recortes[0])
+            self.mesh.set_extent(extension)
+            self.mesh.set_data(np.ma.masked_invalid(valores))
+            self.pluviometros.set_clip_box(recortes[1])
+            self.pluviometros.set_clip_path(recortes[2])
+            self.pluviometros.set_offsets(offsets)
+
+    def guardar(self, valores, ruta_salida, lon_pts=None, lat_pts=None, regiones=None, puntos_cambiados=None):
+        """Pinta un cuadro (o solo sus ``regiones``, ver ``cuadro``) y lo escribe como PNG"""
+        imagen = self.cuadro(valores, lon_pts, lat_pts, regiones, puntos_cambiados)
+        plt.imsave(ruta_salida, imagen, dpi=self.dpi)
+        return ruta_salida
+
+    def cerrar(self):
+        plt.close(self.fig)
+
+
+def obtener_motor(radar_da, calidad='final', vmax=None, log=print):
+    """Motor de la caché del proceso para la rejilla de ``radar_da``"""
+    geometria = geometria_de(radar_da)
+    clave = (geometria.clave, calidad, vmax)
+    if clave not in _motores:
+        _motores[clave] = MotorMapa(geometria, calidad=calidad, vmax=vmax, log=log)
+    return _motores[clave]
+
+
+def cerrar_motores():
+    """Libera las figuras de todos los motores cacheados"""
+    for motor in _motores.values():
+        motor.cerrar()
+    _motores.clear()
+
+
+def renderizar_serie(cubo_da, pluviometros_gdf, directorio, calidad='borrador', vmax=None, log=print):
+    """Un PNG por paso de un cubo (tiempo, Y, X) con la misma escala de colores.
+
+    Sin ``vmax`` se usa el máximo de toda la serie para que los cuadros sean
+    comparables y el fondo no tenga que redibujarse.
+    """
+    os.makedirs(directorio, exist_ok=True)
+    dim = cubo_da.dims[0]
+    if vmax is None:
+        vmax = float(cubo_da.max(skipna=True))
+        vmax = vmax if np.isfinite(vmax) and vmax > 0 else 1.0
+
+    motor = MotorMapa(geometria_de(cubo_da), calidad=calidad, vmax=vmax, log=log)
+    lon_pts = pluviometros_gdf.longitud.values
+    lat_pts = pluviometros_gdf.latitud.values
+    rutas = []
+    try:
+        for i in range(cubo_da.sizes[dim]):
+            ruta = os.path.join(directorio, f"cuadro_{i:04d}.png")
+            motor.guardar(cubo_da.isel({dim: i}).values, ruta, lon_pts, lat_pts)
+            rutas.append(ruta)
+    finally:
+        motor.cerrar()
+
+    log(f"\n{len(rutas)} cuadros guardados en: {directorio}")
+    return rutas
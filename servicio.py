@@ -0,0 +1,428 @@
+"""Servicio HTTP de consultas de lluvia corregida (asyncio, solo biblioteca estándar).
+
+Mantiene en memoria los últimos campos corregidos (uno por escaneo o ventana)
+y responde en milisegundos consultas por punto, caja y polígono. Cargar un
+radar nuevo o subir una tabla de pluviómetros dispara la fusión, que se hace
+en un pool de procesos para no bloquear las consultas.
+
+Rutas (respuestas JSON):
+    GET  /salud
+    GET  /campos
+    GET  /punto?lon=&lat=[&horas=1]
+    GET  /caja?lon_min=&lon_max=&lat_min=&lat_max=[&horas=1]
+    POST /poligono[?horas=1]                   cuerpo: geometría o Feature GeoJSON
+    POST /pluviometros?formato=csv[&metodo=]   cuerpo: tabla de pluviómetros; re-fusiona los radares
+    POST /radar?ruta=escaneo.nc                fusiona un radar nuevo con los pluviómetros actuales
+
+``horas`` selecciona los campos cuyo instante cae en la última ventana de
+esa duración (contada desde el campo más reciente); la respuesta da cada
+campo y la suma de todos, que es el total de lluvia si cada campo es el
+acumulado de su intervalo.
+
+Escucha solo en localhost por defecto. Ejemplo:
+    python servicio.py --radar lluvia8junio.nc --pluviometros lluvia.xls --puerto 8080
+    curl "http://127.0.0.1:8080/punto?lon=-77.9&lat=21.5&horas=1"
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+import correccion
+import fusion
+import geometria
+import reflectividad
+from muestreo import aplicar_muestreo, preparar_muestreo
+from pluviometros import EXTENSIONES
+from productos import tiempo_campo
+
+MAX_CAMPOS = 24
+MAX_CUERPO_MB = 50
+
+# Texto de cada código de estado usado por el servicio
+ESTADOS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class ErrorHTTP(Exception):
+    """Error que se devuelve al cliente con su código de estado"""
+
+    def __init__(self, estado, mensaje):
+        super().__init__(mensaje)
+        self.estado = estado
+
+
+def _preparar_proceso(cache_dir):
+    """Inicializador de cada proceso del pool: la misma caché en disco que el servicio"""
+    if cache_dir:
+        import pluviometros
+
+        geometria.configurar_cache(directorio=cache_dir)
+        pluviometros.configurar_cache(cache_dir)
+
+
+def _cargar_radar(ruta, centro_lon, centro_lat, resolucion_km, ventana, zr):
+    """Radar 2D listo para fusionar (se ejecuta en el pool de procesos)"""
+    silencioso = lambda mensaje: None
+    with fusion.abrir_radar(ruta, centro_lon, centro_lat, resolucion_km, log=silencioso) as radar:
+        return fusion.preparar_campo(radar, ventana, zr=zr, log=silencioso).load()
+
+
+def _fusionar(radar, ruta_pluviometros, metodo, control=True):
+    """Campo corregido y número de pluviómetros usados (se ejecuta en el pool de procesos)"""
+    silencioso = lambda mensaje: None
+    pluv = fusion.cargar_datos_pluviometros(ruta_pluviometros, log=silencioso)
+    corregido = fusion.fusionar_datos(radar, pluv, metodo=metodo, log=silencioso, control=control)
+    return corregido.astype(np.float32), len(pluv)
+
+
+def _numero(valor):
+    """Float para JSON (NaN → null)"""
+    valor = float(valor)
+    return valor if np.isfinite(valor) else None
+
+
+class AlmacenCampos:
+    """Últimos radares y campos corregidos en memoria, ordenados por instante"""
+
+    def __init__(self, max_campos=MAX_CAMPOS):
+        self.max_campos = max_campos
+        self.radares = OrderedDict()
+        self.campos = OrderedDict()
+
+    def agregar(self, tiempo, radar, corregido):
+        self.radares[tiempo] = radar
+        # Solo se guardan los valores y la geometría: las consultas no necesitan el DataArray
+        self.campos[tiempo] = (np.ascontiguousarray(corregido.values, dtype=np.float32),
+                               geometria.geometria_de(corregido))
+        for tabla in (self.radares, self.campos):
+            orden = sorted(tabla)
+            for clave in orden[:-self.max_campos]:
+                del tabla[clave]
+            # Los escaneos pueden llegar desordenados: se reordenan por instante
+            for clave in orden[-self.max_campos:]:
+                tabla.move_to_end(clave)
+
+    def recientes(self, horas):
+        """[(tiempo, valores, geometría)] de la última ventana de ``horas`` horas"""
+        if not self.campos:
+            raise ErrorHTTP(409, "Todavía no hay campos corregidos en memoria")
+        ultimo = next(reversed(self.campos))
+        inicio = ultimo - pd.Timedelta(hours=horas)
+        return [(t, valores, g) for t, (valores, g) in self.campos.items() if t > inicio or t == ultimo]
+
+
+def estadisticas_region(valores, g, poligono_lonlat):
+    """Media, máximo y píxeles del campo dentro de un polígono lon/lat"""
+    import shapely
+
+    poligono = g.proyectar_geometria(shapely.segmentize(poligono_lonlat, 0.05))
+    x0, y0, x1, y1 = poligono.bounds
+    # Solo se evalúan los píxeles de la caja del polígono
+    columnas = slice(np.searchsorted(g.x, x0), np.searchsorted(g.x, x1, side='right'))
+    filas = slice(np.searchsorted(g.y, y0), np.searchsorted(g.y, y1, side='right'))
+    xx, yy = np.meshgrid(g.x[columnas], g.y[filas])
+    dentro = shapely.contains_xy(poligono, xx, yy)
+
+    seleccion = valores[filas, columnas][dentro]
+    validos = seleccion[np.isfinite(seleccion)]
+    return {
+        'pixeles': int(dentro.sum()),
+        'pixeles_validos': int(validos.size),
+        'media': _numero(validos.mean()) if validos.size else None,
+        'maximo': _numero(validos.max()) if validos.size else None,
+    }
+
+
+class ServicioLluvia:
+    """Rutas del servicio sobre un ``AlmacenCampos``"""
+
+    def __init__(self, pluviometros=None, directorio_datos=None, metodo='mediana', centro_lon=fusion.CENTRO_LON,
+                 centro_lat=fusion.CENTRO_LAT, resolucion_km=fusion.RESOLUCION_KM, ventana=None, zr=None,
+                 max_campos=MAX_CAMPOS, procesos=1, cache_dir=None, control=True, log=print):
+        self.pluviometros = pluviometros
+        self.directorio_datos = directorio_datos or tempfile.mkdtemp(prefix='servicio_lluvia_')
+        self.metodo = metodo
+        self.control = control
+        self.radar = (centro_lon, centro_lat, resolucion_km, ventana, zr)
+        self.almacen = AlmacenCampos(max_campos)
+        self.executor = ProcessPoolExecutor(max_workers=procesos, initializer=_preparar_proceso,
+                                            initargs=(cache_dir,))
+        # Las fusiones se hacen de una en una; las consultas no esperan por ellas
+        self._fusion = asyncio.Lock()
+        self.log = log
+        self.rutas = {
+            ('GET', '/salud'): self.salud,
+            ('GET', '/campos'): self.listar_campos,
+            ('GET', '/punto'): self.punto,
+            ('GET', '/caja'): self.caja,
+            ('POST', '/poligono'): self.poligono,
+            ('POST', '/pluviometros'): self.subir_pluviometros,
+            ('POST', '/radar'): self.cargar_radar,
+        }
+
+    async def _en_pool(self, funcion, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, funcion, *args)
+
+    async def fusionar_radar(self, ruta):
+        """Carga y fusiona un radar con los pluviómetros actuales y lo guarda en el almacén"""
+        if self.pluviometros is None:
+            raise ErrorHTTP(409, "No hay tabla de pluviómetros: súbala antes con POST /pluviometros")
+        if not os.path.exists(ruta):
+            raise ErrorHTTP(404, f"No existe el radar {ruta}")
+
+        async with self._fusion:
+            radar = await self._en_pool(_cargar_radar, ruta, *self.radar)
+            corregido, n = await self._en_pool(_fusionar, radar, self.pluviometros, self.metodo, self.control)
+        try:
+            tiempo = tiempo_campo(corregido)
+        except ValueError:
+            # Radar sin hora de escaneo: se toma la de llegada, completa para no pisar otro campo del mismo segundo
+            tiempo = pd.Timestamp.now()
+        self.almacen.agregar(tiempo, radar, corregido)
+        self.log(f"Campo {tiempo} fusionado con {n} pluviómetros ({os.path.basename(ruta)})")
+        return {'tiempo': tiempo.isoformat(), 'pluviometros': n}
+
+    def _horas(self, parametros):
+        return _parametro(parametros, 'horas', 1.0)
+
+    async def salud(self, parametros, cuerpo):
+        return {'estado': 'ok', 'campos': len(self.almacen.campos),
+                'pluviometros': self.pluviometros is not None}
+
+    async def listar_campos(self, parametros, cuerpo):
+        return {'campos': [{'tiempo': t.isoformat(), 'forma': list(valores.shape),
+                            'centro': list(g.centro), 'resolucion_km': g.resolucion_km}
+                           for t, (valores, g) in self.almacen.campos.items()]}
+
+    async def punto(self, parametros, cuerpo):
+        lon = _parametro(parametros, 'lon')
+        lat = _parametro(parametros, 'lat')
+        serie = []
+        for tiempo, valores, g in self.almacen.recientes(self._horas(parametros)):
+            # Plan de un solo punto: no se guarda en la caché de la geometría
+            plan = preparar_muestreo(g.x, g.y, *g.proyectar([lon], [lat]), metodo='bilineal')
+            serie.append({'tiempo': tiempo.isoformat(), 'valor': _numero(aplicar_muestreo(plan, valores)[0])})
+        validos = [p['valor'] for p in serie if p['valor'] is not None]
+        return {'lon': lon, 'lat': lat, 'campos': serie, 'total': float(sum(validos)) if validos else None}
+
+    def _region(self, parametros, poligono):
+        serie = [dict(estadisticas_region(valores, g, poligono), tiempo=tiempo.isoformat())
+                 for tiempo, valores, g in self.almacen.recientes(self._horas(parametros))]
+        medias = [p['media'] for p in serie if p['media'] is not None]
+        return {'campos': serie, 'total_medio': float(sum(medias)) if medias else None}
+
+    async def caja(self, parametros, cuerpo):
+        import shapely
+
+        lon_min, lon_max = _parametro(parametros, 'lon_min'), _parametro(parametros, 'lon_max')
+        lat_min, lat_max = _parametro(parametros, 'lat_min'), _parametro(parametros, 'lat_max')
+        if lon_min >= lon_max or lat_min >= lat_max:
+            raise ErrorHTTP(400, "La caja debe cumplir lon_min < lon_max y lat_min < lat_max")
+        return self._region(parametros, shapely.box(lon_min, lat_min, lon_max, lat_max))
+
+    async def poligono(self, parametros, cuerpo):
+        from shapely.geometry import shape
+
+        try:
+            geojson = json.loads(cuerpo)
+            poligono = shape(geojson.get('geometry', geojson))
+        except (ValueError, AttributeError, KeyError, TypeError) as e:
+            raise ErrorHTTP(400, f"El cuerpo debe ser una geometría GeoJSON: {e}")
+        if poligono.geom_type not in ('Polygon', 'MultiPolygon'):
+            raise ErrorHTTP(400, f"Se esperaba un polígono, no {poligono.geom_type}")
+        return self._region(parametros, poligono)
+
+    async def subir_pluviometros(self, parametros, cuerpo):
+        formato = str(parametros.get('formato', ['csv'])[0]).lower().lstrip('.')
+        if f".{formato}" not in EXTENSIONES:
+            raise ErrorHTTP(400, f"Formato de pluviómetros no soportado: {formato}")
+        metodo = parametros.get('metodo', [self.metodo])[0]
+        if metodo not in correccion.METODOS_CORRECCION:
+            raise ErrorHTTP(400, f"Método de corrección desconocido: {metodo}")
+        if not cuerpo:
+            raise ErrorHTTP(400, "El cuerpo de la petición está vacío")
+
+        ruta = os.path.join(self.directorio_datos, f"pluviometros_subidos.{formato}")
+        async with self._fusion:
+            # Escritura atómica: una fusión en curso no ve el archivo a medias
+            temporal = f"{ruta}.tmp"
+            with open(temporal, 'wb') as f:
+                f.write(cuerpo)
+            os.replace(temporal, ruta)
+            self.pluviometros = ruta
+            self.metodo = metodo
+
+            # Re-fusión de los radares en memoria con la tabla nueva
+            resultados = []
+            for tiempo, radar in list(self.almacen.radares.items()):
+                corregido, n = await self._en_pool(_fusionar, radar, ruta, metodo, self.control)
+                self.almacen.agregar(tiempo, radar, corregido)
+                resultados.append({'tiempo': tiempo.isoformat(), 'pluviometros': n})
+        self.log(f"Pluviómetros actualizados: {len(resultados)} campos re-fusionados")
+        return {'refusionados': resultados}
+
+    async def cargar_radar(self, parametros, cuerpo):
+        if 'ruta' not in parametros:
+            raise ErrorHTTP(400, "Falta el parámetro 'ruta' del radar")
+        return await self.fusionar_radar(parametros['ruta'][0])
+
+    async def despachar(self, metodo, destino, cuerpo):
+        """(estado, respuesta) de una petición"""
+        partes = urlsplit(destino)
+        manejador = self.rutas.get((metodo, partes.path))
+        if manejador is None:
+            if any(ruta == partes.path for _, ruta in self.rutas):
+                raise ErrorHTTP(405, f"Método {metodo} no permitido en {partes.path}")
+            raise ErrorHTTP(404, f"Ruta desconocida: {partes.path}")
+
+        inicio = time.perf_counter()
+        respuesta = await manejador(parse_qs(partes.query), cuerpo)
+        respuesta['milisegundos'] = round((time.perf_counter() - inicio) * 1000, 2)
+        return 200, respuesta
+
+    async def atender(self, lector, escritor):
+        """Una conexión: una petición HTTP/1.1 y su respuesta (``Connection: close``)"""
+        try:
+            try:
+                linea = (await lector.readline()).decode('latin-1').split()
+                if len(linea) != 3:
+                    raise ErrorHTTP(400, "Línea de petición no válida")
+                metodo, destino, _ = linea
+
+                cabeceras = {}
+                while True:
+                    cabecera = (await lector.readline()).decode('latin-1').strip()
+                    if not cabecera:
+                        break
+                    nombre, _, valor = cabecera.partition(':')
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+
+                longitud = int(cabeceras.get('content-length', 0))
+                if longitud > MAX_CUERPO_MB * 2 ** 20:
+                    raise ErrorHTTP(413, f"El cuerpo supera {MAX_CUERPO_MB} MB")
+                cuerpo = await lector.readexactly(longitud) if longitud else b''
+
+                estado, respuesta = await self.despachar(metodo.upper(), destino, cuerpo)
+            except ErrorHTTP as e:
+                estado, respuesta = e.estado, {'error': str(e)}
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                estado, respuesta = 400, {'error': str(e)}
+            except Exception as e:
+                self.log(f"ERROR: {type(e).__name__}: {e}")
+                estado, respuesta = 500, {'error': str(e)}
+
+            datos = json.dumps(respuesta, ensure_ascii=False).encode('utf-8')
+            escritor.write(f"HTTP/1.1 {estado} {ESTADOS.get(estado, '')}\r\n"
+                           "Content-Type: application/json; charset=utf-8\r\n"
+                           f"Content-Length: {len(datos)}\r\n"
+                           "Connection: close\r\n\r\n".encode('latin-1') + datos)
+            await escritor.drain()
+        except ConnectionError:
+            pass
+        finally:
+            escritor.close()
+
+    def cerrar(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _parametro(parametros, nombre, defecto=None):
+    """Parámetro numérico de la consulta"""
+    if nombre not in parametros:
+        if defecto is None:
+            raise ErrorHTTP(400, f"Falta el parámetro '{nombre}'")
+        return defecto
+    try:
+        return float(parametros[nombre][0])
+    except ValueError:
+        raise ErrorHTTP(400, f"El parámetro '{nombre}' debe ser numérico")
+
+
+async def servir(servicio, radares=(), host='127.0.0.1', puerto=8080, listo=None):
+    """Arranca el servidor, fusiona los ``radares`` iniciales y atiende hasta que se cancele.
+
+    ``listo(puerto)`` se llama cuando el servidor ya acepta conexiones (útil con ``puerto=0``).
+    """
+    servidor = await asyncio.start_server(servicio.atender, host, puerto)
+    puerto = servidor.sockets[0].getsockname()[1]
+    servicio.log(f"Servicio de lluvia en http://{host}:{puerto}")
+    if listo is not None:
+        listo(puerto)
+
+    async with servidor:
+        for ruta in radares:
+            try:
+                await servicio.fusionar_radar(ruta)
+            except Exception as e:
+                servicio.log(f"ERROR al fusionar {ruta}: {e}")
+        await servidor.serve_forever()
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Servicio HTTP de consultas de lluvia radar-pluviómetros")
+    parser.add_argument("--radar", nargs='*', default=[], help="Radares (NetCDF) a fusionar al arrancar")
+    parser.add_argument("--pluviometros", default=None,
+                        help="Tabla de pluviómetros inicial (Excel, CSV o Parquet)")
+    parser.add_argument("--host", default="127.0.0.1", help="Dirección de escucha (por defecto, solo localhost)")
+    parser.add_argument("--puerto", type=int, default=8080, help="Puerto de escucha (0: uno libre)")
+    parser.add_argument("--metodo", default="mediana", choices=correccion.METODOS_CORRECCION,
+                        help="Método de corrección del radar con los pluviómetros")
+    parser.add_argument("--sin-control", action="store_true",
+                        help="No pasar el control de calidad a los pluviómetros antes de fusionar")
+    parser.add_argument("--ventana", default=None,
+                        help="Ventana de acumulación para radares con dimensión temporal (1h, 3h, 6h, 24h)")
+    parser.add_argument("--max-campos", type=int, default=MAX_CAMPOS,
+                        help="Campos corregidos que se guardan en memoria")
+    parser.add_argument("-j", "--procesos", type=int, default=1, help="Procesos para cargar y fusionar")
+    parser.add_argument("--datos-dir", default=None, help="Directorio donde guardar los pluviómetros subidos")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directorio de la caché de geometría del radar y de tablas de pluviómetros")
+    parser.add_argument("--centro-lon", type=float, default=fusion.CENTRO_LON,
+                        help="Longitud del centro del radar")
+    parser.add_argument("--centro-lat", type=float, default=fusion.CENTRO_LAT,
+                        help="Latitud del centro del radar")
+    parser.add_argument("--resolucion-km", type=float, default=fusion.RESOLUCION_KM,
+                        help="Resolución de la rejilla del radar (km)")
+    reflectividad.agregar_argumentos(parser)
+    return parser
+
+
+def main(argv=None):
+    parser = crear_parser()
+    args = parser.parse_args(argv)
+    try:
+        zr = reflectividad.desde_argumentos(args)
+    except (OSError, ValueError) as e:
+        parser.error(f"--clutter/--zr: {e}")
+
+    if args.cache_dir:
+        # Las consultas usan la geometría en este proceso; las fusiones, en los del pool
+        geometria.configurar_cache(directorio=args.cache_dir)
+
+    servicio = ServicioLluvia(args.pluviometros, args.datos_dir, args.metodo, args.centro_lon, args.centro_lat,
+                              args.resolucion_km, args.ventana, zr, args.max_campos, args.procesos,
+                              args.cache_dir, control=not args.sin_control)
+    try:
+        asyncio.run(servir(servicio, args.radar, args.host, args.puerto))
+    except KeyboardInterrupt:
+        print("\nServicio detenido")
+    except OSError as e:
+        print(f"ERROR: {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        servicio.cerrar()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
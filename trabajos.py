@@ -0,0 +1,104 @@
+"""Ejecución de fusiones en un hilo de trabajo, fuera del hilo de la interfaz.
+
+La interfaz encola trabajos con ``TrabajadorFusion.encolar`` y consulta
+periódicamente (``after()`` en Tk) los eventos de ``TrabajadorFusion.eventos``:
+
+- ``('log', id, mensaje)``: mensaje de progreso del trabajo.
+- ``('estado', id, estado, detalle)``: ``'iniciado'``, ``'ok'``,
+  ``'error'`` o ``'cancelado'``.
+
+Los trabajos se ejecutan de uno en uno y en orden. Cancelar es cooperativo:
+la función ``log`` que recibe el núcleo lanza ``Cancelado`` en cuanto se
+pide, así que el trabajo se detiene en la siguiente etapa sin dejar
+archivos a medias abiertos.
+"""
+import itertools
+import queue
+import threading
+
+import fusion
+
+
+class Cancelado(Exception):
+    """El usuario canceló el trabajo en curso"""
+
+
+class TrabajadorFusion:
+    """Hilo que ejecuta las fusiones encoladas e informa por una cola de eventos"""
+
+    def __init__(self, funcion=fusion.ejecutar_fusion):
+        self.funcion = funcion
+        self.eventos = queue.Queue()
+        self._pendientes = queue.Queue()
+        self._cancelar = threading.Event()
+        self._contador = itertools.count(1)
+        self._cancelados = set()
+        self._en_curso = None
+        self._hilo = threading.Thread(target=self._bucle, name="TrabajadorFusion", daemon=True)
+        self._hilo.start()
+
+    @property
+    def en_curso(self):
+        """Id del trabajo en ejecución (None si está libre)"""
+        return self._en_curso
+
+    def pendientes(self):
+        """Número aproximado de trabajos esperando en la cola"""
+        return self._pendientes.qsize()
+
+    def encolar(self, **parametros):
+        """Añade un trabajo con los parámetros de ``funcion`` y devuelve su id"""
+        id_trabajo = next(self._contador)
+        self._pendientes.put((id_trabajo, parametros))
+        return id_trabajo
+
+    def cancelar(self, todos=False):
+        """Cancela el trabajo en curso y, con ``todos``, también los pendientes"""
+        if todos:
+            while True:
+                try:
+                    id_trabajo, _ = self._pendientes.get_nowait()
+                except queue.Empty:
+                    break
+                self._cancelados.add(id_trabajo)
+                self.eventos.put(('estado', id_trabajo, 'cancelado', ''))
+        if self._en_curso is not None:
+            self._cancelar.set()
+
+    def detener(self):
+        """Cancela todo y termina el hilo cuando acabe el trabajo actual"""
+        self.cancelar(todos=True)
+        self._pendientes.put(None)
+
+    def _bucle(self):
+        while True:
+            trabajo = self._pendientes.get()
+            if trabajo is None:
+                return
+            id_trabajo, parametros = trabajo
+            if id_trabajo in self._cancelados:
+                continue
+            self._ejecutar(id_trabajo, parametros)
+
+    def _ejecutar(self, id_trabajo, parametros):
+        self._cancelar.clear()
+        self._en_curso = id_trabajo
+
+        def log(mensaje):
+            if self._cancelar.is_set():
+                raise Cancelado()
+            self.eventos.put(('log', id_trabajo, mensaje))
+
+        self.eventos.put(('estado', id_trabajo, 'iniciado', ''))
+        try:
+            self.funcion(log=log, **parametros)
+            if self._cancelar.is_set():
+                raise Cancelado()
+        except Cancelado:
+            self.eventos.put(('estado', id_trabajo, 'cancelado', ''))
+        except Exception as e:
+            self.eventos.put(('estado', id_trabajo, 'error', str(e)))
+        else:
+            self.eventos.put(('estado', id_trabajo, 'ok', parametros.get('ruta_salida', '')))
+        finally:
+            self._en_curso = None
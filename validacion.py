@@ -0,0 +1,319 @@
+"""Validación cruzada de los métodos de corrección sobre los pluviómetros.
+
+Cada pluviómetro se estima sin usarlo en la corrección (dejando uno fuera o
+por pliegues) y se comparan estimación y observación con las mismas
+métricas que ``calculate_comparison_stats`` (sesgo, MAE, RMSE y
+correlación). El radar se muestrea una sola vez por escaneo con el plan
+cacheado de la geometría y las predicciones dejando uno fuera se obtienen
+sin reajustar nada: los factores únicos se actualizan restando el propio
+pluviómetro y los métodos locales buscan un vecino más en el KD-tree y
+descartan el propio.
+
+Ejemplo:
+    python validacion.py lluvia8junio.nc lluvia.xls --pliegues 10
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import correccion
+import fusion
+import lote
+import reflectividad
+from correccion import UMBRAL_LLUVIA
+
+METODOS_VALIDACION = ('radar',) + correccion.METODOS_CORRECCION
+
+
+def estadisticas(observado, estimado):
+    """Sesgo, MAE, RMSE y correlación de observado - estimado (pares finitos)"""
+    observado = np.asarray(observado, dtype=float)
+    estimado = np.asarray(estimado, dtype=float)
+    validos = np.isfinite(observado) & np.isfinite(estimado)
+    observado = observado[validos]
+    estimado = estimado[validos]
+    diferencia = observado - estimado
+
+    if diferencia.size == 0:
+        return {'n': 0, 'sesgo': np.nan, 'mae': np.nan, 'rmse': np.nan, 'correlacion': np.nan}
+
+    correlacion = np.nan
+    if diferencia.size > 1 and observado.std() > 0 and estimado.std() > 0:
+        correlacion = float(np.corrcoef(observado, estimado)[0, 1])
+
+    return {
+        'n': int(diferencia.size),
+        'sesgo': float(diferencia.mean()),
+        'mae': float(np.abs(diferencia).mean()),
+        'rmse': float(np.sqrt((diferencia ** 2).mean())),
+        'correlacion': correlacion,
+    }
+
+
+def _mediana_sin_uno(valores):
+    """Mediana de ``valores`` quitando cada elemento por turno, sin bucles"""
+    m = len(valores)
+    if m < 2:
+        return np.full(m, np.nan)
+
+    orden = np.argsort(valores)
+    ordenados = valores[orden]
+    rango = np.empty(m, dtype=np.intp)
+    rango[orden] = np.arange(m)
+    n = m - 1
+
+    def elemento(posicion):
+        # Posición en el array ordenado una vez quitado el elemento de rango ``rango``
+        return ordenados[np.where(posicion < rango, posicion, posicion + 1)]
+
+    if n % 2:
+        return elemento(np.full(m, (n - 1) // 2))
+    return 0.5 * (elemento(np.full(m, n // 2 - 1)) + elemento(np.full(m, n // 2)))
+
+
+def _factor_sin_uno(valores_pluv, radar_en_pluv, metodo):
+    """Factor escalar de cada pluviómetro calculado sin él (actualización de rango uno)"""
+    lluvia = radar_en_pluv > UMBRAL_LLUVIA
+    factor_total = correccion.factor_unico(valores_pluv, radar_en_pluv, metodo)
+    factores = np.full(len(valores_pluv), factor_total)
+
+    if metodo == 'campo_medio':
+        suma_pluv = valores_pluv[lluvia].sum() - np.where(lluvia, valores_pluv, 0.0)
+        suma_radar = radar_en_pluv[lluvia].sum() - np.where(lluvia, radar_en_pluv, 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            factores = np.where(suma_radar > 0, suma_pluv / suma_radar, 1.0)
+    elif lluvia.any():
+        sin_uno = _mediana_sin_uno(valores_pluv[lluvia] / radar_en_pluv[lluvia])
+        factores[lluvia] = np.where(np.isfinite(sin_uno), sin_uno, 1.0)
+
+    return factores
+
+
+def _vecinos_sin_grupo(xy, candidatos, k, grupo, pliegues):
+    """Vecinos de cada pluviómetro entre ``candidatos`` excluyendo su propio grupo.
+
+    Dejando uno fuera (``pliegues`` None) basta un KD-tree con un vecino más
+    del necesario; por pliegues se construye un KD-tree por pliegue. Devuelve
+    distancias e índices sobre ``candidatos`` (``len(candidatos)`` = hueco).
+    """
+    n = len(xy)
+    hueco = len(candidatos)
+    distancias = np.full((n, k), np.inf)
+    indices = np.full((n, k), hueco, dtype=np.intp)
+    if k < 1 or hueco == 0:
+        return distancias, indices
+
+    if pliegues is None:
+        consulta = min(k + 1, hueco)
+        d, j = cKDTree(xy[candidatos]).query(xy, k=consulta)
+        d = d.reshape(n, consulta)
+        j = j.reshape(n, consulta)
+        propio = candidatos[j] == np.arange(n)[:, np.newaxis]
+        d = np.where(propio, np.inf, d)
+        j = np.where(propio, hueco, j)
+        orden = np.argsort(d, axis=1, kind='stable')[:, :k]
+        tomados = min(k, consulta)
+        distancias[:, :tomados] = np.take_along_axis(d, orden, axis=1)[:, :tomados]
+        indices[:, :tomados] = np.take_along_axis(j, orden, axis=1)[:, :tomados]
+        return distancias, indices
+
+    for pliegue in range(pliegues):
+        prueba = np.flatnonzero(grupo == pliegue)
+        entrenamiento = candidatos[grupo[candidatos] != pliegue]
+        consulta = min(k, len(entrenamiento))
+        if prueba.size == 0 or consulta == 0:
+            continue
+        d, j = cKDTree(xy[entrenamiento]).query(xy[prueba], k=consulta)
+        distancias[prueba, :consulta] = d.reshape(len(prueba), consulta)
+        indices[prueba, :consulta] = np.searchsorted(candidatos, entrenamiento[j.reshape(len(prueba), consulta)])
+    return distancias, indices
+
+
+def _interpolar_validacion(metodo, xy, valores, candidatos, grupo, pliegues, vecinos, potencia):
+    """Interpola ``valores`` (definidos en ``candidatos``) en cada pluviómetro sin su grupo"""
+    if pliegues is None:
+        k = min(vecinos, len(candidatos) - 1)
+    else:
+        k = min(vecinos, min(np.sum(grupo[candidatos] != p) for p in range(pliegues)))
+    if k < 1:
+        return np.full(len(xy), np.nan)
+
+    distancias, indices = _vecinos_sin_grupo(xy, candidatos, k, grupo, pliegues)
+    if metodo == 'idw':
+        return correccion.idw_con_vecinos(valores, distancias, indices, potencia)
+
+    variograma = correccion.ajustar_variograma(xy[candidatos], valores)
+    return correccion.kriging_con_vecinos(xy[candidatos], valores, distancias, indices, variograma)
+
+
+def predicciones_validacion(lon_pts, lat_pts, valores_pluv, radar_en_pluv, metodo, pliegues=None,
+                            vecinos=8, potencia=2.0, xy=None, semilla=0):
+    """Estimación de cada pluviómetro con el radar corregido sin ese pluviómetro.
+
+    ``pliegues`` None es validación dejando uno fuera; un entero, validación
+    por pliegues aleatorios (reproducibles con ``semilla``). El variograma de
+    los métodos de kriging se ajusta una vez con todos los pluviómetros.
+    ``xy`` son las posiciones (n, 2) en km en la rejilla del radar; sin ellas
+    se usa una proyección equirrectangular local.
+    """
+    if metodo not in METODOS_VALIDACION:
+        raise ValueError(f"Método desconocido: {metodo} (opciones: {', '.join(METODOS_VALIDACION)})")
+
+    n = len(valores_pluv)
+    if metodo == 'radar':
+        return radar_en_pluv.copy()
+
+    if pliegues is None:
+        grupo = np.arange(n)
+    else:
+        grupo = np.random.default_rng(semilla).permutation(n) % pliegues
+
+    if metodo in ('mediana', 'campo_medio'):
+        if pliegues is None:
+            return radar_en_pluv * _factor_sin_uno(valores_pluv, radar_en_pluv, metodo)
+        factores = np.empty(n)
+        for pliegue in range(pliegues):
+            prueba = grupo == pliegue
+            factores[prueba] = correccion.factor_unico(valores_pluv[~prueba], radar_en_pluv[~prueba], metodo)
+        return radar_en_pluv * factores
+
+    if xy is None:
+        xy = np.column_stack(correccion.coordenadas_km(lon_pts, lat_pts, float(np.mean(lat_pts))))
+
+    if metodo == 'condicional':
+        todos = np.arange(n)
+        pluv_k = _interpolar_validacion('kriging', xy, valores_pluv, todos, grupo, pliegues, vecinos, potencia)
+        radar_k = _interpolar_validacion('kriging', xy, radar_en_pluv, todos, grupo, pliegues, vecinos, potencia)
+        return np.maximum(pluv_k + (radar_en_pluv - radar_k), 0.0)
+
+    cocientes, lluvia = correccion.log_cocientes(valores_pluv, radar_en_pluv)
+    candidatos = np.flatnonzero(lluvia)
+    estimado = _interpolar_validacion(metodo, xy, cocientes[candidatos], candidatos, grupo,
+                                      pliegues, vecinos, potencia)
+
+    # Sin vecinos (o sin pares con lluvia) se recurre al sesgo medio sin el propio grupo
+    sin_dato = ~np.isfinite(estimado)
+    if sin_dato.any():
+        for i in np.flatnonzero(sin_dato):
+            otros = lluvia & (grupo != grupo[i])
+            estimado[i] = cocientes[otros].mean() if otros.any() else 0.0
+
+    return correccion.aplicar_factor(radar_en_pluv, np.exp(estimado))
+
+
+def validar(radar_da, pluviometros_gdf, metodos=METODOS_VALIDACION, pliegues=None, vecinos=8,
+            metodo_muestreo='bilineal', log=print):
+    """Valida cada método sobre un escaneo; devuelve (métricas, predicciones) como DataFrames"""
+    if radar_da.ndim != 2:
+        raise ValueError("La validación necesita un campo 2D; acumule primero el cubo de radar")
+
+    radar_en_pluv = fusion.muestrear_pluviometros(radar_da, pluviometros_gdf, metodo_muestreo)
+    valores_pluv = pluviometros_gdf.precipitacion.values.astype(float)
+    validos = np.isfinite(radar_en_pluv) & np.isfinite(valores_pluv)
+    lon_pts = pluviometros_gdf.longitud.values.astype(float)[validos]
+    lat_pts = pluviometros_gdf.latitud.values.astype(float)[validos]
+    valores_pluv = valores_pluv[validos]
+    radar_en_pluv = radar_en_pluv[validos]
+
+    esquema = "dejando uno fuera" if pliegues is None else f"{pliegues} pliegues"
+    log(f"Validación cruzada ({esquema}) con {validos.sum()} pluviómetros")
+
+    predicciones = pd.DataFrame({
+        'longitud': lon_pts,
+        'latitud': lat_pts,
+        'pluviometro': valores_pluv,
+    })
+    # Las distancias entre pluviómetros, en la misma proyección que usa la corrección
+    _, _, x_pts, y_pts = correccion.coordenadas_radar_km(radar_da, lon_pts, lat_pts)
+    for metodo in metodos:
+        predicciones[metodo] = predicciones_validacion(
+            lon_pts, lat_pts, valores_pluv, radar_en_pluv, metodo,
+            pliegues=pliegues, vecinos=vecinos, xy=np.column_stack([x_pts, y_pts])
+        )
+
+    return resumen_metricas(predicciones, metodos), predicciones
+
+
+def resumen_metricas(predicciones, metodos):
+    """Tabla de métricas por método a partir de la tabla de predicciones"""
+    filas = [dict(metodo=m, **estadisticas(predicciones['pluviometro'], predicciones[m])) for m in metodos]
+    return pd.DataFrame(filas).set_index('metodo')
+
+
+def validar_escaneos(rutas_radar, pluviometros, metodos=METODOS_VALIDACION, pliegues=None, vecinos=8,
+                     centro_lon=fusion.CENTRO_LON, centro_lat=fusion.CENTRO_LAT,
+                     resolucion_km=fusion.RESOLUCION_KM, zr=None, log=print):
+    """Valida sobre varios escaneos y agrega las predicciones de todos ellos"""
+    silencioso = lambda mensaje: None
+    parejas = lote.emparejar_pluviometros(rutas_radar, pluviometros)
+    todas = []
+
+    for ruta in rutas_radar:
+        if parejas[ruta] is None:
+            log(f"Sin pluviómetros para {ruta}, se omite")
+            continue
+        radar = fusion.cargar_datos_radar(ruta, centro_lon, centro_lat, resolucion_km, log=silencioso)
+        radar = fusion.preparar_campo(radar, zr=zr, en_sitio=True, log=silencioso)
+        pluv = fusion.cargar_datos_pluviometros(parejas[ruta], log=silencioso)
+        _, predicciones = validar(radar, pluv, metodos, pliegues, vecinos, log=log)
+        predicciones.insert(0, 'radar_archivo', ruta)
+        todas.append(predicciones)
+
+    if not todas:
+        raise ValueError("No se pudo validar ningún escaneo")
+
+    predicciones = pd.concat(todas, ignore_index=True)
+    return resumen_metricas(predicciones, metodos), predicciones
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(
+        description="Validación cruzada de los métodos de fusión radar-pluviómetros"
+    )
+    parser.add_argument("radar", help="Archivo, directorio o patrón glob de archivos de radar (NetCDF)")
+    parser.add_argument("pluviometros", help="Archivo de pluviómetros común o directorio con uno por escaneo")
+    parser.add_argument("--pliegues", type=int, default=None,
+                        help="Número de pliegues (por defecto, dejando uno fuera)")
+    parser.add_argument("--metodos", nargs='+', default=list(METODOS_VALIDACION),
+                        choices=METODOS_VALIDACION, help="Métodos a validar")
+    parser.add_argument("--vecinos", type=int, default=8, help="Vecinos de los métodos locales")
+    parser.add_argument("--predicciones", default=None, help="CSV donde guardar las predicciones")
+    parser.add_argument("--centro-lon", type=float, default=fusion.CENTRO_LON,
+                        help="Longitud del centro del radar")
+    parser.add_argument("--centro-lat", type=float, default=fusion.CENTRO_LAT,
+                        help="Latitud del centro del radar")
+    parser.add_argument("--resolucion-km", type=float, default=fusion.RESOLUCION_KM,
+                        help="Resolución de la rejilla del radar (km)")
+    reflectividad.agregar_argumentos(parser)
+    return parser
+
+
+def main(argv=None):
+    args = crear_parser().parse_args(argv)
+
+    rutas_radar = lote.buscar_archivos_radar(args.radar)
+    if not rutas_radar:
+        print(f"ERROR: No se encontraron archivos de radar en {args.radar}", file=sys.stderr)
+        return 1
+
+    try:
+        metricas, predicciones = validar_escaneos(
+            rutas_radar, args.pluviometros, args.metodos, args.pliegues, args.vecinos,
+            args.centro_lon, args.centro_lat, args.resolucion_km, zr=reflectividad.desde_argumentos(args)
+        )
+    except Exception as e:
+        print(f"ERROR: {str(e)}", file=sys.stderr)
+        return 1
+
+    print(metricas.to_string(float_format=lambda v: f"{v:.3f}"))
+    if args.predicciones:
+        predicciones.to_csv(args.predicciones, index=False)
+        print(f"Predicciones guardadas en: {args.predicciones}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""Modo vigilancia: fusiona cada radar nuevo que aparece en un directorio de entrada.
+
+El radar deja un NetCDF cada pocos minutos; este proceso consulta el
+directorio cada ``--intervalo`` segundos y manda cada archivo nuevo a un pool
+de procesos persistente (las mismas tareas que ``lote``). Como los procesos
+no se reinician, cada uno mantiene en memoria la tabla de pluviómetros, la
+geometría del radar y el mapa base entre archivos, y el primer archivo es el
+único que paga la preparación.
+
+- Un archivo se procesa cuando su tamaño y fecha no cambian durante
+  ``--estabilidad`` segundos (se ignoran los temporales ``.tmp``/``.part`` y
+  los ocultos), para no leer escaneos a medio escribir.
+- El atraso se procesa por hora de escaneo, del más antiguo al más nuevo,
+  con como mucho ``--procesos`` escaneos a la vez. Un escaneo que llega
+  después de otro más reciente no se puede añadir al ``--producto``.
+- Un radar sin hora de escaneo toma la fecha del archivo; si coincide con
+  la de otro escaneo se omite con un aviso, en lugar de sustituirlo en el
+  ``--producto``.
+- Los archivos ya procesados se anotan en ``--estado``; al reiniciar no se
+  repiten, salvo que el archivo haya cambiado.
+
+Ejemplo:
+    python vigilancia.py entrada/ --pluviometros lluvia.xls --salida-dir mapas -j 2 --producto serie.nc
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fusion
+import geometria
+import instrumentacion
+import lote
+import pluviometros
+import productos
+import reflectividad
+import renderizado
+
+INTERVALO_S = 1.0
+ESTABILIDAD_S = 2.0
+
+# Sufijos que usan los programas de copia y transferencia mientras escriben
+SUFIJOS_TEMPORALES = ('.tmp', '.part', '.partial', '.crdownload', '.filepart')
+
+
+def _preparar_proceso(cache_dir, ruta_pluviometros):
+    """Inicializador de cada proceso: caché compartida y pluviómetros ya en memoria"""
+    if cache_dir:
+        geometria.configurar_cache(directorio=cache_dir)
+        pluviometros.configurar_cache(cache_dir)
+    if ruta_pluviometros and os.path.isfile(ruta_pluviometros):
+        try:
+            pluviometros.cargar_tabla(ruta_pluviometros, log=lambda mensaje: None)
+        except Exception:
+            # El error se verá, con su mensaje, al procesar el primer escaneo
+            pass
+
+
+def es_candidato(nombre):
+    """True si el nombre corresponde a un NetCDF terminado (no oculto ni temporal)"""
+    minusculas = nombre.lower()
+    return (not nombre.startswith(('.', '~')) and minusculas.endswith('.nc')
+            and not minusculas.endswith(SUFIJOS_TEMPORALES))
+
+
+def leer_estado(ruta):
+    """Firmas (tamaño, mtime_ns) de los archivos ya procesados según el archivo de estado"""
+    procesados = {}
+    if ruta and os.path.exists(ruta):
+        with open(ruta, encoding='utf-8') as f:
+            for linea in f:
+                partes = linea.rstrip("\n").split("\t")
+                if len(partes) == 3:
+                    procesados[partes[0]] = (int(partes[1]), int(partes[2]))
+    return procesados
+
+
+class Vigilante:
+    """Detecta los radares nuevos de ``entrada`` y los fusiona en un pool de procesos"""
+
+    def __init__(self, entrada, pluviometros, salida_dir, procesos=2, estabilidad=ESTABILIDAD_S,
+                 intervalo=INTERVALO_S, estado=None, producto=None, registro=None, opciones=None, log=print):
+        self.entrada = entrada
+        self.pluviometros = pluviometros
+        self.salida_dir = salida_dir
+        self.procesos = max(1, procesos)
+        self.estabilidad = estabilidad
+        self.intervalo = intervalo
+        self.estado = estado
+        self.producto = producto
+        self.registro = registro
+        # Argumentos de ``lote.preparar_tareas`` comunes a todos los escaneos
+        self.opciones = dict(opciones or {})
+        self.log = log
+
+        self.procesados = leer_estado(estado)
+        self._observados = {}      # ruta -> (firma, instante desde el que no cambia, primera vez visto)
+        self._pendientes = deque()  # (ruta, firma, instante de llegada), del más antiguo al más nuevo
+        self._en_vuelo = deque()    # (ruta, firma, llegada, futuro), en orden de envío
+        self._tiempos = {}          # instante -> (ruta, sin hora propia) de los escaneos ya enviados
+
+    def _firma(self, entrada):
+        info = entrada.stat()
+        return info.st_size, info.st_mtime_ns
+
+    def explorar(self, ahora=None):
+        """Pasa a pendientes los archivos nuevos que ya llevan ``estabilidad`` segundos sin cambiar"""
+        ahora = time.monotonic() if ahora is None else ahora
+        ocupados = {p[0] for p in self._pendientes} | {v[0] for v in self._en_vuelo}
+        listos = []
+        vistos = set()
+
+        with os.scandir(self.entrada) as entradas:
+            for entrada in entradas:
+                if not entrada.is_file() or not es_candidato(entrada.name):
+                    continue
+                ruta = entrada.path
+                vistos.add(ruta)
+                try:
+                    firma = self._firma(entrada)
+                except FileNotFoundError:
+                    continue
+                if ruta in ocupados or self.procesados.get(ruta) == firma or firma[0] == 0:
+                    continue
+
+                anterior = self._observados.get(ruta)
+                if anterior is None or anterior[0] != firma:
+                    # Archivo nuevo o todavía creciendo: se vuelve a mirar en la próxima pasada
+                    self._observados[ruta] = (firma, ahora, anterior[2] if anterior else ahora)
+                elif ahora - anterior[1] >= self.estabilidad:
+                    hora = fusion.hora_escaneo_radar(ruta)
+                    tiempo = fusion.fecha_archivo(ruta) if hora is None else hora
+                    listos.append((tiempo, hora is None, ruta, firma, anterior[2]))
+
+        # Los archivos borrados antes de estabilizarse se olvidan
+        for ruta in set(self._observados) - vistos:
+            del self._observados[ruta]
+
+        for tiempo, sin_hora, ruta, firma, llegada in sorted(listos):
+            del self._observados[ruta]
+            otra, otra_sin_hora = self._tiempos.get(tiempo, (ruta, False))
+            if self.producto is not None and otra != ruta and (sin_hora or otra_sin_hora):
+                # Con la fecha del archivo como hora, uno de los dos sustituiría al otro en el producto
+                self.log(f"Aviso: {os.path.basename(ruta)} tiene la misma hora ({tiempo}) que "
+                         f"{os.path.basename(otra)} y uno de ellos no trae hora de escaneo; se omite")
+                self._anotar(ruta, firma)
+                continue
+            self._tiempos[tiempo] = (ruta, sin_hora)
+            self._pendientes.append((ruta, firma, llegada))
+        return len(listos)
+
+    def _enviar(self, executor):
+        while self._pendientes and len(self._en_vuelo) < self.procesos:
+            ruta, firma, llegada = self._pendientes.popleft()
+            tarea, = lote.preparar_tareas([ruta], self.pluviometros, self.salida_dir,
+                                          producto=self.producto, registro=bool(self.registro),
+                                          **self.opciones)
+            try:
+                futuro = executor.submit(lote._procesar_escaneo, tarea)
+            except BrokenProcessPool:
+                self._pendientes.appendleft((ruta, firma, llegada))
+                raise
+            self._en_vuelo.append((ruta, firma, llegada, futuro))
+
+    def _recoger(self):
+        """Atiende los escaneos terminados, en el orden en que se enviaron"""
+        terminados = 0
+        while self._en_vuelo and self._en_vuelo[0][3].done():
+            ruta, firma, llegada, futuro = self._en_vuelo.popleft()
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                resultado = {'estado': 'error', 'error': f"Fallo del proceso: {str(e)}", 'salida': ''}
+
+            campo = resultado.pop('campo', None)
+            if self.producto is not None and campo is not None:
+                try:
+                    productos.guardar_producto(campo, self.producto, resultado.get('tiempo'),
+                                               log=lambda mensaje: None)
+                except Exception as e:
+                    resultado['estado'] = 'error'
+                    resultado['error'] = f"Producto: {str(e)}"
+            if self.registro and resultado.get('medidas'):
+                instrumentacion.guardar_ejecucion(resultado['medidas'], self.registro)
+
+            latencia = time.monotonic() - llegada
+            if resultado['estado'] == 'ok':
+                self.log(f"OK {os.path.basename(ruta)} -> {resultado['salida']} "
+                         f"({latencia:.1f} s desde su llegada)")
+            else:
+                self.log(f"ERROR {os.path.basename(ruta)}: {resultado['error']}")
+            # También los fallidos: se reintentan solo si el archivo vuelve a cambiar
+            self._anotar(ruta, firma)
+            terminados += 1
+        return terminados
+
+    def _anotar(self, ruta, firma):
+        self.procesados[ruta] = firma
+        if self.estado:
+            with open(self.estado, 'a', encoding='utf-8') as f:
+                f.write(f"{ruta}\t{firma[0]}\t{firma[1]}\n")
+
+    def ocupado(self):
+        return bool(self._pendientes or self._en_vuelo or self._observados)
+
+    def ejecutar(self, una_vez=False):
+        """Bucle principal; con ``una_vez`` termina al vaciar lo que hay en el directorio"""
+        os.makedirs(self.salida_dir, exist_ok=True)
+        cache_dir = self.opciones.get('cache_dir')
+        procesados = 0
+
+        while True:
+            executor = ProcessPoolExecutor(max_workers=self.procesos, initializer=_preparar_proceso,
+                                           initargs=(cache_dir, self.pluviometros))
+            try:
+                while True:
+                    self.explorar()
+                    self._enviar(executor)
+                    procesados += self._recoger()
+                    if una_vez and not self.ocupado():
+                        return procesados
+                    # Con trabajo en vuelo se espera a que termine el primero; si no, a la próxima pasada
+                    if self._en_vuelo:
+                        try:
+                            self._en_vuelo[0][3].result(timeout=self.intervalo)
+                        except Exception:
+                            pass
+                    else:
+                        time.sleep(self.intervalo)
+            except BrokenProcessPool:
+                # Un proceso murió (memoria, señal...): sus escaneos quedan como fallidos y se sigue con otro pool
+                procesados += self._recoger()
+                self.log("Aviso: un proceso de fusión terminó de forma anómala; se reinicia el pool")
+            except KeyboardInterrupt:
+                self.log("\nDetenido: se descartan los escaneos pendientes")
+                return procesados
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(
+        description="Fusión radar-pluviómetros en tiempo casi real de los radares que llegan a un directorio"
+    )
+    parser.add_argument("entrada", help="Directorio donde el radar deja los NetCDF")
+    parser.add_argument("--pluviometros", required=True,
+                        help="Archivo de pluviómetros común o directorio con uno por escaneo")
+    parser.add_argument("--salida-dir", default="mapas", help="Directorio de los mapas generados")
+    parser.add_argument("-j", "--procesos", type=int, default=2,
+                        help="Escaneos procesados a la vez como máximo")
+    parser.add_argument("--intervalo", type=float, default=INTERVALO_S,
+                        help="Segundos entre dos exploraciones del directorio")
+    parser.add_argument("--estabilidad", type=float, default=ESTABILIDAD_S,
+                        help="Segundos que un archivo debe seguir igual antes de procesarlo")
+    parser.add_argument("--estado", default=None,
+                        help="Archivo con los escaneos ya procesados (por defecto, en --salida-dir)")
+    parser.add_argument("--una-vez", action="store_true",
+                        help="Procesar lo que haya en el directorio y terminar")
+    parser.add_argument("--calidad", default="final", choices=tuple(renderizado.CALIDADES),
+                        help="Calidad de los mapas: borrador (vista previa rápida) o final (300 dpi)")
+    parser.add_argument("--producto", default=None,
+                        help="NetCDF (.nc), Zarr (.zarr) o archivo de campos (.arch) donde acumular los campos "
+                             "corregidos a lo largo del tiempo")
+    parser.add_argument("--geotiff", action="store_true",
+                        help="Guardar también un GeoTIFF del campo corregido de cada escaneo")
+    parser.add_argument("--sin-control", action="store_true",
+                        help="No pasar el control de calidad a los pluviómetros antes de fusionar")
+    parser.add_argument("--registro", default=None,
+                        help="Añadir las medidas por etapa de cada escaneo a este registro (.csv o .jsonl)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directorio de la caché de geometría del radar y de tablas de pluviómetros")
+    parser.add_argument("--centro-lon", type=float, default=fusion.CENTRO_LON,
+                        help="Longitud del centro del radar")
+    parser.add_argument("--centro-lat", type=float, default=fusion.CENTRO_LAT,
+                        help="Latitud del centro del radar")
+    parser.add_argument("--resolucion-km", type=float, default=fusion.RESOLUCION_KM,
+                        help="Resolución de la rejilla del radar (km)")
+    reflectividad.agregar_argumentos(parser)
+    return parser
+
+
+def main(argv=None):
+    parser = crear_parser()
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.entrada):
+        parser.error(f"No existe el directorio de entrada: {args.entrada}")
+    if args.producto:
+        try:
+            formato = productos.formato_de(args.producto)
+        except ValueError as e:
+            parser.error(str(e))
+        if formato not in ('netcdf', 'zarr', 'archivo'):
+            parser.error("--producto debe ser un NetCDF (.nc), un almacén Zarr (.zarr) o un archivo de campos "
+                         "(.arch)")
+    try:
+        zr = reflectividad.desde_argumentos(args)
+    except (OSError, ValueError) as e:
+        parser.error(f"--clutter/--zr: {e}")
+
+    vigilante = Vigilante(
+        args.entrada, args.pluviometros, args.salida_dir,
+        procesos=args.procesos,
+        estabilidad=args.estabilidad,
+        intervalo=args.intervalo,
+        estado=args.estado or os.path.join(args.salida_dir, 'procesados_vigilancia.txt'),
+        producto=args.producto,
+        registro=args.registro,
+        opciones={
+            'centro_lon': args.centro_lon,
+            'centro_lat': args.centro_lat,
+            'resolucion_km': args.resolucion_km,
+            'cache_dir': args.cache_dir,
+            'calidad': args.calidad,
+            'geotiff': args.geotiff,
+            'zr': zr,
+            'control': not args.sin_control,
+        }
+    )
+
+    print(f"=== VIGILANDO {args.entrada} (hasta {vigilante.procesos} escaneos a la vez) ===")
+    procesados = vigilante.ejecutar(una_vez=args.una_vez)
+    print(f"Escaneos procesados: {procesados}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""Estadísticas zonales de lluvia por provincia o cuenca.
+
+Para cada polígono de una capa de ``shpfiles/`` se calcula una vez la
+fracción de cada píxel del radar que cae dentro (cobertura fraccional, con
+el polígono proyectado a la rejilla x/y en km del radar), y
+se guarda como matriz dispersa (polígonos × píxeles) en la caché de la
+geometría del radar. Con ella, las estadísticas de todos los polígonos en
+un paso de tiempo son un producto matriz dispersa-vector:
+
+- ``media``: lluvia media areal (mm), ponderada por el área cubierta.
+- ``maximo``: máximo de los píxeles que tocan el polígono (mm).
+- ``area_sobre_umbral``: área con lluvia mayor que el umbral (km²).
+- ``volumen``: volumen de agua caído (m³).
+
+Ejemplo:
+    python zonal.py lluvia8junio.nc --capa cuba --umbral 10 -o zonal.csv
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import capas
+import reflectividad
+from geometria import geometria_de
+
+# 1 mm de lluvia sobre 1 km² son 1000 m³
+M3_POR_MM_KM2 = 1000.0
+
+# Matrices de cobertura ya montadas en este proceso: (clave geometría, capa) -> (matriz, áreas)
+_matrices = {}
+
+
+def _bordes(eje):
+    """Bordes de las celdas de un eje regular de centros"""
+    paso = (eje[-1] - eje[0]) / (len(eje) - 1) if len(eje) > 1 else 1.0
+    return np.concatenate([eje - paso / 2, [eje[-1] + paso / 2]])
+
+
+def area_pixeles(x, y):
+    """Área (km²) de cada píxel de una rejilla con ejes en km, aplanada en orden (Y, X)"""
+    # En la acimutal equidistante el error de área a 250 km del radar es menor del 0.05 %
+    areas = np.abs(np.outer(np.diff(_bordes(y)), np.diff(_bordes(x))))
+    return areas.ravel()
+
+
+def cobertura_fraccional(x, y, poligono):
+    """Índices planos y fracción de cada píxel cubierta por ``poligono``.
+
+    ``poligono`` va en el mismo sistema que los ejes ``x``/``y`` de la
+    rejilla. Solo se examinan los píxeles dentro de la caja del polígono;
+    los que quedan enteramente dentro valen 1 y solo los del borde
+    necesitan intersección exacta.
+    """
+    import shapely
+
+    bordes_x = _bordes(x)
+    bordes_y = _bordes(y)
+    x_min, y_min, x_max, y_max = poligono.bounds
+    # Los ejes pueden ser crecientes o decrecientes
+    cols = np.flatnonzero((np.maximum(bordes_x[:-1], bordes_x[1:]) > x_min)
+                          & (np.minimum(bordes_x[:-1], bordes_x[1:]) < x_max))
+    filas = np.flatnonzero((np.maximum(bordes_y[:-1], bordes_y[1:]) > y_min)
+                           & (np.minimum(bordes_y[:-1], bordes_y[1:]) < y_max))
+    if cols.size == 0 or filas.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    ff, cc = np.meshgrid(filas, cols, indexing='ij')
+    ff = ff.ravel()
+    cc = cc.ravel()
+    celdas = shapely.box(bordes_x[cc], bordes_y[ff], bordes_x[cc + 1], bordes_y[ff + 1])
+
+    shapely.prepare(poligono)
+    fraccion = np.where(shapely.contains_properly(poligono, celdas), 1.0, 0.0)
+    borde = (fraccion == 0) & shapely.intersects(poligono, celdas)
+    if borde.any():
+        fraccion[borde] = shapely.area(shapely.intersection(celdas[borde], poligono)) / shapely.area(celdas[borde])
+
+    tocados = fraccion > 0
+    return (ff[tocados] * len(x) + cc[tocados]).astype(np.int64), fraccion[tocados].astype(np.float32)
+
+
+def _construir_cobertura(geometria, poligonos):
+    indices, fracciones, punteros = [], [], [0]
+    for poligono in poligonos:
+        idx, frac = cobertura_fraccional(geometria.x, geometria.y, geometria.proyectar_geometria(poligono))
+        indices.append(idx)
+        fracciones.append(frac)
+        punteros.append(punteros[-1] + len(idx))
+    return {
+        'datos': np.concatenate(fracciones) if fracciones else np.empty(0, dtype=np.float32),
+        'indices': np.concatenate(indices) if indices else np.empty(0, dtype=np.int64),
+        'punteros': np.asarray(punteros, dtype=np.int64),
+    }
+
+
+def matriz_cobertura(radar_da, capa='cuba'):
+    """Matriz dispersa (polígonos × píxeles) de área cubierta en km², cacheada por geometría"""
+    geometria = geometria_de(radar_da)
+    limites = capas.obtener_capa(capa)
+    ruta_shp = os.path.join(capas.ALMACEN.directorio, capa + '.shp')
+    nombre = f"zonal|{capa}@{os.path.getmtime(ruta_shp):.0f}"
+
+    clave = (geometria.clave, nombre)
+    if clave not in _matrices:
+        partes = geometria.arrays(nombre, lambda g: _construir_cobertura(g, limites.geometrias))
+        n_pixeles = len(geometria.x) * len(geometria.y)
+        fracciones = sparse.csr_matrix(
+            (partes['datos'], partes['indices'], partes['punteros']),
+            shape=(len(limites.geometrias), n_pixeles)
+        )
+        # Fracción cubierta por el área de cada píxel: pesos en km²
+        areas = fracciones.multiply(area_pixeles(geometria.x, geometria.y)[np.newaxis, :]).tocsr()
+        _matrices[clave] = (areas, np.asarray(areas.sum(axis=1)).ravel())
+    return _matrices[clave]
+
+
+def _nombres_poligonos(capa):
+    limites = capas.obtener_capa(capa)
+    if limites.columna_nombre is None:
+        return [str(i) for i in range(len(limites.geometrias))]
+    return list(limites.gdf[limites.columna_nombre].astype(str))
+
+
+def estadisticas_campo(areas, area_total, valores, umbral=1.0):
+    """Estadísticas de todos los polígonos para un campo (Y, X) ya aplanable"""
+    valores = np.asarray(valores, dtype=np.float64).ravel()
+    validos = np.isfinite(valores)
+    lluvia = np.where(validos, valores, 0.0)
+
+    area_valida = areas @ validos.astype(np.float64)
+    suma = areas @ lluvia
+    with np.errstate(invalid='ignore', divide='ignore'):
+        media = np.where(area_valida > 0, suma / area_valida, np.nan)
+
+    # Máximo por fila de la matriz dispersa, sin densificar
+    maximo = np.full(areas.shape[0], np.nan)
+    con_pixeles = np.diff(areas.indptr) > 0
+    if con_pixeles.any():
+        en_poligonos = np.where(validos, valores, -np.inf)[areas.indices]
+        maximos = np.maximum.reduceat(en_poligonos, areas.indptr[:-1][con_pixeles])
+        maximo[con_pixeles] = np.where(np.isfinite(maximos), maximos, np.nan)
+
+    return {
+        'area_cubierta_km2': area_total,
+        'cobertura_radar': np.divide(area_valida, area_total, out=np.zeros_like(area_total),
+                                     where=area_total > 0),
+        'media': media,
+        'maximo': maximo,
+        'area_sobre_umbral': areas @ (lluvia > umbral).astype(np.float64),
+        'volumen': suma * M3_POR_MM_KM2,
+    }
+
+
+def estadisticas_zonales(radar_da, capa='cuba', umbral=1.0, solo_cubiertos=True):
+    """DataFrame con las estadísticas de cada polígono (y paso de tiempo si es un cubo).
+
+    Con ``solo_cubiertos`` se omiten los polígonos que no tocan la rejilla del radar.
+    """
+    areas, area_total = matriz_cobertura(radar_da, capa)
+    nombres = np.asarray(_nombres_poligonos(capa), dtype=object)
+    cubiertos = area_total > 0 if solo_cubiertos else np.ones(len(nombres), dtype=bool)
+
+    if radar_da.ndim == 2:
+        pasos = [(None, radar_da)]
+    else:
+        dim = radar_da.dims[0]
+        pasos = ((radar_da[dim].values[i], radar_da.isel({dim: i})) for i in range(radar_da.sizes[dim]))
+
+    tablas = []
+    for tiempo, campo in pasos:
+        tabla = pd.DataFrame(estadisticas_campo(areas, area_total, campo.values, umbral))
+        tabla.insert(0, 'poligono', nombres)
+        if tiempo is not None:
+            tabla.insert(0, 'tiempo', tiempo)
+        tablas.append(tabla[cubiertos])
+
+    return pd.concat(tablas, ignore_index=True)
+
+
+def crear_parser():
+    import fusion
+
+    parser = argparse.ArgumentParser(description="Estadísticas zonales de lluvia del radar por polígono")
+    parser.add_argument("radar", help="Archivo de radar (NetCDF)")
+    parser.add_argument("--capa", default="cuba", help="Capa de polígonos de shpfiles/ (nombre sin .shp)")
+    parser.add_argument("--umbral", type=float, default=1.0, help="Umbral de lluvia para el área (mm)")
+    parser.add_argument("--ventana", default=None,
+                        help="Acumular antes los radares con dimensión temporal (1h, 3h, 6h, 24h)")
+    reflectividad.agregar_argumentos(parser)
+    parser.add_argument("-o", "--salida", default=None, help="CSV de salida (por defecto, se muestra)")
+    parser.add_argument("--centro-lon", type=float, default=fusion.CENTRO_LON,
+                        help="Longitud del centro del radar")
+    parser.add_argument("--centro-lat", type=float, default=fusion.CENTRO_LAT,
+                        help="Latitud del centro del radar")
+    parser.add_argument("--resolucion-km", type=float, default=fusion.RESOLUCION_KM,
+                        help="Resolución de la rejilla del radar (km)")
+    return parser
+
+
+def main(argv=None):
+    import acumulacion
+    import fusion
+
+    args = crear_parser().parse_args(argv)
+    silencioso = lambda mensaje: None
+
+    try:
+        zr = reflectividad.desde_argumentos(args)
+        with fusion.abrir_radar(args.radar, args.centro_lon, args.centro_lat, args.resolucion_km,
+                                log=silencioso) as radar:
+            dbz = reflectividad.es_reflectividad(radar)
+            if args.ventana is not None:
+                radar = acumulacion.acumular(radar, ventana=args.ventana,
+                                             tipo='reflectividad' if dbz else 'intensidad', zr=zr)
+            elif dbz:
+                radar = reflectividad.convertir_campo(radar, zr)
+            tabla = estadisticas_zonales(radar, args.capa, args.umbral)
+    except Exception as e:
+        print(f"ERROR: {str(e)}", file=sys.stderr)
+        return 1
+
+    if args.salida:
+        tabla.to_csv(args.salida, index=False)
+        print(f"Estadísticas guardadas en: {args.salida}")
+    else:
+        print(tabla.to_string(index=False, float_format=lambda v: f"{v:.2f}"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())